@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Benchmark webcompare against a synthetic site served from this process
+
+Generates an origin site and a slightly different target site, serves them
+on localhost and reports crawl throughput, parse time, the cost of each
+comparator and peak memory use as JSON, so runs can be compared to catch
+performance regressions::
+
+    benchmark.py --pages=500 -f before.json
+    benchmark.py --pages=500 --baseline=before.json
+
+With --baseline, the aggregate metrics (crawl throughput, median parse and
+comparator times and peak memory) which got more than --threshold worse, and
+by more than a small absolute amount, are listed and the exit status is 1.
+Runs with different settings can't be compared.
+"""
+from __future__ import absolute_import
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import json
+import logging
+import optparse
+import random
+import resource
+import sys
+import threading
+import time
+
+import webcompare
+from webcompare import (BodyComparator, ContentComparator, LengthComparator,
+                        Response, TitleComparator, Walker)
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+         "tempor incididunt ut labore et dolore magna aliqua enim ad minim veniam "
+         "quis nostrud exercitation ullamco laboris nisi aliquip ex ea commodo").split()
+
+#: Markup html5lib will complain about, used for --error-rate:
+BROKEN_MARKUP = ("<p><b>unclosed", "<div></span></div>", "<td>stray cell</td>",
+                 "<p>AT&T & co</p>", "<img src=x alt='a' alt='b'>")
+
+#: Metrics where a bigger number is an improvement; for all others it's a regression:
+HIGHER_IS_BETTER = ("pages_per_second", )
+
+#: Changes smaller than this are noise whatever --threshold says, by metric name
+NOISE_FLOORS = {"pages_per_second": 0.5,
+                "median_seconds": 0.001,
+                "peak_rss": 10 * 1024}
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_site(pages, page_size=20, fanout=10, error_rate=0.1, seed=0):
+    """Return a dict of path: HTML for a site of pages pages of about
+    page_size KB each, each linking to fanout others; error_rate is the
+    fraction of paragraphs with broken markup
+    """
+    rng = random.Random(seed)
+    paths = ["/"] + ["/page/%d" % i for i in range(1, pages)]
+    site = {}
+
+    for i, path in enumerate(paths):
+        # Link to the next page so every page is reachable, then at random:
+        links = [paths[(i + 1) % pages]] + [rng.choice(paths) for j in range(fanout - 1)]
+        # A few links to pages which don't exist:
+        if rng.random() < error_rate:
+            links.append("/missing/%d" % i)
+
+        parts = ["<html><head><title>Page %d %s</title></head><body>" % (i, rng.choice(WORDS)),
+                 "<div class='nav'>%s</div>" % "".join('<a href="%s">%s</a> ' % (link, rng.choice(WORDS))
+                                                       for link in links)]
+        size = sum(len(p) for p in parts)
+
+        while size < page_size * 1024:
+            if rng.random() < error_rate:
+                paragraph = rng.choice(BROKEN_MARKUP)
+            else:
+                paragraph = "<p>%s</p>" % " ".join(rng.choice(WORDS) for j in range(60))
+            parts.append(paragraph)
+            size += len(paragraph)
+
+        parts.append("</body></html>")
+        site[path] = "\n".join(parts)
+
+    return site
+
+
+def mutate_site(site, change_rate=0.05, seed=1):
+    """Return a copy of site with about change_rate of the words changed,
+    like a migrated site which mostly matches
+    """
+    rng = random.Random(seed)
+    target = {}
+
+    for path, html in site.items():
+        words = html.split(" ")
+        for i in range(len(words)):
+            if words[i] in WORDS and rng.random() < change_rate:
+                words[i] = rng.choice(WORDS)
+        target[path] = " ".join(words)
+
+    return target
+
+
+def serve_site(site):
+    """Serve site on a localhost port in a background thread, returning the server"""
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            body = site.get(self.path)
+            if body is None:
+                body = "<html><body>Not found</body></html>"
+                self.send_response(404)
+            else:
+                self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def get_comparators():
+    return [LengthComparator(), TitleComparator(), BodyComparator(), ContentComparator()]
+
+
+def get_peak_rss():
+    """Return this process's peak resident set size in KB (bytes on OS X)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def bench_crawl(origin_url, target_url, concurrency=1):
+    """Crawl the origin site with every comparator and return throughput and stage timings"""
+    walker = Walker(origin_url, target_url, concurrency=concurrency)
+    for comparator in get_comparators():
+        walker.add_comparator(comparator)
+
+    start = time.time()
+    walker.walk_and_compare()
+    elapsed = time.time() - start
+    walker.connection_pool.close()
+
+    return {"pages": len(walker.results),
+            "seconds": elapsed,
+            "pages_per_second": len(walker.results) / elapsed,
+            "stages": walker.get_timing_stats()}
+
+
+def make_response(url, html):
+    from StringIO import StringIO
+    import httplib
+    import urllib
+
+    headers = httplib.HTTPMessage(StringIO("Content-Type: text/html; charset=utf-8\r\n\r\n"))
+    return Response(urllib.addinfourl(StringIO(html), headers, url, 200))
+
+
+def summarize_seconds(samples):
+    """Return the mean and median of a list of seconds"""
+    samples = sorted(samples)
+    return {"mean_seconds": sum(samples) / len(samples),
+            "median_seconds": samples[len(samples) // 2]}
+
+
+def bench_parse(site, repeat=1):
+    """Return the mean and median seconds to parse a page and collect its HTML errors"""
+    samples = []
+
+    for i in range(repeat):
+        for path, html in site.items():
+            response = make_response("http://origin.int" + path, html)
+            start = time.time()
+            response.get_parser_errors()
+            samples.append(time.time() - start)
+
+    return dict(summarize_seconds(samples), pages=len(samples))
+
+
+def bench_comparators(site, target_site, repeat=1):
+    """Return the mean and median seconds each comparator takes on a freshly
+    parsed pair of pages, including extracting the text it compares
+    """
+    results = {}
+
+    for comparator in get_comparators():
+        samples = []
+
+        for i in range(repeat):
+            for path in site:
+                origin = make_response("http://origin.int" + path, site[path])
+                target = make_response("http://target.int" + path, target_site[path])
+                # Parse both pages first so only the comparison is timed:
+                origin.htmltree
+                target.htmltree
+
+                start = time.time()
+                comparator.compare(origin, target)
+                samples.append(time.time() - start)
+
+        results[comparator.__class__.__name__] = summarize_seconds(samples)
+
+    return results
+
+
+def get_gated_metrics(results):
+    """Return {metric: value} for the aggregate metrics checked against a
+    baseline; per-stage percentiles are reported but too noisy to gate on
+    """
+    data = results["results"]
+    metrics = {}
+
+    if "crawl" in data:
+        metrics["crawl.pages_per_second"] = data["crawl"]["pages_per_second"]
+    # Medians, since one page hit by a GC pause or a busy machine skews a mean:
+    if "parse" in data:
+        metrics["parse.median_seconds"] = data["parse"]["median_seconds"]
+    for name, comparator in data.get("comparators", {}).items():
+        metrics["comparators.%s.median_seconds" % name] = comparator["median_seconds"]
+    if "peak_rss" in data:
+        metrics["peak_rss"] = data["peak_rss"]
+
+    return metrics
+
+
+def compare_to_baseline(results, baseline, threshold):
+    """Return a list of (metric, baseline value, new value) which got more
+    than threshold worse, and by more than the metric's NOISE_FLOORS entry.
+    Raises ValueError if the runs used different settings.
+    """
+    if results.get("settings") != baseline.get("settings"):
+        raise ValueError("Can't compare runs with different settings: %s and %s" % (
+                         json.dumps(baseline.get("settings"), sort_keys=True),
+                         json.dumps(results.get("settings"), sort_keys=True)))
+
+    new = get_gated_metrics(results)
+    old = get_gated_metrics(baseline)
+    regressions = []
+
+    for metric in sorted(set(new) & set(old)):
+        name = metric.rsplit(".", 1)[-1]
+        worse = new[metric] - old[metric]
+        if name in HIGHER_IS_BETTER:
+            worse = -worse
+        if not old[metric] or worse <= NOISE_FLOORS.get(name, 0):
+            continue
+        if worse / float(old[metric]) > threshold:
+            regressions.append((metric, old[metric], new[metric]))
+
+    return regressions
+
+
+def main():
+    usage = 'Usage: %prog [options]'
+    parser = optparse.OptionParser(usage)
+    parser.add_option("--pages", type="int", default=200,
+                      help="Number of pages in the generated site (default %default)")
+    parser.add_option("--page-size", type="int", default=20,
+                      help="Approximate size of each page in KB (default %default)")
+    parser.add_option("--fanout", type="int", default=10,
+                      help="Links on each page (default %default)")
+    parser.add_option("--error-rate", type="float", default=0.1,
+                      help="Fraction of paragraphs with broken markup, and of pages "
+                           "with a broken link (default %default)")
+    parser.add_option("--seed", type="int", default=0,
+                      help="Random seed for generating the site (default %default)")
+    parser.add_option("--concurrency", type="int", default=1,
+                      help="Walker concurrency for the crawl benchmark (default %default)")
+    parser.add_option("--repeat", type="int", default=1,
+                      help="Times to repeat the parse and comparator benchmarks (default %default)")
+    parser.add_option("-f", "--output", dest="output_file",
+                      help="Store the results as JSON in FILE (default is stdout)")
+    parser.add_option("--baseline",
+                      help="Report metrics which regressed compared to this earlier output")
+    parser.add_option("--threshold", type="float", default=0.5,
+                      help="Fractional change counted as a regression (default %default)")
+
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(format=webcompare.LOGGING_FORMAT, level=logging.ERROR)
+
+    site = make_site(options.pages, page_size=options.page_size, fanout=options.fanout,
+                     error_rate=options.error_rate, seed=options.seed)
+    target_site = mutate_site(site, seed=options.seed + 1)
+
+    origin_server = serve_site(site)
+    target_server = serve_site(target_site)
+
+    try:
+        crawl = bench_crawl("http://127.0.0.1:%d/" % origin_server.server_port,
+                            "http://127.0.0.1:%d/" % target_server.server_port,
+                            concurrency=options.concurrency)
+    finally:
+        origin_server.shutdown()
+        target_server.shutdown()
+
+    results = {"settings": dict(pages=options.pages, page_size=options.page_size,
+                                fanout=options.fanout, error_rate=options.error_rate,
+                                seed=options.seed, concurrency=options.concurrency,
+                                repeat=options.repeat),
+               "python": sys.version.split()[0],
+               "results": {"crawl": crawl,
+                           "parse": bench_parse(site, repeat=options.repeat),
+                           "comparators": bench_comparators(site, target_site,
+                                                            repeat=options.repeat),
+                           "peak_rss": get_peak_rss()}}
+
+    if options.output_file:
+        with open(options.output_file, "wb") as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=4, sort_keys=True)
+        print
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            try:
+                regressions = compare_to_baseline(results, json.load(f), options.threshold)
+            except ValueError as e:
+                print >>sys.stderr, e
+                sys.exit(2)
+
+        for metric, old, new in regressions:
+            print >>sys.stderr, "%s regressed: %s -> %s" % (metric, old, new)
+
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
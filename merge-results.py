@@ -1,8 +1,17 @@
 #!/usr/bin/env python
 # encoding: utf-8
+"""
+Combine webcompare result files without loading them into memory
+
+Inputs may be webcompare JSON documents, --jsonl or --columnar output.
+Results are read and written one at a time (except that a --columnar file is
+read whole) so memory use depends on the number of distinct URLs (16 bytes
+each for the duplicate index) rather than the size of the results.
+"""
 from __future__ import absolute_import
 
 from glob import glob
+import hashlib
 import optparse
 import os
 import sys
@@ -13,6 +22,76 @@ try:
 except ImportError:
     import json
 
+from webcompare import iter_result_dicts
+
+
+def iter_files_results(filenames):
+    """Yield the results in each of filenames, skipping (and reporting) any
+    file which can't be read. Each file is read through once before any of
+    its results are yielded so a truncated one isn't half merged.
+    """
+    for filename in filenames:
+        try:
+            with open(filename, "rb") as f:
+                for result in iter_result_dicts(f):
+                    pass
+        except (IOError, ValueError) as e:
+            print >>sys.stderr, "Unable to load %s: %s" % (filename, e)
+            continue
+
+        with open(filename, "rb") as f:
+            for result in iter_result_dicts(f):
+                yield result
+
+
+def merge_results(results, stats, seen_urls, strip_html_validation=False):
+    """Yield each result whose origin URL isn't in seen_urls, counting it in stats
+
+    seen_urls holds MD5 digests rather than the URLs themselves to keep the
+    index small. Shards of a --shard crawl never overlap but a URL may appear
+    in more than one input when merging earlier or partial runs; the first
+    result for each URL wins.
+    """
+    for result in results:
+        url = result['origin_url']
+        if isinstance(url, unicode):
+            url = url.encode("utf-8")
+        key = hashlib.md5(url).digest()
+
+        if key in seen_urls:
+            continue
+        seen_urls.add(key)
+
+        if strip_html_validation:
+            result.pop("origin_html_errors", None)
+            result.pop("target_html_errors", None)
+
+        stats[result['result_type']] = stats.get(result['result_type'], 0) + 1
+
+        yield result
+
+
+def write_json(results, stats, output_file):
+    """Write results as a webcompare JSON document, one result at a time"""
+    output_file.write('{"results": {"resultlist": [')
+
+    for i, result in enumerate(results):
+        output_file.write(",\n" if i else "\n")
+        output_file.write(json.dumps(result, sort_keys=True))
+
+    # stats is complete once results has been consumed:
+    output_file.write('\n], "stats": %s}}\n' % json.dumps(stats, sort_keys=True))
+
+
+def write_jsonl(results, stats, output_file):
+    """Write results in the same format as webcompare --jsonl"""
+    for result in results:
+        output_file.write(json.dumps(result, sort_keys=True))
+        output_file.write("\n")
+
+    output_file.write(json.dumps({"stats": stats}, sort_keys=True))
+    output_file.write("\n")
+
 
 def main():
     usage = 'Usage: %prog --output=FILE.json result1.json result1.json'
@@ -20,6 +99,9 @@ def main():
     parser.add_option("--strip-html-validation",
                       action="store_true", default=False,
                       help="Remove HTML validation messages to reduce size")
+    parser.add_option("--jsonl", action="store_true", default=False,
+                      help="Write one result per line followed by a stats line "
+                           "instead of one JSON document")
     parser.add_option("-f", "--output", dest="output_file",
                       help="Store combined results in FILE")
 
@@ -33,36 +115,18 @@ def main():
     else:
         output_file = sys.stdout
 
-    all_results = {"results": {"resultlist": [], "stats": {}}}
-
     files = []
     for arg in args:
         files.extend(glob(os.path.expanduser(arg)))
 
-    for filename in files:
-        try:
-            with open(filename, "rb") as f:
-                new_result = json.load(f)
-                if options.strip_html_validation:
-                    for res in new_result['results']['resultlist']:
-                        res.pop("origin_html_errors", None)
-                        res.pop("target_html_errors", None)
-                results = merge_results(all_results, new_result)
-        except (IOError, ValueError) as e:
-            print >>sys.stderr, "Unable to load %s: %s" % (filename, e)
+    stats = {}
+    results = merge_results(iter_files_results(files), stats, set(),
+                            strip_html_validation=options.strip_html_validation)
 
-    json.dump(all_results, output_file, indent=True)
-
-
-def merge_results(all_results, new_results):
-    resultlist = all_results['results']['resultlist']
-    resultlist.extend(new_results['results']['resultlist'])
-    
-    stats = all_results['results']['stats']
-    for k, v in new_results['results']['stats'].items():
-        stats[k] = stats.get(k, 0) + v
-            
-    return all_results
+    if options.jsonl:
+        write_jsonl(results, stats, output_file)
+    else:
+        write_json(results, stats, output_file)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,5 +1,47 @@
 import unittest
 
+from webcompare import TitleComparator
+
+
+def make_http_response(url, body, code=200, content_type="text/html; charset=utf-8"):
+    """Return a urllib2.urlopen()-style response without touching the network"""
+    from StringIO import StringIO
+    import httplib
+    import urllib
+    headers = httplib.HTTPMessage(StringIO("Content-Type: %s\r\n\r\n" % content_type))
+    return urllib.addinfourl(StringIO(body), headers, url, code)
+
+
+def make_site_walker(pages, **kwargs):
+    """Return a Walker which serves origin and target pages from a dict of path: html"""
+    from webcompare import Walker, Response
+
+    class SiteWalker(Walker):
+        def _fetch_url(self, url):
+            path = url.split(".int", 1)[1] or "/"
+            return Response(make_http_response(url, pages.get(path, ""),
+                                               code=200 if path in pages else 404))
+
+    return SiteWalker("http://origin.int", "http://target.int", **kwargs)
+
+
+SITE_PAGES = {
+    "/": '<html><head><title>Home</title></head><body><a href="/a">a</a><a href="/b">b</a></body></html>',
+    "/a": '<html><head><title>A</title></head><body><a href="/c">c</a><a href="/">home</a></body></html>',
+    "/b": '<html><head><title>B</title></head><body><a href="/c">c</a><a href="/missing">x</a></body></html>',
+    "/c": '<html><head><title>C</title></head><body><p>See <a href="http://elsewhere.int/">away</a></p></body></html>',
+}
+
+
+class CountingComparator(TitleComparator):
+    """TitleComparator which counts its comparisons in calls"""
+    calls = 0
+
+    def compare(self, origin_response, target_response):
+        CountingComparator.calls += 1
+        return TitleComparator.compare(self, origin_response, target_response)
+
+
 class TestWebCompare(unittest.TestCase):
 
     def setUp(self):
@@ -92,6 +134,41 @@ class TestComparator(unittest.TestCase):
         self.assertEquals(self.comparator.fuzziness("foo", "Foo"), 100)
         self.assertEquals(self.comparator.fuzziness("foo", "fool"), 85)
 
+    def test_similarity_engines(self):
+        from webcompare import Comparator
+        for name in ("sequence", "jaccard", "minhash"):
+            comparator = Comparator(similarity=name)
+            self.assertEquals(comparator.fuzziness("Foo bar  baz", "foo bar baz"), 100)
+            self.assertTrue(comparator.fuzziness("foo bar baz", "qux quux corge") < 20)
+            self.assertEquals(comparator.fuzziness("foo", ""), 0)
+        self.assertEquals(Comparator(similarity="jaccard").fuzziness("a b c", "a b d"), 50)
+        self.assertRaises(ValueError, Comparator, similarity="telepathy")
+
+    def test_minhash_similarity(self):
+        from webcompare import SIMILARITY_ENGINES
+        minhash_similarity = SIMILARITY_ENGINES["minhash"]
+        jaccard_similarity = SIMILARITY_ENGINES["jaccard"]
+        words = ["word%d" % i for i in range(2000)]
+        origin = " ".join(words)
+        target = " ".join(words[:1500] + ["changed%d" % i for i in range(500)])
+        self.assertTrue(abs(minhash_similarity(origin, target) - 1497 / 2503.0) < 0.15)
+        self.assertEquals(jaccard_similarity(origin, " ".join(reversed(words))), 1.0)
+        self.assertTrue(minhash_similarity(origin, " ".join(reversed(words))) < 0.1)
+
+    def test_interesting_threshold(self):
+        from webcompare import Comparator
+        exact = Comparator()
+        tiered = Comparator(interesting_threshold=40)
+        # The length bound rules this out without running the matcher:
+        self.assertEquals(tiered.fuzziness("foo", "foo" * 10), 18)
+        # quick_ratio says these share at most the space:
+        self.assertEquals(tiered.fuzziness("aaaa bbbb", "cccc dddd"), 11)
+        # ... but an anagram looks perfect to the bounds so gets the exact ratio:
+        self.assertEquals(tiered.fuzziness("abcdefgh", "hgfedcba"), 12)
+        self.assertEquals(exact.fuzziness("abcdefgh", "hgfedcba"), 12)
+        self.assertEquals(tiered.fuzziness("foo", "fool"), exact.fuzziness("foo", "fool"))
+        self.assertEquals(tiered.fuzziness("Foo", "foo"), 100)
+
     def test_unfraction(self):
         self.assertEquals(self.comparator.unfraction(1.0), 100)
         self.assertEquals(self.comparator.unfraction(1), 100)
@@ -134,6 +211,43 @@ class TestResult(unittest.TestCase):
         self.assertEquals(r.origin_html_errors, ["bad"])
         self.assertEquals(r.target_html_errors, ["ugly"])
 
+    def test_compact(self):
+        from webcompare import HTML_ERROR_MESSAGES
+        errors = [u"Error at line 3 col 7: Unexpected end tag (p). Ignored.",
+                  u"Error at line 9 col 1: Unexpected end tag (p). Ignored."]
+        r = self.GoodResult("http://origin.int/a", 200, origin_html_errors=errors,
+                            target_html_errors=[], target_url="http://target.int/a",
+                            url_prefixes=("http://origin.int", "http://target.int"))
+        self.assertFalse(hasattr(r, "__dict__"))
+        self.assertEquals(r.origin_html_errors, errors)
+        self.assertEquals(r.target_html_errors, [])
+        self.assertEquals(r.count_html_errors(), (2, 0))
+        # Both errors share one message:
+        self.assertEquals(r._origin_html_errors[2], r._origin_html_errors[5])
+        self.assertEquals(HTML_ERROR_MESSAGES[r._origin_html_errors[2]],
+                          u"Unexpected end tag (p). Ignored.")
+        self.assertEquals(r._target_url, None)
+        self.assertEquals(r.target_url, "http://target.int/a")
+        r.target_url = "http://elsewhere.int/a"
+        self.assertEquals(r.target_url, "http://elsewhere.int/a")
+
+    def test_to_dict(self):
+        from webcompare import result_from_dict
+        r = self.BadTargetResult("http://origin.int/a", 200, origin_html_errors=["bad"],
+                                 target_url="http://target.int/b", target_code=404,
+                                 origin_time=0.123456, timings={"origin_ttfb": 0.0123456},
+                                 url_prefixes=("http://origin.int", "http://target.int"))
+        data = r.to_dict()
+        self.assertEquals(data["result_type"], "BadTargetResult")
+        self.assertEquals(data["target_url"], "http://target.int/b")
+        self.assertEquals(data["origin_html_errors"], ["bad"])
+        self.assertEquals(data["origin_time"], 0.123)
+        self.assertEquals(data["timings"], {"origin_ttfb": 0.012})
+        # None fields are left out:
+        self.assertFalse("target_html_errors" in data)
+        self.assertFalse("origin_hash" in data)
+        self.assertEquals(result_from_dict(data).to_dict(), data)
+
 
     def test___init__comparisons(self):
         r = self.Result("originurl", 666, target_url="targeturl", target_code=777, comparisons={'fee': 42, 'fi':666, 'foo':0xDeadBeef})
@@ -189,6 +303,1308 @@ class TestResponse(unittest.TestCase):
         self.assertNotEqual(r.htmltree, None)
 
 
+class TestWalkAndCompare(unittest.TestCase):
+    def walk(self, **kwargs):
+        from webcompare import TitleComparator
+        walker = make_site_walker(SITE_PAGES, **kwargs)
+        walker.add_comparator(TitleComparator())
+        walker.walk_and_compare()
+        return walker
+
+    def test_sequential(self):
+        walker = self.walk()
+        self.assertEquals([r.origin_url for r in walker.results],
+                          ["http://origin.int", "http://origin.int/a", "http://origin.int/b",
+                           "http://origin.int/c", "http://origin.int/", "http://origin.int/missing"])
+        self.assertEquals(walker.results[-1].result_type, "BadOriginResult")
+        self.assertEquals(walker.results[1].comparisons, {"TitleComparator": 100})
+
+    def summarize(self, walker):
+        return [(r.result_type, r.origin_url, r.target_code, r.comparisons)
+                for r in walker.results]
+
+    def test_concurrent_matches_sequential(self):
+        sequential = self.walk()
+        concurrent = self.walk(concurrency=4)
+        self.assertEquals(self.summarize(concurrent), self.summarize(sequential))
+
+
+    def test_comparison_processes(self):
+        from webcompare import BodyComparator, ContentComparator, LengthComparator
+        comparators = [BodyComparator(), ContentComparator(), LengthComparator()]
+        sequential = make_site_walker(SITE_PAGES)
+        parallel = make_site_walker(SITE_PAGES, concurrency=2)
+        parallel.comparison_processes = 2
+        for walker in (sequential, parallel):
+            for comparator in comparators:
+                walker.add_comparator(comparator)
+            walker.walk_and_compare()
+        self.assertEquals(self.summarize(parallel), self.summarize(sequential))
+        self.assertEquals(len(parallel.results[0].comparisons), 3)
+
+    def test_comparison_processes_forked_first(self):
+        import threading
+        import webcompare
+        create_pool = webcompare.multiprocessing.Pool
+        threads_at_fork = []
+
+        def Pool(processes):
+            threads_at_fork.append(threading.active_count())
+            return create_pool(processes)
+
+        webcompare.multiprocessing.Pool = Pool
+        self.addCleanup(setattr, webcompare.multiprocessing, "Pool", create_pool)
+
+        walker = make_site_walker(SITE_PAGES, concurrency=4)
+        walker.comparison_processes = 1
+        threads_before = threading.active_count()
+        walker.walk_and_compare()
+        # None of the worker pool's threads existed when the processes forked:
+        self.assertEquals(threads_at_fork, [threads_before])
+
+    def test_bloom_filter_frontier(self):
+        from webcompare import BloomFilter
+        sequential = self.walk()
+        bloom = self.walk(origin_urls_seen=BloomFilter(1000))
+        self.assertEquals(self.summarize(bloom), self.summarize(sequential))
+        self.assertEquals(bloom.origin_urls_visited, 6)
+
+    def test_result_stream(self):
+        from StringIO import StringIO
+        import json
+        stream = StringIO()
+        walker = make_site_walker(SITE_PAGES)
+        walker.result_stream = stream
+        walker.walk_and_compare()
+        self.assertEquals(walker.results, [])
+        lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEquals(len(lines), 7)
+        self.assertEquals(lines[0]["origin_url"], "http://origin.int")
+        self.assertEquals(sorted(lines[-1]["stats"].pop("timings")),
+                          sorted(walker.get_timing_stats()))
+        self.assertEquals(lines[-1], {"stats": {"GoodResult": 5, "BadOriginResult": 1}})
+        self.assertEquals(walker.stats, {"GoodResult": 5, "BadOriginResult": 1})
+
+    def test_columnar_results(self):
+        from StringIO import StringIO
+        import json
+        from webcompare import unpack_html_errors
+        walker = self.walk()
+        errors_file = StringIO()
+        data = walker.columnar_results(html_errors_file=errors_file)
+
+        self.assertEquals(data["count"], 6)
+        self.assertTrue("TitleComparator" in data["stats"].pop("timings"))
+        self.assertEquals(data["stats"], {"GoodResult": 5, "BadOriginResult": 1})
+        self.assertEquals(data["comparators"], ["TitleComparator"])
+        columns = data["columns"]
+        self.assertEquals(columns["origin_url"], [r.origin_url for r in walker.results])
+        self.assertEquals([data["result_types"][i] for i in columns["result_type"]],
+                          [r.result_type for r in walker.results])
+        self.assertEquals(columns["target_url"][1], None)
+        self.assertEquals(columns["TitleComparator"][1], 100)
+
+        offsets = data["html_errors_offsets"]
+        self.assertEquals(len(offsets), 7)
+        for i, r in enumerate(walker.results):
+            chunk = errors_file.getvalue()[offsets[i]:offsets[i + 1]]
+            if r.origin_html_errors or r.target_html_errors:
+                messages = data["html_error_messages"]
+                errors = json.loads(chunk)
+                self.assertEquals(unpack_html_errors(errors["origin"], messages),
+                                  r.origin_html_errors or [])
+                self.assertEquals(unpack_html_errors(errors["target"], messages),
+                                  r.target_html_errors or [])
+            else:
+                self.assertEquals(chunk, "")
+        self.assertTrue(errors_file.getvalue())
+
+    def test_columnar_target_urls(self):
+        from webcompare import BadOriginResult, BadTargetResult, Walker, iter_columnar_result_dicts
+        walker = Walker("http://origin.int", "http://target.int")
+        walker.results = [
+            # A connection failure has no target_code:
+            BadTargetResult("http://origin.int/a", 200, target_url="http://target.int/a"),
+            BadTargetResult("http://origin.int/b", 200, target_url="http://elsewhere.int/b",
+                            target_code=0),
+            BadOriginResult("http://origin.int/c", 404),
+        ]
+        data = walker.columnar_results()
+        self.assertEquals(data["columns"]["target_url"], [None, "http://elsewhere.int/b", ""])
+        self.assertEquals([r["target_url"] for r in iter_columnar_result_dicts(data)],
+                          ["http://target.int/a", "http://elsewhere.int/b", None])
+
+    def test_resume_from_checkpoint(self):
+        import os
+        import tempfile
+        from webcompare import Checkpoint
+
+        fd, filename = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        self.addCleanup(os.remove, filename)
+
+        walker = make_site_walker(SITE_PAGES)
+        walker.checkpoint = Checkpoint(filename, interval=1)
+        fetch_url = walker._fetch_url
+
+        def crash_on_b(url):
+            if url.endswith("/b"):
+                raise KeyboardInterrupt
+            return fetch_url(url)
+
+        walker._fetch_url = crash_on_b
+        self.assertRaises(KeyboardInterrupt, walker.walk_and_compare)
+        walker.checkpoint.close()
+
+        resumed = make_site_walker(SITE_PAGES)
+        resumed.checkpoint = Checkpoint(filename, resume=True)
+        fetched = []
+        fetch_url = resumed._fetch_url
+
+        def record_fetch(url):
+            fetched.append(url)
+            return fetch_url(url)
+
+        resumed._fetch_url = record_fetch
+        resumed.walk_and_compare()
+        resumed.checkpoint.close()
+
+        self.assertFalse("http://origin.int/a" in fetched)
+        self.assertEquals(fetched[0], "http://origin.int/b")
+        uninterrupted = make_site_walker(SITE_PAGES)
+        uninterrupted.walk_and_compare()
+        self.assertEquals(self.summarize(resumed), self.summarize(uninterrupted))
+        self.assertEquals(resumed.stats, {"GoodResult": 5, "BadOriginResult": 1})
+
+    def test_previous_results(self):
+        from StringIO import StringIO
+
+        unhashed = make_site_walker(SITE_PAGES)
+        unhashed.add_comparator(CountingComparator())
+        unhashed.walk_and_compare()
+        self.assertTrue(all(r.origin_hash is None for r in unhashed.results))
+
+        CountingComparator.calls = 0
+        first = make_site_walker(SITE_PAGES)
+        first.add_comparator(CountingComparator())
+        first.record_hashes = True
+        first.walk_and_compare()
+        self.assertEquals(CountingComparator.calls, 5)
+
+        streamed = make_site_walker(SITE_PAGES)
+        streamed.add_comparator(CountingComparator())
+        streamed.record_hashes = True
+        streamed.result_stream = StringIO()
+        streamed.walk_and_compare()
+
+        for output in (StringIO(first.json_results()), streamed.result_stream):
+            output.seek(0)
+
+            CountingComparator.calls = 0
+            second = make_site_walker(SITE_PAGES)
+            second.add_comparator(CountingComparator())
+            second.load_previous_results(output)
+            second.walk_and_compare()
+            self.assertEquals(CountingComparator.calls, 0)
+            self.assertEquals(self.summarize(second), self.summarize(first))
+
+        changed = dict(SITE_PAGES)
+        changed["/c"] = changed["/c"].replace("<title>C</title>", "<title>Changed</title>")
+        CountingComparator.calls = 0
+        third = make_site_walker(changed)
+        third.add_comparator(CountingComparator())
+        output.seek(0)
+        third.load_previous_results(output)
+        third.walk_and_compare()
+        self.assertEquals(CountingComparator.calls, 1)
+
+    def test_previous_results_settings(self):
+        from StringIO import StringIO
+        from webcompare import NoiseFilter
+
+        def walk(pages, previous=None, noise=None, **settings):
+            CountingComparator.calls = 0
+            walker = make_site_walker(pages)
+            walker.add_comparator(CountingComparator(**settings))
+            walker.record_hashes = True
+            if noise is not None:
+                walker.origin_noise = NoiseFilter(noise)
+                walker.target_noise = NoiseFilter(noise)
+            if previous is not None:
+                walker.load_previous_results(StringIO(previous.json_results()))
+            walker.walk_and_compare()
+            return walker
+
+        first = walk(SITE_PAGES)
+        walk(SITE_PAGES, first, similarity="jaccard")
+        self.assertEquals(CountingComparator.calls, 5)
+        walk(SITE_PAGES, first, interesting_threshold=50)
+        self.assertEquals(CountingComparator.calls, 5)
+
+        # Only what's left once the noise is removed is hashed:
+        denoised = walk(SITE_PAGES, first, noise=["//p"])
+        self.assertEquals(CountingComparator.calls, 5)
+        changed = dict(SITE_PAGES)
+        changed["/c"] = changed["/c"].replace("See", "Look")
+        walk(changed, denoised, noise=["//p"])
+        self.assertEquals(CountingComparator.calls, 0)
+        walk(changed, first)
+        self.assertEquals(CountingComparator.calls, 1)
+
+    def test_shards(self):
+        import shutil
+        import tempfile
+        import threading
+        import time
+        from webcompare import ShardSpool
+
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir)
+
+        shards = []
+        for index in range(3):
+            walker = make_site_walker(SITE_PAGES)
+            walker.shard_poll_interval = 0.05
+            shards.append(walker)
+
+        threads = [threading.Thread(target=walker.walk_and_compare) for walker in shards]
+        # Shards which finish their own URLs early wait for the one that
+        # hasn't even started yet, however long it takes
+        for index in range(2):
+            shards[index].shard_spool = ShardSpool(spool_dir, index, 3)
+            threads[index].start()
+        time.sleep(0.5)
+        self.assertTrue(all(thread.is_alive() for thread in threads[:2]))
+
+        shards[2].shard_spool = ShardSpool(spool_dir, 2, 3)
+        threads[2].start()
+        for thread in threads:
+            thread.join()
+
+        urls = [r.origin_url for walker in shards for r in walker.results]
+        self.assertEquals(sorted(urls), sorted(r.origin_url for r in self.walk().results))
+        for walker in shards:
+            self.assertTrue(all(walker.shard_spool.owns(r.origin_url) for r in walker.results))
+            walker.shard_spool.close()
+
+    def test_shard_spool_finished(self):
+        import itertools
+        import shutil
+        import tempfile
+        from webcompare import ShardSpool
+
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir)
+        first, second = ShardSpool(spool_dir, 0, 2), ShardSpool(spool_dir, 1, 2)
+        self.addCleanup(first.close)
+        self.addCleanup(second.close)
+
+        first.set_state("idle")
+        self.assertFalse(first.is_finished())
+        second.set_state("idle")
+        self.assertTrue(first.is_finished())
+
+        url = next(u"http://origin.int/%d" % i for i in itertools.count()
+                   if second.owns(u"http://origin.int/%d" % i))
+        first.send(url)
+        self.assertFalse(first.is_finished())
+        self.assertEquals(second.receive(), [url])
+        self.assertFalse(first.is_finished())
+        second.set_state("idle")
+        self.assertTrue(second.is_finished())
+
+    def test_shard_spool_leftovers(self):
+        import shutil
+        import tempfile
+        from webcompare import ShardSpool
+
+        def make_spool_dir():
+            spool_dir = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, spool_dir)
+            return spool_dir
+
+        # Our own state file can only be from an earlier crawl:
+        spool_dir = make_spool_dir()
+        ShardSpool(spool_dir, 0, 2).close()
+        self.assertRaises(ValueError, ShardSpool, spool_dir, 0, 2)
+
+        # ... as can another shard being done before we've started:
+        spool_dir = make_spool_dir()
+        second = ShardSpool(spool_dir, 1, 2)
+        second.set_state("done")
+        second.close()
+        self.assertRaises(ValueError, ShardSpool, spool_dir, 0, 2)
+        ShardSpool(spool_dir, 0, 2, resume=True).close()
+
+    def test_merge_shard_results(self):
+        import imp
+        import json
+        import os
+        from itertools import chain
+        from StringIO import StringIO
+        from webcompare import JSON_DOCUMENT_RE, ResultListReader, TitleComparator, iter_result_dicts
+        merge_results = imp.load_source("merge_results",
+                                        os.path.join(os.path.dirname(__file__), "merge-results.py"))
+
+        first = json.loads(self.walk().json_results())
+
+        walker = make_site_walker(SITE_PAGES)
+        walker.add_comparator(TitleComparator())
+        walker.result_stream = second = StringIO()
+        walker.walk_and_compare()
+        second.seek(0)
+
+        def read_all(f):
+            # A tiny chunk size makes results span several reads:
+            if JSON_DOCUMENT_RE.match(f.getvalue()):
+                return ResultListReader(f, chunk_size=7)
+            return iter_result_dicts(f)
+
+        stats = {}
+        output = StringIO()
+        results = chain(read_all(StringIO(json.dumps(first, indent=4))), read_all(second))
+        merge_results.write_json(merge_results.merge_results(results, stats, set()), stats, output)
+
+        # Percentiles can't be combined so merging drops them:
+        del first["results"]["stats"]["timings"]
+        self.assertEquals(json.loads(output.getvalue()), first)
+
+    def test_merge_skips_truncated_files(self):
+        import imp
+        import os
+        import shutil
+        import sys
+        import tempfile
+        from StringIO import StringIO
+        merge_results = imp.load_source("merge_results",
+                                        os.path.join(os.path.dirname(__file__), "merge-results.py"))
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        whole = os.path.join(directory, "whole.json")
+        truncated = os.path.join(directory, "truncated.json")
+        json_results = self.walk().json_results()
+        with open(whole, "wb") as f:
+            f.write(json_results)
+        with open(truncated, "wb") as f:
+            f.write(json_results[:len(json_results) // 2])
+
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            results = list(merge_results.iter_files_results([truncated, whole]))
+            errors = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+
+        self.assertEquals(len(results), 6)
+        self.assertTrue(errors.startswith("Unable to load %s" % truncated))
+
+    def test_timings(self):
+        walker = self.walk()
+        result = walker.results[1]
+        self.assertEquals(sorted(result.timings),
+                          ["TitleComparator", "origin_download", "origin_parse",
+                           "target_download", "target_parse"])
+        self.assertEquals(walker.results[-1].timings.keys(), ["origin_download"])
+
+        stats = walker.get_timing_stats()
+        self.assertEquals(stats["TitleComparator"]["count"], 5)
+        self.assertEquals(stats["origin_fetch"]["count"], 5)
+        for summary in stats.values():
+            self.assertTrue(summary["p50"] <= summary["p95"] <= summary["p99"] <= summary["max"])
+
+    def test_no_validation(self):
+        from webcompare import LengthComparator
+        walker = make_site_walker(SITE_PAGES)
+        walker.validate_html = False
+        walker.add_comparator(LengthComparator())
+        walker.walk_and_compare()
+        self.assertEquals(len(walker.results), 6)
+        self.assertEquals(walker.results[0].origin_html_errors, None)
+        self.assertEquals(walker.results[0].target_html_errors, None)
+        self.assertEquals(walker.results[0].comparisons, {"LengthComparator": 100})
+        # Nothing needed the target's tree so it was never parsed:
+        self.assertFalse("target_parse" in walker.results[0].timings)
+
+    def test_max_connections_per_host(self):
+        walker = make_site_walker(SITE_PAGES, concurrency=4)
+        walker.max_connections_per_host = 2
+        self.assertTrue(walker._get_host_semaphore("http://origin.int/a")
+                        is walker._get_host_semaphore("http://origin.int/b"))
+        self.assertFalse(walker._get_host_semaphore("http://origin.int/a")
+                         is walker._get_host_semaphore("http://target.int/a"))
+
+
+class LocalServerTestCase(unittest.TestCase):
+    """Runs an HTTP/1.1 server on localhost which answers with handle_request"""
+    def setUp(self):
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        from SocketServer import ThreadingMixIn
+        import threading
+
+        class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        test = self
+        connections = self.connections = []
+        self.requests = []
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                connections.append(self.client_address)
+
+            def do_GET(self):
+                test.requests.append((self.path, self.headers))
+                test.handle_request(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base_url = "http://127.0.0.1:%d" % self.server.server_port
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle_request(self, handler, headers=()):
+        body = "<html><body>%s</body></html>" % handler.path
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/html")
+        handler.send_header("Content-Length", str(len(body)))
+        for header in headers:
+            handler.send_header(*header)
+        handler.end_headers()
+        handler.wfile.write(body)
+
+
+class TestGevent(LocalServerTestCase):
+    def test_max_connections_per_host(self):
+        import json
+        import os
+        import shutil
+        import subprocess
+        import sys
+        import tempfile
+        import threading
+        import time
+        try:
+            import gevent
+        except ImportError:
+            raise unittest.SkipTest("gevent isn't installed")
+
+        lock = threading.Lock()
+        active = {}
+        most_active = {}
+
+        def handle_request(handler):
+            host = handler.headers["Host"]
+            with lock:
+                active[host] = active.get(host, 0) + 1
+                most_active[host] = max(most_active.get(host, 0), active[host])
+            time.sleep(0.05)
+            with lock:
+                active[host] -= 1
+
+            links = "".join('<a href="/page%d">%d</a>' % (i, i) for i in range(20))
+            body = "<html><head><title>%s</title></head><body>%s</body></html>" % (
+                handler.path, links if handler.path == "/" else "")
+            handler.send_response(200)
+            handler.send_header("Content-Type", "text/html")
+            handler.send_header("Content-Length", str(len(body)))
+            handler.end_headers()
+            handler.wfile.write(body)
+        self.handle_request = handle_request
+
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        output = os.path.join(output_dir, "webcompare.json")
+        # The origin and target are the same server under two host names:
+        target_url = "http://localhost:%d" % self.server.server_port
+        subprocess.check_call([sys.executable,
+                               os.path.join(os.path.dirname(os.path.abspath(__file__)), "webcompare.py"),
+                               "--gevent", "--concurrency=8", "--max-connections-per-host=2",
+                               "-f", output, self.base_url, target_url])
+
+        with open(output) as f:
+            results = json.load(f)["results"]["resultlist"]
+        self.assertEquals(len(results), 21)
+        self.assertEquals(sorted(most_active), sorted([self.base_url[len("http://"):],
+                                                       target_url[len("http://"):]]))
+        # The greenlets really did run at once, but never more than 2 per host:
+        self.assertEquals(max(most_active.values()), 2)
+
+
+class TestKeepAlive(LocalServerTestCase):
+    def test_connection_reused(self):
+        from webcompare import Walker
+        walker = Walker(self.base_url, self.base_url)
+        for path in ("/a", "/b", "/c"):
+            response = walker._fetch_url(self.base_url + path)
+            self.assertEquals(response.code, 200)
+            self.assertTrue(path in response.content)
+        walker.connection_pool.close()
+        self.assertEquals(len(self.connections), 1)
+
+    def test_timings(self):
+        from webcompare import Walker
+        walker = Walker(self.base_url, self.base_url)
+        first = walker._fetch_url(self.base_url + "/a")
+        second = walker._fetch_url(self.base_url + "/b")
+        walker.connection_pool.close()
+        self.assertEquals(sorted(first.timings), ["connect", "dns", "download", "ttfb"])
+        # The second request reused the connection:
+        self.assertEquals(sorted(second.timings), ["download", "ttfb"])
+
+    def test_abandoned_body(self):
+        from webcompare import Walker
+        def handle_request(handler):
+            body = "x" * 300000
+            handler.send_response(200)
+            handler.send_header("Content-Type", "text/html")
+            handler.send_header("Content-Length", str(len(body)))
+            handler.end_headers()
+            handler.wfile.write(body)
+
+        self.handle_request = handle_request
+        walker = Walker(self.base_url, self.base_url)
+        walker.max_body_size = 100000
+        self.assertTrue(walker._fetch_url(self.base_url + "/a").truncated)
+        # The rest of the body was still on the wire so that connection was closed:
+        walker.max_body_size = None
+        self.assertFalse(walker._fetch_url(self.base_url + "/b").truncated)
+        walker.connection_pool.close()
+        self.assertEquals(len(self.connections), 2)
+
+    def test_idle_timeout(self):
+        from webcompare import Walker
+        walker = Walker(self.base_url, self.base_url)
+        walker.connection_pool.idle_timeout = 0
+        walker._fetch_url(self.base_url + "/a")
+        walker._fetch_url(self.base_url + "/b")
+        walker.connection_pool.close()
+        self.assertEquals(len(self.connections), 2)
+
+
+class TestResponseCache(LocalServerTestCase):
+    def setUp(self):
+        import os
+        import tempfile
+        from webcompare import ResponseCache, Walker
+
+        LocalServerTestCase.setUp(self)
+
+        fd, filename = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        self.addCleanup(os.remove, filename)
+
+        self.walker = Walker(self.base_url, "http://target.int")
+        self.walker.response_cache = ResponseCache(filename)
+        self.addCleanup(self.walker.response_cache.close)
+
+    def handle_request(self, handler):
+        if handler.headers.get("If-None-Match") == '"v1"':
+            handler.send_response(304)
+            handler.send_header("Content-Length", "0")
+            handler.end_headers()
+        else:
+            LocalServerTestCase.handle_request(self, handler, headers=[("ETag", '"v1"')])
+
+    def test_revalidation(self):
+        first = self.walker._fetch_url(self.base_url + "/a")
+        second = self.walker._fetch_url(self.base_url + "/a")
+        self.assertEquals(second.code, 200)
+        self.assertEquals(second.content, first.content)
+        self.assertEquals(second.content_type, "text/html")
+        self.assertEquals(len(self.requests), 2)
+        self.assertEquals(self.requests[1][1].get("If-None-Match"), '"v1"')
+
+    def test_revalidation_keeps_connection(self):
+        for i in range(4):
+            self.assertTrue("/a" in self.walker._fetch_url(self.base_url + "/a").content)
+        self.walker.connection_pool.close()
+        self.assertEquals(len(self.requests), 4)
+        self.assertEquals(len(self.connections), 1)
+
+    def test_origin_frozen(self):
+        import urllib2
+        self.walker._fetch_url(self.base_url + "/a")
+        self.walker.origin_frozen = True
+        self.assertTrue("/a" in self.walker._fetch_url(self.base_url + "/a").content)
+        self.assertRaises(urllib2.URLError, self.walker._fetch_url, self.base_url + "/b")
+        self.assertEquals(len(self.requests), 1)
+
+    def test_eviction(self):
+        cache = self.walker.response_cache
+        cache.max_size = 70
+        self.walker._fetch_url(self.base_url + "/a")
+        self.walker._fetch_url(self.base_url + "/b")
+        self.walker._fetch_url(self.base_url + "/a")
+        self.walker._fetch_url(self.base_url + "/c")
+        self.assertNotEqual(cache.get(self.base_url + "/a"), None)
+        self.assertEquals(cache.get(self.base_url + "/b"), None)
+        self.assertNotEqual(cache.get(self.base_url + "/c"), None)
+
+
+class TestRetries(LocalServerTestCase):
+    def setUp(self):
+        from webcompare import Walker
+        LocalServerTestCase.setUp(self)
+        self.failures = []
+        self.walker = Walker(self.base_url, "http://target.int")
+        self.walker.retry_backoff = 0
+        self.addCleanup(self.walker.connection_pool.close)
+
+    def handle_request(self, handler):
+        if self.failures:
+            code, headers = self.failures.pop(0)
+            handler.send_response(code)
+            for header in headers:
+                handler.send_header(*header)
+            handler.send_header("Content-Length", "0")
+            handler.end_headers()
+        else:
+            LocalServerTestCase.handle_request(self, handler)
+
+    def test_retry_after(self):
+        self.failures = [(503, [("Retry-After", "0")]), (502, [])]
+        response = self.walker._fetch_url(self.base_url + "/a")
+        self.assertEquals(response.code, 200)
+        self.assertEquals(len(self.requests), 3)
+        stats = self.walker.get_summary_stats()["throttles"]
+        self.assertEquals(stats["origin"]["failures"], 2)
+
+    def test_retries_exhausted(self):
+        import urllib2
+        self.walker.max_retries = 1
+        self.failures = [(503, [])] * 3
+        try:
+            self.walker._fetch_url(self.base_url + "/a")
+            self.fail("Expected an HTTPError")
+        except urllib2.HTTPError as e:
+            self.assertEquals(e.code, 503)
+        self.assertEquals(len(self.requests), 2)
+
+    def test_not_retried(self):
+        import urllib2
+        self.failures = [(404, [])]
+        self.assertRaises(urllib2.HTTPError, self.walker._fetch_url, self.base_url + "/a")
+        self.assertEquals(len(self.requests), 1)
+        self.assertEquals(self.walker.get_summary_stats()["throttles"]["origin"]["failures"], 0)
+
+    def test_timeout_recorded(self):
+        import socket
+        from webcompare import BadTargetResult, ErrorResult
+        walker = make_site_walker(SITE_PAGES)
+        fetch_url = walker._fetch_url
+
+        def fetch(url):
+            if url == "http://target.int/a":
+                raise socket.timeout("timed out")
+            if url == "http://origin.int/b":
+                raise socket.error(104, "Connection reset by peer")
+            return fetch_url(url)
+
+        walker._fetch_url = fetch
+        walker.walk_and_compare()
+        results = dict((r.origin_url, r) for r in walker.results)
+        self.assertTrue(isinstance(results["http://origin.int/a"], BadTargetResult))
+        self.assertEquals(results["http://origin.int/a"].target_code, 0)
+        self.assertTrue(isinstance(results["http://origin.int/b"], ErrorResult))
+
+    def test_release_on_error(self):
+        self.walker.max_retries = 0
+        self.failures = [(503, [])]
+        self.assertRaises(Exception, self.walker._fetch_url, self.base_url + "/a")
+        self.assertEquals(self.walker._get_throttle(self.base_url + "/a").active, 0)
+
+    def test_is_transient_error(self):
+        import httplib
+        import socket
+        import urllib2
+        from webcompare import is_transient_error
+        self.assertTrue(is_transient_error(urllib2.HTTPError("/", 503, "", {}, None)))
+        self.assertFalse(is_transient_error(urllib2.HTTPError("/", 500, "", {}, None)))
+        self.assertTrue(is_transient_error(httplib.BadStatusLine("")))
+        self.assertTrue(is_transient_error(urllib2.URLError(socket.timeout())))
+        self.assertFalse(is_transient_error(urllib2.URLError(socket.gaierror())))
+        self.assertFalse(is_transient_error(urllib2.URLError("not in the response cache")))
+
+    def test_get_retry_after(self):
+        import email.utils
+        import time
+        import urllib2
+        from webcompare import get_retry_after
+
+        def error(headers):
+            return urllib2.HTTPError("/", 503, "", headers, None)
+
+        self.assertEquals(get_retry_after(error({"retry-after": "120"})), 120)
+        self.assertEquals(get_retry_after(error({})), None)
+        self.assertEquals(get_retry_after(error({"retry-after": "soon"})), None)
+        later = email.utils.formatdate(time.time() + 60)
+        self.assertTrue(55 < get_retry_after(error({"retry-after": later})) <= 60)
+
+
+class TestHostThrottle(unittest.TestCase):
+    def test_backoff(self):
+        from webcompare import HostThrottle
+        throttle = HostThrottle(max_concurrency=8)
+        throttle.acquire()
+        throttle.release(0.01, failed=True)
+        self.assertEquals(throttle.limit, 4)
+        # Only once per round trip:
+        throttle.acquire()
+        throttle.release(0.01, failed=True)
+        self.assertEquals(throttle.limit, 4)
+        throttle.backed_off_at = 0
+        throttle.release(0.01, failed=True)
+        self.assertEquals(throttle.limit, 2)
+        for i in range(4):
+            throttle.acquire()
+            throttle.release(0.01)
+        self.assertTrue(2 < throttle.limit <= 4)
+
+    def test_slow(self):
+        from webcompare import HostThrottle
+        throttle = HostThrottle(max_concurrency=2, latency_factor=3)
+        throttle.acquire()
+        throttle.release(0.1)
+        throttle.acquire()
+        throttle.release(1)
+        self.assertEquals(throttle.limit, 1)
+        self.assertEquals(throttle.backoffs, 1)
+        throttle.backed_off_at = 0
+        throttle.acquire()
+        throttle.release(5)
+        self.assertEquals(throttle.delay, throttle.MIN_DELAY)
+        for i in range(3):
+            throttle.acquire()
+            throttle.release(1)
+        self.assertEquals(throttle.delay, 0)
+
+    def test_mixed_latency(self):
+        from webcompare import HostThrottle
+        # Without latency_factor, only errors make the throttle back off:
+        throttle = HostThrottle(max_concurrency=4)
+        for latency in (0.01, 0.2, 0.01, 0.5, 0.02, 0.2) * 3:
+            throttle.acquire()
+            throttle.release(latency)
+        self.assertEquals(throttle.limit, 4)
+        self.assertEquals(throttle.backoffs, 0)
+        self.assertEquals(throttle.delay, 0)
+
+    def test_rate(self):
+        import time
+        from webcompare import HostThrottle
+        throttle = HostThrottle(rate=50, max_concurrency=4)
+        start = time.time()
+        for i in range(6):
+            throttle.acquire()
+            throttle.release()
+        self.assertTrue(time.time() - start >= 0.09)
+
+    def test_pause(self):
+        import time
+        from webcompare import HostThrottle
+        throttle = HostThrottle()
+        throttle.pause(0.1)
+        start = time.time()
+        throttle.acquire()
+        self.assertTrue(time.time() - start >= 0.09)
+        throttle.release()
+
+
+class TestResponseCacheSize(unittest.TestCase):
+    def test_total_size(self):
+        import os
+        import tempfile
+        from webcompare import ResponseCache
+
+        fd, filename = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        self.addCleanup(os.remove, filename)
+
+        cache = ResponseCache(filename)
+        cache.put("http://origin.int/a", make_http_response("http://origin.int/a", ""), "x" * 10)
+        cache.put("http://origin.int/b", make_http_response("http://origin.int/b", ""), "x" * 20)
+        cache.put("http://origin.int/a", make_http_response("http://origin.int/a", ""), "x" * 5)
+        self.assertEquals(cache.total_size, 25)
+        cache.get("http://origin.int/b")
+        self.assertEquals(list(cache.touched), ["http://origin.int/b"])
+        cache.close()
+
+        cache = ResponseCache(filename)
+        self.assertEquals(cache.total_size, 25)
+        # /b was used most recently so /a goes first:
+        cache.max_size = 30
+        cache.put("http://origin.int/c", make_http_response("http://origin.int/c", ""), "x" * 10)
+        self.assertEquals(cache.get("http://origin.int/a"), None)
+        self.assertNotEqual(cache.get("http://origin.int/b"), None)
+        self.assertEquals(cache.total_size, 30)
+        cache.close()
+
+
+class TestResultIndex(unittest.TestCase):
+    def setUp(self):
+        from StringIO import StringIO
+        from webcompare import ResultIndex, TitleComparator, LengthComparator
+        walker = make_site_walker(SITE_PAGES)
+        walker.add_comparator(TitleComparator())
+        walker.add_comparator(LengthComparator())
+        walker.walk_and_compare()
+        self.walker = walker
+        self.index = ResultIndex()
+        self.index.load(StringIO(walker.json_results()))
+
+    def tearDown(self):
+        self.index.close()
+
+    def test_query(self):
+        records, total = self.index.query(count=2)
+        self.assertEquals(total, 6)
+        self.assertEquals([r["origin_url"] for r in records],
+                          ["http://origin.int", "http://origin.int/"])
+        self.assertEquals(records[0]["TitleComparator"], 100)
+
+        records, total = self.index.query(start=4, count=10, descending=True)
+        self.assertEquals([r["origin_url"] for r in records],
+                          ["http://origin.int/", "http://origin.int"])
+
+    def test_filters(self):
+        records, total = self.index.query(result_types=["BadOriginResult"])
+        self.assertEquals(total, 1)
+        self.assertEquals(records[0]["origin_url"], "http://origin.int/missing")
+
+        records, total = self.index.query(url_prefix=u"http://origin.int/", sort="origin_url")
+        self.assertEquals([r["origin_url"] for r in records],
+                          ["http://origin.int/", "http://origin.int/a", "http://origin.int/b",
+                           "http://origin.int/c", "http://origin.int/missing"])
+
+        expected = sorted(r.origin_url for r in self.walker.results
+                          if r.comparisons.get("LengthComparator", -1) >= 90)
+        records, total = self.index.query(comparator="LengthComparator", min_score=90)
+        self.assertEquals([r["origin_url"] for r in records], expected)
+
+        records, total = self.index.query(comparator="LengthComparator", max_score=-1)
+        self.assertEquals(total, 0)
+        self.assertRaises(ValueError, self.index.query, sort="origin_url; DROP TABLE results")
+
+    def test_sort_by_comparator(self):
+        records, total = self.index.query(sort="LengthComparator", descending=True,
+                                          result_types=["GoodResult"])
+        scores = [r["LengthComparator"] for r in records]
+        self.assertEquals(scores, sorted(scores, reverse=True))
+
+    def test_html_errors(self):
+        records, total = self.index.query(count=1)
+        result = self.walker.results[0]
+        self.assertEquals(self.index.get_html_errors(records[0]["row"]),
+                          {"origin": result.origin_html_errors or [],
+                           "target": result.target_html_errors or []})
+        self.assertRaises(KeyError, self.index.get_html_errors, 100)
+
+    def test_columnar(self):
+        import json
+        import os
+        import shutil
+        import tempfile
+        from webcompare import ResultIndex
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with open(os.path.join(directory, "r.errors.jsonl"), "wb") as errors_file:
+            data = self.walker.columnar_results(html_errors_file=errors_file)
+        data["html_errors_file"] = "r.errors.jsonl"
+        with open(os.path.join(directory, "r.json"), "wb") as f:
+            json.dump(data, f, sort_keys=True, separators=(",", ":"))
+
+        index = ResultIndex()
+        self.addCleanup(index.close)
+        with open(os.path.join(directory, "r.json"), "rb") as f:
+            index.load(f)
+
+        self.assertEquals(index.count(), 6)
+        self.assertEquals(index.stats, self.index.stats)
+        records, total = self.index.query(sort="origin_url")
+        columnar_records, total = index.query(sort="origin_url")
+        for a, b in zip(records, columnar_records):
+            self.assertEquals(a["target_url"], b["target_url"])
+            self.assertEquals(a.get("LengthComparator"), b.get("LengthComparator"))
+            self.assertEquals(self.index.get_html_errors(a["row"]), index.get_html_errors(b["row"]))
+
+    def test_unknown_format(self):
+        from StringIO import StringIO
+        from webcompare import ResultIndex
+        index = ResultIndex()
+        self.addCleanup(index.close)
+        self.assertRaises(ValueError, index.load, StringIO('{"something": "else"}\n'))
+
+    def test_server(self):
+        import json
+        import threading
+        import urllib2
+        from BaseHTTPServer import HTTPServer
+        from webcompare import ResultRequestHandler
+
+        class QuietHandler(ResultRequestHandler):
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(("127.0.0.1", 0), QuietHandler)
+        server.result_index = self.index
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        base_url = "http://127.0.0.1:%d" % server.server_port
+
+        meta = json.load(urllib2.urlopen(base_url + "/webcompare.json"))
+        self.assertTrue(meta["server"])
+        self.assertEquals(meta["stats"], {"GoodResult": 5, "BadOriginResult": 1})
+
+        page = json.load(urllib2.urlopen(base_url + "/results?sort=origin_url&dir=asc"
+                                         "&startIndex=0&results=2&result_type=GoodResult"))
+        self.assertEquals(page["totalRecords"], 5)
+        self.assertEquals(len(page["records"]), 2)
+        # No result_type ticked shows nothing, as in the static report:
+        empty = json.load(urllib2.urlopen(base_url + "/results?sort=origin_url&dir=asc"))
+        self.assertEquals(empty["totalRecords"], 0)
+
+        errors = json.load(urllib2.urlopen(base_url + "/errors?row=%d" % page["records"][0]["row"]))
+        self.assertEquals(sorted(errors), ["origin", "target"])
+
+        try:
+            urllib2.urlopen(base_url + "/results?sort=nonsense")
+            self.fail("Invalid sort should be rejected")
+        except urllib2.HTTPError as e:
+            self.assertEquals(e.code, 400)
+
+
+class TestBodyLimits(unittest.TestCase):
+    def test_body_types(self):
+        import hashlib
+        from webcompare import Response
+        pdf = make_http_response("http://origin.int/a.pdf", "%PDF" * 1000, content_type="application/pdf")
+        response = Response(pdf, body_types=set(["text/html"]))
+        self.assertEquals(response.content, "")
+        self.assertEquals(response.content_length, 4000)
+        self.assertEquals(response.body_hash, hashlib.sha1("%PDF" * 1000).hexdigest())
+        self.assertFalse(response.is_html)
+
+        html = make_http_response("http://origin.int/", "<html><title>x</title></html>")
+        response = Response(html, body_types=set(["text/html"]))
+        self.assertEquals(response.content, "<html><title>x</title></html>")
+        self.assertTrue(response.is_html)
+
+    def test_no_body_hash(self):
+        from webcompare import Response
+        pdf = make_http_response("http://origin.int/a.pdf", "%PDF" * 1000, content_type="application/pdf")
+        response = Response(pdf, body_types=set(["text/html"]), hash_body=False)
+        self.assertEquals(response.content, "")
+        self.assertEquals(response.body_hash, None)
+        self.assertEquals(response.content_length, None)
+        # addinfourl.close() drops its file:
+        self.assertEquals(pdf.fp, None)
+
+    def test_max_body_size(self):
+        from webcompare import Response
+        big = make_http_response("http://origin.int/", "<p>" + "x" * 300000)
+        response = Response(big, max_body_size=100000)
+        self.assertTrue(response.truncated)
+        self.assertFalse(response.is_html)
+        self.assertEquals(response.content, "")
+        self.assertEquals(response.body_hash, None)
+        self.assertTrue(response.content_length > 100000)
+
+    def test_asset_comparisons(self):
+        pages = dict(SITE_PAGES)
+        pages["/"] = pages["/"].replace("</body>", '<a href="/doc.pdf">pdf</a></body>')
+        pages["/doc.pdf"] = "%PDF" * 100
+        walker = make_site_walker(pages)
+        walker.body_types = set(["text/html"])
+
+        def fetch(url):
+            path = url.split(".int", 1)[1] or "/"
+            content_type = "application/pdf" if path.endswith(".pdf") else "text/html"
+            return walker._make_response(make_http_response(
+                url, pages.get(path, ""), code=200 if path in pages else 404,
+                content_type=content_type))
+
+        walker._fetch_url = fetch
+        walker.walk_and_compare()
+        pdf = [r for r in walker.results if r.origin_url.endswith(".pdf")][0]
+        self.assertEquals(pdf.comparisons, {"AssetComparator": 100})
+        self.assertEquals(pdf.origin_hash, pdf.target_hash)
+
+    def test_asset_comparator(self):
+        from webcompare import AssetComparator
+
+        class Stub(object):
+            def __init__(self, body_hash, content_length):
+                self.body_hash = body_hash
+                self.content_length = content_length
+
+        comparator = AssetComparator()
+        self.assertEquals(comparator.compare(Stub("a", 10), Stub("a", 10)), 100)
+        self.assertEquals(comparator.compare(Stub("a", 10), Stub("b", 10)), 99)
+        self.assertEquals(comparator.compare(Stub(None, 10), Stub(None, 20)), 50)
+        self.assertEquals(comparator.compare(Stub(None, None), Stub(None, 20)), None)
+
+
+class TestLinkFiltering(unittest.TestCase):
+    def test_combine_regexes(self):
+        from webcompare import combine_regexes
+        patterns = [r".*\.pdf$", r"(?i).*/ADMIN/", r"(.)\1x", r".*/tag/(\w+)/"] + \
+                   [r".*/skip%d/(\d+)" % i for i in range(150)]
+        regexes = combine_regexes(patterns)
+        self.assertTrue(len(regexes) < 20)
+
+        def ignored(url):
+            return any(r.match(url) for r in regexes)
+
+        self.assertTrue(ignored("http://origin.int/file.pdf"))
+        self.assertTrue(ignored("http://origin.int/admin/"))
+        self.assertTrue(ignored("aax"))
+        self.assertTrue(ignored("http://origin.int/skip149/3"))
+        self.assertFalse(ignored("http://origin.int/ADMINISTRATION.PDF"))
+        self.assertFalse(ignored("http://origin.int/file.PDF"))
+        self.assertFalse(ignored("abx"))
+
+    def test_get_links(self):
+        from webcompare import Response
+        walker = make_site_walker(SITE_PAGES, ignoreres=[r".*/b$", r".*/ignored/"])
+        page = ('<html><body><a href="/a">a</a><a href="/a#top">a again</a><a href="/b">b</a>'
+                '<a href="/a">a</a><a href="/ignored/x">x</a><a href="http://elsewhere.int/">e</a>'
+                '<a href="/c">c</a></body></html>')
+        response = Response(make_http_response("http://origin.int/", page))
+        self.assertEquals(walker._get_links(response), ["http://origin.int/a", "http://origin.int/c"])
+        self.assertEquals(walker._link_cache["http://origin.int/b"], None)
+        self.assertEquals(walker._link_cache["http://origin.int/a#top"], "http://origin.int/a")
+
+        small = make_site_walker(SITE_PAGES, ignoreres=[r".*/b$", r".*/ignored/"])
+        small.link_cache_size = 2
+        self.assertEquals(small._get_links(response), ["http://origin.int/a", "http://origin.int/c"])
+        self.assertTrue(len(small._link_cache) <= 2)
+
+
+class TestNoiseFilter(unittest.TestCase):
+    EXPRESSIONS = ['//script', '//*[@id="ads"]', '//div[contains(@class, "nav")]',
+                   "//div[@class='x']", "//span[@title]", "//section/p[2]", ""]
+    PAGE = ('<html><body><script>x</script><div id="ads"><p>a</p></div>'
+            '<div class="top nav">n<span title="t">t</span></div><div class="x">X</div>'
+            '<section><p>1</p><p>2</p><span>kept</span></section></body></html>')
+
+    def remove_separately(self, tree):
+        from webcompare import XPath
+        for expression in self.EXPRESSIONS:
+            if expression:
+                for e in XPath(expression)(tree):
+                    if e.getparent() is not None:
+                        e.getparent().remove(e)
+
+    def test_combined(self):
+        import lxml.html
+        from webcompare import NoiseFilter
+        noise = NoiseFilter(self.EXPRESSIONS)
+        self.assertEquals(len(noise.passes), 2)
+        self.assertEquals(noise.passes[1].path, "//section/p[2]")
+
+        expected = lxml.html.fromstring(self.PAGE)
+        self.remove_separately(expected)
+        tree = lxml.html.fromstring(self.PAGE)
+        noise.remove(tree)
+        self.assertEquals(lxml.html.tostring(tree), lxml.html.tostring(expected))
+        self.assertEquals(lxml.html.tostring(tree),
+                          "<html><body><section><p>1</p><span>kept</span></section></body></html>")
+
+    def test_in_order(self):
+        import lxml.html
+        from webcompare import NoiseFilter
+        page = ('<html><body><div class="ad">ad</div><div>1</div><div>2</div>'
+                '<section><p>p</p></section><section>s</section></body></html>')
+        # //div[2] and //section[p] are evaluated once the expressions
+        # before them have been removed:
+        expressions = ['//div[@class="ad"]', "//div[2]", "//p", "//section[p]"]
+
+        for timed in (False, True):
+            tree = lxml.html.fromstring(page)
+            NoiseFilter(expressions, timed=timed).remove(tree)
+            self.assertEquals(lxml.html.tostring(tree),
+                              "<html><body><div>1</div><section></section>"
+                              "<section>s</section></body></html>")
+
+    def test_timed(self):
+        import lxml.html
+        from webcompare import NoiseFilter
+        noise = NoiseFilter(self.EXPRESSIONS, timed=True)
+        tree = lxml.html.fromstring(self.PAGE)
+        noise.remove(tree)
+        self.assertEquals(lxml.html.tostring(tree),
+                          "<html><body><section><p>1</p><span>kept</span></section></body></html>")
+
+        timings = noise.get_timings()
+        self.assertEquals(sorted(timings), sorted(e for e in self.EXPRESSIONS if e))
+        self.assertEquals(timings["//script"]["matches"], 1)
+        self.assertTrue(timings["//script"]["seconds"] > 0)
+
+    def test_walker_stats(self):
+        from webcompare import NoiseFilter
+        walker = make_site_walker(SITE_PAGES)
+        walker.origin_noise = NoiseFilter(["//a"], timed=True)
+        walker.walk_and_compare()
+        stats = walker.get_summary_stats()
+        self.assertEquals(stats["noise_xpaths"]["origin"]["//a"]["matches"], 9)
+        self.assertFalse("target" in stats["noise_xpaths"])
+        self.assertTrue("denoise" in walker.results[1].timings)
+
+
+class TestTimingHistogram(unittest.TestCase):
+    def test_percentiles(self):
+        from webcompare import TimingHistogram
+        histogram = TimingHistogram()
+        self.assertEquals(histogram.percentile(50), None)
+
+        for i in range(1, 1001):
+            histogram.add(i / 1000.0)
+
+        summary = histogram.summary()
+        self.assertEquals(summary["count"], 1000)
+        self.assertEquals(summary["max"], 1.0)
+        self.assertAlmostEquals(summary["mean"], 0.5005)
+        for p in (50, 95, 99):
+            self.assertTrue(abs(summary["p%d" % p] - p / 100.0) <= 0.05 * p / 100.0)
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_make_site(self):
+        from benchmark import make_site, mutate_site
+        site = make_site(20, page_size=2, fanout=3, error_rate=0.5)
+        self.assertEquals(len(site), 20)
+        self.assertEquals(site, make_site(20, page_size=2, fanout=3, error_rate=0.5))
+        self.assertTrue(all(len(html) >= 2048 for html in site.values()))
+
+        target = mutate_site(site)
+        self.assertEquals(sorted(target), sorted(site))
+        self.assertNotEquals(target, site)
+
+    def test_compare_to_baseline(self):
+        from benchmark import compare_to_baseline
+        settings = {"pages": 5}
+        baseline = {"settings": settings,
+                    "results": {"crawl": {"pages_per_second": 10.0, "pages": 5,
+                                          "stages": {"origin_ttfb": {"max": 0.00001}}},
+                                "parse": {"median_seconds": 1.0},
+                                "comparators": {"TitleComparator": {"median_seconds": 0.0001}}}}
+        same = {"settings": settings,
+                "results": {"crawl": {"pages_per_second": 9.0, "pages": 50,
+                                      "stages": {"origin_ttfb": {"max": 0.00005}}},
+                            "parse": {"median_seconds": 1.1},
+                            # Twice as slow, but by less than the noise floor:
+                            "comparators": {"TitleComparator": {"median_seconds": 0.0002}}}}
+        worse = {"settings": settings,
+                 "results": {"crawl": {"pages_per_second": 5.0, "pages": 5},
+                             "parse": {"median_seconds": 2.0}}}
+        self.assertEquals(compare_to_baseline(same, baseline, 0.2), [])
+        self.assertEquals(compare_to_baseline(worse, baseline, 0.2),
+                          [("crawl.pages_per_second", 10.0, 5.0), ("parse.median_seconds", 1.0, 2.0)])
+        self.assertRaises(ValueError, compare_to_baseline,
+                          dict(same, settings={"pages": 50}), baseline, 0.2)
+
+
+class TestBloomFilter(unittest.TestCase):
+    def test_membership(self):
+        from webcompare import BloomFilter
+        bf = BloomFilter(1000, error_rate=0.01)
+        urls = ["http://origin.int/page/%d" % i for i in range(1000)]
+        for url in urls:
+            bf.add(url)
+        self.assertEquals(len(bf), 1000)
+        self.assertTrue(all(url in bf for url in urls))
+        self.assertTrue(u"http://origin.int/page/1" in bf)
+        false_positives = sum(1 for i in range(1000) if "http://origin.int/other/%d" % i in bf)
+        self.assertTrue(false_positives < 50)
+
+
+class TestResponseParsing(unittest.TestCase):
+    def setUp(self):
+        from webcompare import Response
+        self.response = Response(make_http_response(
+            "http://origin.int/dir/page",
+            '<html><head><title>Title</title><body><p><a href="other">x</a><b>unclosed'))
+
+    def test_htmltree(self):
+        import lxml.html
+        self.assertTrue(isinstance(self.response.htmltree, lxml.html.HtmlElement))
+        self.assertEquals(self.response.htmltree.xpath("//html/head/title")[0].text, "Title")
+        self.assertEquals([link[2] for link in self.response.htmltree.iterlinks()],
+                          ["http://origin.int/dir/other"])
+
+    def test_parser_errors(self):
+        errors = self.response.get_parser_errors()
+        self.assertTrue(len(errors) > 0)
+        self.assertTrue(errors[0].startswith("Error at line 1 col 6:"))
+
+    def test_body_text(self):
+        self.assertEquals(self.response.get_body_text(), u"x\nunclosed")
+
+    def test_tbody(self):
+        from webcompare import Response
+        response = Response(make_http_response(
+            "http://origin.int/", "<table><tr><td>cell</td></tr></table>"))
+        # Like browsers, but unlike lxml.html, html5lib adds the tbody:
+        self.assertEquals(response.htmltree.xpath("//table/tr"), [])
+        self.assertEquals(response.htmltree.xpath("//table/tbody/tr/td")[0].text, "cell")
+
+    def test_foreign_elements(self):
+        import warnings
+        from webcompare import Response
+        response = Response(make_http_response(
+            "http://origin.int/dir/page",
+            '<p xml:lang="en"><svg><a xlink:href="drawing"><text>t</text></a></svg>'
+            '<math><mi>x</mi></math></p>'))
+
+        with warnings.catch_warnings(record=True) as caught:
+            tree = response.htmltree
+        self.assertEquals(caught, [])
+
+        self.assertEquals(len(tree.xpath("//svg/a/text")), 1)
+        self.assertEquals(len(tree.xpath("//math/mi")), 1)
+        self.assertEquals(tree.xpath("//p/@xml:lang"), ["en"])
+        self.assertEquals([link[2] for link in tree.iterlinks()],
+                          ["http://origin.int/dir/drawing"])
+
+    def test_features(self):
+        from webcompare import SIMILARITY_ENGINES
+        self.assertEquals(self.response.get_title(), u"Title")
+        self.assertEquals(self.response.get_feature("title"), u"title")
+        self.assertEquals(self.response.get_feature("body"), u"x unclosed")
+        words = self.response.get_feature("body", SIMILARITY_ENGINES["jaccard"])
+        self.assertEquals(words, frozenset([u"x", u"unclosed"]))
+        self.assertTrue(self.response.get_feature("body", SIMILARITY_ENGINES["jaccard"]) is words)
+        self.assertEquals(self.response.get_feature("body", SIMILARITY_ENGINES["sequence"]), u"x unclosed")
+        self.assertRaises(ValueError, self.response.get_feature, "footer")
+
+    def test_lazy_parse(self):
+        self.assertEquals(self.response.parser, None)
+        self.assertNotEqual(self.response.htmltree, None)
+        self.assertNotEqual(self.response.parser, None)
+
+    def test_not_html(self):
+        from webcompare import Response
+        response = Response(make_http_response("http://origin.int/a.txt", "<p>text",
+                                               content_type="text/plain"))
+        self.assertEquals(response.htmltree, None)
+        self.assertEquals(response.get_parser_errors(), [])
+
+
 class TestUrlManglers(unittest.TestCase):
     def SetUp(self):
         pass
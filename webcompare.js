@@ -7,6 +7,232 @@
 (function () {
     "use strict";
     var WebCompare = {
+        // Labels for the comparators we know about; others use their name:
+        comparatorLabels: {
+            BodyComparator:    "Body<br/>proxim",
+            ContentComparator: "Content<br/>proxim",
+            NgramComparator:   "NGram<br/>similarity",
+            LengthComparator:  "Length<br/>proxim",
+            TitleComparator:   "Title<br/>proxim"
+        },
+
+        fields: ["result_type", "origin_url", "origin_code", "origin_time", "origin_html_errors",
+                 "target_url", "target_code", "target_time", "target_html_errors"],
+
+        // Convert the original one-object-per-result format into the
+        // columnar format written by webcompare.py --columnar:
+        toColumnar: function (results) {
+            var data = {result_types: [], comparators: [], columns: {}, html_errors: [],
+                        count: results.resultlist.length, stats: results.stats};
+            var typeIndex = {};
+            var i, j, k, r;
+
+            for (j = 0; j < this.fields.length; j += 1) {
+                data.columns[this.fields[j]] = [];
+            }
+
+            for (i = 0; i < results.resultlist.length; i += 1) {
+                r = results.resultlist[i];
+
+                if (typeIndex[r.result_type] === undefined) {
+                    typeIndex[r.result_type] = data.result_types.length;
+                    data.result_types.push(r.result_type);
+                }
+
+                for (k in r.comparisons) {
+                    if (r.comparisons.hasOwnProperty(k) && data.columns[k] === undefined) {
+                        data.comparators.push(k);
+                        data.columns[k] = [];
+                    }
+                }
+
+                for (j = 0; j < this.fields.length; j += 1) {
+                    // Fields which are null are left out of the JSON:
+                    data.columns[this.fields[j]].push(r[this.fields[j]] !== undefined ? r[this.fields[j]] : null);
+                }
+                data.columns.result_type[i] = typeIndex[r.result_type];
+                data.columns.origin_html_errors[i] = (r.origin_html_errors ? r.origin_html_errors.length : null);
+                data.columns.target_html_errors[i] = (r.target_html_errors ? r.target_html_errors.length : null);
+                data.html_errors.push({origin: r.origin_html_errors || [], target: r.target_html_errors || []});
+            }
+
+            // Results without a score for a comparator:
+            for (j = 0; j < data.comparators.length; j += 1) {
+                k = data.comparators[j];
+                for (i = 0; i < results.resultlist.length; i += 1) {
+                    r = results.resultlist[i].comparisons;
+                    data.columns[k][i] = (r && r[k] !== undefined ? r[k] : null);
+                }
+            }
+
+            return data;
+        },
+
+        // Split a DataTable request like sort=origin_url&dir=asc&startIndex=0&results=100
+        // into its parameters; result_type may be repeated.
+        parseRequest: function (request) {
+            var params = {result_type: []};
+            var pairs = request.split("&");
+            var i, kv;
+
+            for (i = 0; i < pairs.length; i += 1) {
+                kv = pairs[i].split("=");
+                if (kv[0] === "result_type") {
+                    params.result_type.push(decodeURIComponent(kv[1]));
+                } else if (kv[0]) {
+                    params[kv[0]] = decodeURIComponent(kv[1] || "");
+                }
+            }
+            return params;
+        },
+
+        // Return one page of rows matching the filters, sorted by the
+        // requested column, in the same form as webcompare.py --serve
+        // answers /results. Only the rows on the page become objects.
+        query: function (data, params) {
+            var columns = data.columns;
+            var types = columns.result_type;
+            var sort = params.sort;
+            var dir = params.dir;
+            var startIndex = parseInt(params.startIndex, 10) || 0;
+            var count = parseInt(params.results, 10) || 100;
+            var resFilter = {};
+            var scores = columns[params.comparator];
+            var minScore = (params.min_score ? parseFloat(params.min_score) : null);
+            var maxScore = (params.max_score ? parseFloat(params.max_score) : null);
+            var prefix = params.prefix || "";
+            var rows = [];
+            var records = [];
+            var i, l, row, rec, name, values;
+
+            for (i = 0; i < params.result_type.length; i += 1) {
+                resFilter[params.result_type[i]] = true;
+            }
+
+            for (i = 0, l = data.count; i < l; i += 1) {
+                if (!resFilter[data.result_types[types[i]]]) {
+                    continue;
+                }
+                if (prefix && columns.origin_url[i].indexOf(prefix) !== 0) {
+                    continue;
+                }
+                if ((minScore !== null || maxScore !== null) &&
+                        (!scores || scores[i] === null || scores[i] === undefined ||
+                         (minScore !== null && scores[i] < minScore) ||
+                         (maxScore !== null && scores[i] > maxScore))) {
+                    continue;
+                }
+                rows.push(i);
+            }
+
+            if (sort && columns[sort]) {
+                values = columns[sort];
+                if (sort === "result_type") {
+                    values = [];
+                    for (i = 0, l = data.count; i < l; i += 1) {
+                        values.push(data.result_types[types[i]]);
+                    }
+                }
+                rows.sort(function (a, b) {
+                    var x = values[a], y = values[b];
+                    if (x === y) {
+                        return a - b;
+                    } else if (x === null || x === undefined) {
+                        return -1;
+                    } else if (y === null || y === undefined) {
+                        return 1;
+                    }
+                    return (x < y ? -1 : 1);
+                });
+                if (dir === "desc") {
+                    rows.reverse();
+                }
+            }
+
+            for (i = startIndex, l = Math.min(rows.length, startIndex + count); i < l; i += 1) {
+                row = rows[i];
+                rec = {row: row};
+                for (name in columns) {
+                    if (columns.hasOwnProperty(name)) {
+                        rec[name] = columns[name][row];
+                    }
+                }
+                rec.result_type = data.result_types[types[row]];
+                // null is derived from the origin URL, "" means there's none:
+                if (rec.target_url === null && data.origin_url_base) {
+                    rec.target_url = rec.origin_url.replace(data.origin_url_base, data.target_url_base);
+                } else if (rec.target_url === "") {
+                    rec.target_url = null;
+                }
+                records.push(rec);
+            }
+
+            return {records: records, totalRecords: rows.length};
+        },
+
+        // Turn a flat [line, col, message index, ...] array from
+        // columnar_results back into error strings
+        unpackHtmlErrors: function (packed, messages) {
+            var errors = [], i;
+
+            for (i = 0; i < packed.length; i = i + 3) {
+                if (packed[i] < 0) {
+                    errors.push(messages[packed[i + 2]]);
+                } else {
+                    errors.push("Error at line " + packed[i] + " col " + packed[i + 1] + ": " + messages[packed[i + 2]]);
+                }
+            }
+
+            return errors;
+        },
+
+        // Call callback with {origin: [...], target: [...]} for a row
+        getHtmlErrors: function (data, row, callback) {
+            var start, end;
+
+            if (data.html_errors) {
+                callback(data.html_errors[row]);
+                return;
+            }
+
+            if (data.server) {
+                YAHOO.util.Connect.asyncRequest('GET', "errors?row=" + row, {
+                    success: function (o) {
+                        callback(YAHOO.lang.JSON.parse(o.responseText));
+                    },
+                    failure: function (o) {
+                        alert("Unable to load HTML errors: " + o.status + ":" + o.statusText);
+                    }
+                });
+                return;
+            }
+
+            start = data.html_errors_offsets[row];
+            end = data.html_errors_offsets[row + 1];
+            if (start === end) {
+                callback({origin: [], target: []});
+                return;
+            }
+
+            YAHOO.util.Connect.initHeader("Range", "bytes=" + start + "-" + (end - 1), false);
+            YAHOO.util.Connect.asyncRequest('GET', document.location.href.replace(/[^\/]*$/, data.html_errors_file), {
+                success: function (o) {
+                    // Servers which ignore Range send the whole file:
+                    var text = (o.status === 206 ? o.responseText : o.responseText.substring(start, end)),
+                        errors = YAHOO.lang.JSON.parse(text);
+
+                    if (data.html_error_messages) {
+                        errors.origin = WebCompare.unpackHtmlErrors(errors.origin, data.html_error_messages);
+                        errors.target = WebCompare.unpackHtmlErrors(errors.target, data.html_error_messages);
+                    }
+                    callback(errors);
+                },
+                failure: function (o) {
+                    alert("Unable to load HTML errors: " + o.status + ":" + o.statusText);
+                }
+            });
+        },
+
         load: function (data) {
             var urlPath = function (url) {
                 return url.replace(/http:\/\/[\w.]+/, '');
@@ -31,7 +257,7 @@
                 }
             };
             var formatHtmlErrors = function (elCell, oRecord, oColumn, sData) {
-                elCell.innerHTML = (sData ? sData.length : ''); // how to higlight linkability?
+                elCell.innerHTML = (sData ? sData : ''); // how to higlight linkability?
             };
             var getResFilter = function () {
                 var resFilter = {};
@@ -41,8 +267,13 @@
                 resFilter.GoodResult      = (document.getElementById("GoodResult").checked === true);
                 return resFilter;
             };
+            var i, name;
+
+            if (data.results) {
+                data = WebCompare.toColumnar(data.results);
+            }
 
-            var statsSource = new YAHOO.util.DataSource([data.results.stats]);
+            var statsSource = new YAHOO.util.DataSource([data.stats]);
             statsSource.responseType = YAHOO.util.XHRDataSource.TYPE_JSARRAY;
             statsSource.responseSchema = {
                 fields:      ["ErrorResult", "BadOriginResult", "BadTargetResult", "GoodResult"]
@@ -56,42 +287,52 @@
 
             var statsTable = new YAHOO.widget.DataTable("statsTable", statsColumns, statsSource);
 
-            function flatten_results(input) {
-                var res = [];
+            // Add the filters to the DataTable's usual paging and sorting request:
+            var generateRequest = function (oState, oSelf) {
+                var request;
+                var resFilter = getResFilter();
+                var comparator = document.getElementById("scoreComparator").value;
+                var type;
 
-                for (var i = 0; i < input.resultlist.length; i += 1) {
-                    var tmp = input.resultlist[i];
-                    for (var k in tmp.comparisons) {
-                        tmp[k] = tmp.comparisons[k];
+                request = "sort=" + encodeURIComponent(oState.sortedBy ? oState.sortedBy.key : "origin_url") +
+                    "&dir=" + (oState.sortedBy && oState.sortedBy.dir === YAHOO.widget.DataTable.CLASS_DESC ? "desc" : "asc") +
+                    "&startIndex=" + (oState.pagination ? oState.pagination.recordOffset : 0) +
+                    "&results=" + (oState.pagination ? oState.pagination.rowsPerPage : 100);
+
+                for (type in resFilter) {
+                    if (resFilter.hasOwnProperty(type) && resFilter[type]) {
+                        request += "&result_type=" + type;
                     }
-                    res.push(tmp);
                 }
-                return res;
-            }
-
-            var dataSource = new YAHOO.util.FunctionDataSource(
-                function () {
-                    return flatten_results(data.results);
-                },
-                {
-                    doBeforeCallback: function (req, oFullResponse, res, cb) {
-                        var data     = res.results || [];
-                        var filtered = [];
-                        var i, l;
-
-                        var resFilter = getResFilter();
-                        for (i = 0, l = data.length; i < l; i += 1) {
-                            if (resFilter[data[i].result_type]) {
-                                filtered.push(data[i]);
-                            }
-                        }
-                        res.results = filtered;
-                        return res;
+                if (document.getElementById("urlPrefix").value) {
+                    request += "&prefix=" + encodeURIComponent(document.getElementById("urlPrefix").value);
+                }
+                if (comparator) {
+                    request += "&comparator=" + encodeURIComponent(comparator);
+                    if (document.getElementById("minScore").value) {
+                        request += "&min_score=" + encodeURIComponent(document.getElementById("minScore").value);
                     }
+                    if (document.getElementById("maxScore").value) {
+                        request += "&max_score=" + encodeURIComponent(document.getElementById("maxScore").value);
+                    }
+                }
+                return request;
+            };
+
+            var dataSource;
+            if (data.server) {
+                // webcompare.py --serve answers the queries:
+                dataSource = new YAHOO.util.XHRDataSource("results?");
+            } else {
+                dataSource = new YAHOO.util.FunctionDataSource(function (request) {
+                    return WebCompare.query(data, WebCompare.parseRequest(request));
                 });
-            dataSource.responseType = YAHOO.util.DataSource.TYPE_JSARRAY;
+            }
+            dataSource.responseType = YAHOO.util.DataSource.TYPE_JSON;
             dataSource.responseSchema = {
+                resultsList: "records",
                 fields: [
+                    {key: "row",                parser: "number"},
                     "result_type",
                     "origin_url",
                     "target_url",
@@ -99,14 +340,10 @@
                     {key: "target_code",        parser: "number"},
                     {key: "origin_time",        parser: "number"},
                     {key: "target_time",        parser: "number"},
-                    "origin_html_errors",
-                    "target_html_errors",
-                    {key: "BodyComparator",     parser: "number"},
-                    {key: "ContentComparator",  parser: "number"},
-                    {key: "NgramComparator",    parser: "number"},
-                    {key: "LengthComparator",   parser: "number"},
-                    {key: "TitleComparator",    parser: "number"}
-                ]
+                    {key: "origin_html_errors", parser: "number"},
+                    {key: "target_html_errors", parser: "number"}
+                ],
+                metaFields: {totalRecords: "totalRecords"}
             };
 
             var tableColumns = [
@@ -116,47 +353,68 @@
                 {key: "origin_time",                    label: "Origin<br/>Time",      sortable: true, formatter: formatDownloadTime},
                 {key: "target_time",                    label: "Target<br/>Time",      sortable: true, formatter: formatDownloadTime},
                 {key: "origin_html_errors",             label: "Origin<br/>Errors",    sortable: true, formatter: formatHtmlErrors},
-                {key: "target_html_errors",             label: "Target<br/>Errors",    sortable: true, formatter: formatHtmlErrors},
-                {key: "BodyComparator",                 label: "Body<br/>proxim",      sortable: true},
-                {key: "ContentComparator",              label: "Content<br/>proxim",   sortable: true},
-                {key: "NgramComparator",                label: "NGram<br/>similarity", sortable: true},
-                {key: "LengthComparator",               label: "Length<br/>proxim",    sortable: true},
-                {key: "TitleComparator",                label: "Title<br/>proxim",     sortable: true},
-                {key: "origin_url",                     label: "URL Path",             sortable: true, formatter: formatUrlPath}
+                {key: "target_html_errors",             label: "Target<br/>Errors",    sortable: true, formatter: formatHtmlErrors}
             ];
 
-            var dataTable = new YAHOO.widget.DataTable("resultlist", tableColumns, dataSource);
+            var scoreComparator = document.getElementById("scoreComparator");
+            for (i = 0; i < data.comparators.length; i += 1) {
+                name = data.comparators[i];
+                scoreComparator.options[scoreComparator.options.length] = new window.Option(name, name);
+                dataSource.responseSchema.fields.push({key: name, parser: "number"});
+                tableColumns.push({key: name, label: WebCompare.comparatorLabels[name] || name, sortable: true});
+            }
+
+            tableColumns.push({key: "origin_url",   label: "URL Path",             sortable: true, formatter: formatUrlPath});
+
+            var dataTable = new YAHOO.widget.DataTable("resultlist", tableColumns, dataSource, {
+                dynamicData: true,
+                generateRequest: generateRequest,
+                initialRequest: generateRequest({sortedBy: null, pagination: null}),
+                sortedBy: {key: "origin_url", dir: YAHOO.widget.DataTable.CLASS_ASC},
+                paginator: new YAHOO.widget.Paginator({rowsPerPage: 100})
+            });
+            dataTable.handleDataReturnPayload = function (oRequest, oResponse, oPayload) {
+                oPayload.totalRecords = oResponse.meta.totalRecords;
+                return oPayload;
+            };
             dataTable.set("seletionMode", "singlecell");
             dataTable.subscribe("cellClickEvent", function (oArgs) {
-                var html_errors;
-                var ln;
+                var which;
                 var rec = this.getRecord(oArgs.target);
-                var data = rec.getData();
-                var mywin;
                 if (oArgs.target.headers.indexOf("origin_html_errors") >= 0) {
-                    html_errors = data.origin_html_errors;
+                    which = "origin";
                 }
                 if (oArgs.target.headers.indexOf("target_html_errors") >= 0) {
-                    html_errors = data.target_html_errors;
+                    which = "target";
                 }
-                if (html_errors !== undefined) {
-                    for (ln = 0; ln < html_errors.length; ln = ln + 1) {
-                        html_errors[ln] = html_errors[ln].replace(/</g, '&lt;').replace(/>/g, '&gt;');
-                    }
-                    mywin = window.open('', "popWindow", 'height=400,location=no,menubar=no,status=no,toolbar=no');
-                    mywin.document.write(html_errors.join("<br/>"));
-                    mywin.document.close();
+                if (which !== undefined && rec.getData(which + "_html_errors")) {
+                    WebCompare.getHtmlErrors(data, rec.getData("row"), function (errors) {
+                        var html_errors = errors[which];
+                        var ln;
+                        var mywin;
+                        for (ln = 0; ln < html_errors.length; ln = ln + 1) {
+                            html_errors[ln] = html_errors[ln].replace(/</g, '&lt;').replace(/>/g, '&gt;');
+                        }
+                        mywin = window.open('', "popWindow", 'height=400,location=no,menubar=no,status=no,toolbar=no');
+                        mywin.document.write(html_errors.join("<br/>"));
+                        mywin.document.close();
+                    });
                 }
                 return true;        // allow other handers to see the click
             });
 
-            // Reload the table when they select new filter options and click on Filter!
+            // Reload the table from the first page when they select new
+            // filter options and click on Filter!
 
-            YAHOO.util.Event.addListener('filters', 'click', function () {
+            YAHOO.util.Event.addListener(['filters', 'applyFilters'], 'click', function () {
+                var state = dataTable.getState();
+                state.pagination.recordOffset = 0;
                 dataTable.showTableMessage("Reloading ...");
                 dataTable.getDataSource().sendRequest(
-                    '',
-                    {success: dataTable.onDataReturnInitializeTable,
+                    dataTable.get("generateRequest")(state, dataTable),
+                    {success: dataTable.onDataReturnSetRows,
+                     failure: dataTable.onDataReturnSetRows,
+                     argument: state,
                      scope: dataTable});
             });
         }
@@ -183,4 +441,4 @@
             }
         });
     });
-})();
\ No newline at end of file
+})();
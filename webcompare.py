@@ -2,27 +2,55 @@
 # encoding: utf-8
 from __future__ import absolute_import
 
+from array import array
+from collections import Counter, deque
+from itertools import chain
 from difflib import SequenceMatcher
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
-from urlparse import urlparse, urlunparse
+from StringIO import StringIO
+from urlparse import parse_qs, urlparse, urlunparse
+import BaseHTTPServer
+import email.utils
+import hashlib
+import heapq
 import httplib
+import io
 import json
 import logging
+import math
+import multiprocessing
 import os
+import random
 import re                       # "now you've got *two* problems"
+import socket
+import sqlite3
+import struct
 import sys
+import threading
 import time
 import unicodedata
+import urllib
 import urllib2
+import warnings
 
 import html5lib
+import html5lib.constants
+import html5lib.treebuilders
 
 from lxml.etree import XPath
 from lxml.html.clean import Cleaner
+import lxml.etree
 import lxml.html
 
 LOGGING_FORMAT = '%(asctime)s %(levelname)8s %(module)s.%(funcName)s: %(message)s'
 
+#: HTTP status codes which mean the server is overloaded and a retry may succeed
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+
+#: Exceptions fetching a page can raise which are recorded as an error result
+FETCH_ERRORS = (urllib2.URLError, httplib.HTTPException, socket.error)
+
 #: lxml Clean instance which removes things which are noisy for text comparison
 HTML_CLEANER = Cleaner(scripts=True, javascript=True, comments=True,
                        style=True, links=True, meta=True,
@@ -31,6 +59,22 @@ HTML_CLEANER = Cleaner(scripts=True, javascript=True, comments=True,
                        safe_attrs_only=True, add_nofollow=False,
                        whitelist_tags=set(['iframe', 'embed']))
 
+#: html5lib treebuilder which creates lxml nodes directly:
+LXML_TREEBUILDER = html5lib.treebuilders.getTreeBuilder("lxml")
+
+# lxml can't hold names like xml:lang or fb:like, so html5lib renames them
+# (e.g. to xmlU0003Alang) and warns every time; Response fixes up xml:*
+warnings.filterwarnings("ignore", category=html5lib.constants.DataLossWarning)
+
+#: html5lib puts SVG and MathML elements in these namespaces, but XPaths like
+#: //svg and lxml.html's link finding expect them without:
+FOREIGN_ELEMENTS = tuple("{%s}*" % html5lib.constants.namespaces[prefix]
+                         for prefix in ("svg", "mathml"))
+
+#: Attributes which lxml made us rename, e.g. xml:lang to xmlU0003Alang:
+COERCED_XML_ATTRIBUTES = XPath('//@*[starts-with(name(), "xmlU0003A")]')
+XML_NAMESPACE = html5lib.constants.namespaces["xml"]
+
 
 def collapse_whitespace(text):
     """Collapse multiple whitespace chars to a single space.
@@ -48,11 +92,197 @@ def normalize_unicode(text):
     return unicodedata.normalize("NFC", text)
 
 
+def get_mime_type(content_type):
+    """Return the lowercase type/subtype from a Content-Type header"""
+    return content_type.split(";", 1)[0].strip().lower()
+
+
 def clean_text(text):
     """Utility which performs routine text cleanup"""
     return collapse_whitespace(normalize_unicode(text))
 
 
+def combine_regexes(patterns, chunk_size=100):
+    """Return compiled regexes which between them match whatever one of
+    patterns would, combining the patterns into alternations so a string is
+    tested against a few regexes instead of hundreds. Patterns with inline
+    flags or numbered backreferences, which would change meaning inside an
+    alternation, are kept on their own.
+    """
+    regexes = []
+    combinable = []
+
+    for pattern in patterns:
+        # Compiling each one separately reports a bad pattern by itself:
+        regex = re.compile(pattern)
+        if re.search(r"\(\?[iLmsux]+\)|\\\d", pattern):
+            regexes.append(regex)
+        else:
+            combinable.append(pattern)
+
+    for i in range(0, len(combinable), chunk_size):
+        chunk = combinable[i:i + chunk_size]
+        try:
+            regexes.append(re.compile("|".join("(?:%s)" % pattern for pattern in chunk)))
+        except (re.error, AssertionError):
+            # Python 2 allows at most 100 groups in a regex:
+            regexes.extend(re.compile(pattern) for pattern in chunk)
+
+    return regexes
+
+
+def sequence_similarity(origin_text, target_text):
+    """Return difflib's similarity ratio: exact but worst-case quadratic"""
+    return SequenceMatcher(None, origin_text, target_text).ratio()
+
+
+def get_word_set(text):
+    """Return the set of words in text"""
+    return frozenset(text.split())
+
+
+def get_shingles(text, size=4):
+    """Return the set of runs of size consecutive words in text"""
+    words = text.split()
+
+    if len(words) <= size:
+        return set([u' '.join(words)])
+
+    return set(u' '.join(words[i:i + size]) for i in xrange(len(words) - size + 1))
+
+
+def get_minhash_sketch(text, sketch_size=128):
+    """Return a bottom-k MinHash sketch: the sketch_size smallest shingle hashes"""
+    return frozenset(heapq.nsmallest(sketch_size, set(hash(i) for i in get_shingles(text))))
+
+
+def jaccard_similarity(origin_words, target_words):
+    """Return the overlap of two sets of words.
+    This is linear time but ignores word order and repetition.
+    """
+    if not origin_words and not target_words:
+        return 1.0
+
+    return len(origin_words & target_words) / float(len(origin_words | target_words))
+
+
+def minhash_similarity(origin_sketch, target_sketch, sketch_size=128):
+    """Estimate the Jaccard similarity of two texts' shingles from their sketches.
+    Unlike jaccard_similarity this notices reordered text, but it's still
+    linear time; the error of the estimate is roughly 1 / sqrt(sketch_size).
+    """
+    union_sketch = set(heapq.nsmallest(sketch_size, origin_sketch | target_sketch))
+
+    return len(union_sketch & origin_sketch & target_sketch) / float(len(union_sketch))
+
+
+def sequence_upper_bounds(origin_text, target_text):
+    """Yield successively tighter, and costlier, upper bounds on sequence_similarity.
+    These are difflib's real_quick_ratio and quick_ratio.
+    """
+    total_length = float(len(origin_text) + len(target_text))
+
+    yield 2.0 * min(len(origin_text), len(target_text)) / total_length
+
+    common = Counter(origin_text) & Counter(target_text)
+    yield 2.0 * sum(common.itervalues()) / total_length
+
+
+class SimilarityEngine(object):
+    """Score two normalized texts between 0.0 and 1.0.
+    score works on whatever prepare reduces a text to (the text itself if
+    prepare is None), which lets Response cache the prepared form for every
+    comparator using the engine. upper_bounds optionally yields cheap upper
+    bounds on the score.
+    """
+    def __init__(self, name, score, prepare=None, upper_bounds=None):
+        self.name = name
+        self.score = score
+        self.prepare = prepare
+        self.upper_bounds = upper_bounds
+
+    def __call__(self, origin_text, target_text):
+        if self.prepare is not None:
+            origin_text = self.prepare(origin_text)
+            target_text = self.prepare(target_text)
+
+        return self.score(origin_text, target_text)
+
+
+#: Engines Comparator.fuzziness can use, by name
+SIMILARITY_ENGINES = dict((engine.name, engine) for engine in [
+    SimilarityEngine("sequence", sequence_similarity, upper_bounds=sequence_upper_bounds),
+    SimilarityEngine("jaccard", jaccard_similarity, prepare=get_word_set),
+    SimilarityEngine("minhash", minhash_similarity, prepare=get_minhash_sketch),
+])
+
+
+class MessageTable(object):
+    """Strings stored once and referred to by index, for messages which many
+    results repeat, like the html5lib errors every page of a template shares
+    """
+    def __init__(self):
+        self.messages = []
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def index(self, message):
+        """Return message's index, adding it if it's new"""
+        i = self.indexes.get(message)
+        if i is None:
+            with self.lock:
+                i = self.indexes.get(message)
+                if i is None:
+                    i = self.indexes[message] = len(self.messages)
+                    self.messages.append(message)
+        return i
+
+    def __getitem__(self, i):
+        return self.messages[i]
+
+    def __len__(self):
+        return len(self.messages)
+
+
+#: Every HTML error message any Result has held
+HTML_ERROR_MESSAGES = MessageTable()
+
+HTML_ERROR_FORMAT = u"Error at line %s col %s: %s"
+HTML_ERROR_RE = re.compile(r"Error at line (\d+) col (\d+): (.*)\Z", re.DOTALL)
+
+
+def pack_html_errors(errors, messages=HTML_ERROR_MESSAGES):
+    """Return a list of HTML error strings as an array of (line, col, message
+    index) triples, line being -1 for errors without a position, or None
+    """
+    if errors is None:
+        return None
+
+    packed = array("i")
+    for error in errors:
+        m = HTML_ERROR_RE.match(error)
+        if m is not None:
+            packed.extend((int(m.group(1)), int(m.group(2)), messages.index(m.group(3))))
+        else:
+            packed.extend((-1, -1, messages.index(error)))
+    return packed
+
+
+def unpack_html_errors(packed, messages=HTML_ERROR_MESSAGES):
+    """Return the list of HTML error strings from pack_html_errors"""
+    if packed is None:
+        return None
+
+    errors = []
+    for i in xrange(0, len(packed), 3):
+        line, col, message = packed[i:i + 3]
+        if line < 0:
+            errors.append(messages[message])
+        else:
+            errors.append(HTML_ERROR_FORMAT % (line, col, messages[message]))
+    return errors
+
+
 class Result(object):
     """Return origin and target URL, HTTP success code, redirect urls, performance error, comparator stats.
     The HTML errors are actually a list of reported errors, so we can popup details in the report.
@@ -60,7 +290,23 @@ class Result(object):
     Should I just create a Result upon origin retrieval,
     then add attributes to it as further progress is made?
     Instead of trying to do it once for each retrieval outcome?
+
+    A crawl can hold 100,000s of these so they're kept compact: there are
+    __slots__ rather than a dict, the HTML errors are packed against
+    HTML_ERROR_MESSAGES and, given url_prefixes (origin_url_base,
+    target_url_base), a target_url which is just origin_url moved to
+    target_url_base is worked out when it's asked for.
     """
+    __slots__ = ("origin_url", "origin_code", "origin_time", "_origin_html_errors",
+                 "_target_url", "_url_prefixes", "target_code", "target_time",
+                 "_target_html_errors", "comparisons", "origin_hash", "target_hash",
+                 "comparison_key", "timings")
+
+    #: The fields saved by to_dict, besides result_type
+    FIELDS = ("origin_url", "origin_code", "origin_time", "origin_html_errors",
+              "target_url", "target_code", "target_time", "target_html_errors",
+              "comparisons", "origin_hash", "target_hash", "comparison_key", "timings")
+
     def __init__(self,
                  origin_url,
                  origin_code,
@@ -70,20 +316,25 @@ class Result(object):
                  target_code=None,
                  target_time=None,
                  target_html_errors=None,
-                 comparisons={}):
+                 comparisons={},
+                 origin_hash=None,
+                 target_hash=None,
+                 comparison_key=None,
+                 timings=None,
+                 url_prefixes=None):
 
-        self.result_type = self.__class__.__name__
         self.origin_url = origin_url
         self.origin_code = int(origin_code)
         self.origin_time = origin_time
-        self.origin_html_errors = origin_html_errors
-        self.target_url = target_url
         self.target_code = target_code
         self.target_time = target_time
-        self.target_html_errors = target_html_errors
         self.comparisons = comparisons
-        if not isinstance(self.result_type, basestring):
-            raise TypeError("result_type must be a string")
+        self.origin_hash = origin_hash
+        self.target_hash = target_hash
+        #: Walker.get_comparison_key() of the settings comparisons were made with
+        self.comparison_key = comparison_key
+        #: Seconds spent in each stage, e.g. origin_ttfb, denoise or a comparator's name
+        self.timings = timings if timings is not None else {}
         if not isinstance(self.origin_url, basestring):
             raise TypeError("origin_url must be a string")
 
@@ -91,21 +342,93 @@ class Result(object):
             raise TypeError("origin_code=%s must be a int" % self.origin_code)
         if self.origin_time != None and type(self.origin_time) != float:
             raise TypeError("origin_time=%s must be a float" % self.origin_time)
-        if self.origin_html_errors != None and type(self.origin_html_errors) != list:
-            raise TypeError("origin_html_errors=%s must be a list (of errors)" % self.origin_html_errors)
-        if self.target_url != None and not hasattr(self.target_url, "lower"):
-            raise TypeError("target_url=%s must be a string" % self.target_url)
+        if origin_html_errors != None and type(origin_html_errors) != list:
+            raise TypeError("origin_html_errors=%s must be a list (of errors)" % origin_html_errors)
+        if target_url != None and not hasattr(target_url, "lower"):
+            raise TypeError("target_url=%s must be a string" % target_url)
         if self.target_code != None and type(self.target_code) != int:
             raise TypeError("target_code=%s must be a int" % self.target_code)
         if (self.target_time != None and type(self.target_time) != float):
             raise TypeError("target_time=%s must be a float" % self.target_time)
 
-        if self.target_html_errors != None and type(self.target_html_errors) != list:
-            raise TypeError("target_html_errors=%s must be an list (of errors)" % self.target_html_errors)
+        if target_html_errors != None and type(target_html_errors) != list:
+            raise TypeError("target_html_errors=%s must be an list (of errors)" % target_html_errors)
 
         if not isinstance(self.comparisons, dict):
             raise TypeError("comparisons=%s must be a dict" % self.comparisons)
 
+        if not isinstance(self.timings, dict):
+            raise TypeError("timings=%s must be a dict" % self.timings)
+
+        self.origin_html_errors = origin_html_errors
+        self.target_html_errors = target_html_errors
+        self._set_target_url(target_url, url_prefixes)
+
+    @property
+    def result_type(self):
+        return self.__class__.__name__
+
+    @property
+    def origin_html_errors(self):
+        return unpack_html_errors(self._origin_html_errors)
+
+    @origin_html_errors.setter
+    def origin_html_errors(self, errors):
+        self._origin_html_errors = pack_html_errors(errors)
+
+    @property
+    def target_html_errors(self):
+        return unpack_html_errors(self._target_html_errors)
+
+    @target_html_errors.setter
+    def target_html_errors(self, errors):
+        self._target_html_errors = pack_html_errors(errors)
+
+    @property
+    def target_url(self):
+        if self._url_prefixes is None:
+            return self._target_url
+        origin_url_base, target_url_base = self._url_prefixes
+        return target_url_base + self.origin_url[len(origin_url_base):]
+
+    @target_url.setter
+    def target_url(self, target_url):
+        self._set_target_url(target_url)
+
+    def _set_target_url(self, target_url, url_prefixes=None):
+        if (url_prefixes is not None and target_url is not None
+                and self.origin_url.startswith(url_prefixes[0])
+                and target_url == url_prefixes[1] + self.origin_url[len(url_prefixes[0]):]):
+            self._target_url = None
+            self._url_prefixes = url_prefixes
+        else:
+            self._target_url = target_url
+            self._url_prefixes = None
+
+    def count_html_errors(self):
+        """Return the number of (origin, target) HTML errors, None if not validated"""
+        return tuple(len(errors) / 3 if errors is not None else None
+                     for errors in (self._origin_html_errors, self._target_html_errors))
+
+    def to_dict(self):
+        """Return the fields as a dict for JSON, as result_from_dict reads them.
+        Fields which are None are left out and times are rounded to the
+        millisecond, to keep large result files down.
+        """
+        data = {"result_type": self.result_type}
+
+        for name in self.FIELDS:
+            value = getattr(self, name)
+            if value is None:
+                continue
+            if name in ("origin_time", "target_time"):
+                value = round(value, 3)
+            elif name == "timings":
+                value = dict((stage, round(t, 3)) for stage, t in value.items())
+            data[name] = value
+
+        return data
+
     def __str__(self):
         return "<%s o=%s oc=%s t=%s tc=%s comp=%s>" % (self.result_type,
                                                        self.origin_url,
@@ -116,19 +439,202 @@ class Result(object):
 
 
 class ErrorResult(Result):
-    pass
+    __slots__ = ()
 
 
 class BadOriginResult(Result):
-    pass
+    __slots__ = ()
 
 
 class BadTargetResult(Result):
-    pass
+    __slots__ = ()
 
 
 class GoodResult(Result):
-    pass
+    __slots__ = ()
+
+
+#: Result classes by result_type, for turning saved results back into objects
+RESULT_TYPES = dict((cls.__name__, cls) for cls in (ErrorResult, BadOriginResult,
+                                                    BadTargetResult, GoodResult))
+
+
+#: How much of a result file to read at a time
+RESULTS_CHUNK_SIZE = 1 << 20
+
+JSON_DOCUMENT_RE = re.compile(r'^\s*\{\s*"results"\s*:')
+COLUMNAR_DOCUMENT_RE = re.compile(r'^\s*\{\s*"columns"\s*:')
+NON_WHITESPACE_RE = re.compile(r"\S")
+
+
+class ResultListReader(object):
+    """Iterate over the resultlist of a webcompare JSON document, decoding one
+    result at a time from a buffer which only holds the current chunk
+    """
+    def __init__(self, f, buf="", chunk_size=RESULTS_CHUNK_SIZE):
+        self.f = f
+        self.buf = buf
+        self.pos = 0
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            raise ValueError("Unexpected end of file in resultlist")
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+
+    def _skip_past(self, token):
+        while True:
+            i = self.buf.find(token, self.pos)
+            if i != -1:
+                self.pos = i + len(token)
+                return
+            # Keep enough to match a token split across two chunks:
+            self.pos = max(self.pos, len(self.buf) - len(token) + 1)
+            self._fill()
+
+    def _peek(self):
+        """Skip whitespace and return the next character"""
+        while True:
+            m = NON_WHITESPACE_RE.search(self.buf, self.pos)
+            if m:
+                self.pos = m.start()
+                return self.buf[self.pos]
+            self.pos = len(self.buf)
+            self._fill()
+
+    def __iter__(self):
+        self._skip_past('"resultlist"')
+        self._skip_past("[")
+
+        if self._peek() == "]":
+            return
+
+        while True:
+            while True:
+                try:
+                    result, self.pos = self.decoder.raw_decode(self.buf, self.pos)
+                    break
+                except ValueError:
+                    # The result continues in the next chunk:
+                    self._fill()
+
+            yield result
+
+            c = self._peek()
+            self.pos += 1
+            if c == "]":
+                return
+            elif c != ",":
+                raise ValueError("Expected , or ] after a result but found %r" % c)
+            self._peek()
+
+
+def chain_lines(buf, f):
+    """Iterate over the lines of f as if buf had been read first"""
+    if buf:
+        lines = buf.splitlines(True)
+        last = lines.pop()
+        for line in lines:
+            yield line
+        if not last.endswith("\n"):
+            last += f.readline()
+        yield last
+
+    for line in f:
+        yield line
+
+
+def iter_jsonl_result_dicts(f, buf=""):
+    """Yield each result dict from --jsonl output, skipping the stats line"""
+    for line in chain_lines(buf, f):
+        if not line.strip():
+            continue
+
+        record = json.loads(line)
+        if "result_type" in record:
+            yield record
+        elif "stats" not in record:
+            raise ValueError("Expected a result or stats line but found %s" % line[:100])
+
+
+def iter_columnar_result_dicts(data, errors_filename=None):
+    """Yield each result dict from Walker.columnar_results output, reading
+    the HTML errors from errors_filename if it's given; otherwise only whether
+    there were any (as an empty list or None) is known
+    """
+    if errors_filename is None:
+        errors_file = None
+    else:
+        errors_file = open(errors_filename, "rb")
+
+    try:
+        for result in _iter_columns(data, errors_file):
+            yield result
+    finally:
+        if errors_file is not None:
+            errors_file.close()
+
+
+def _iter_columns(data, errors_file):
+    columns = data["columns"]
+    offsets = data.get("html_errors_offsets")
+    messages = data.get("html_error_messages")
+
+    for i in xrange(data["count"]):
+        result = dict((k, columns[k][i]) for k in ("origin_url", "origin_code", "origin_time",
+                                                   "target_url", "target_code", "target_time"))
+        result["result_type"] = data["result_types"][columns["result_type"][i]]
+        result["comparisons"] = dict((name, columns[name][i]) for name in data["comparators"]
+                                     if columns[name][i] is not None)
+
+        if result["target_url"] is None:
+            result["target_url"] = data["target_url_base"] + result["origin_url"][len(data["origin_url_base"]):]
+        elif result["target_url"] == "":
+            result["target_url"] = None
+
+        errors = {}
+        if errors_file is not None and offsets[i + 1] > offsets[i]:
+            errors = json.loads(errors_file.readline())
+
+        for side in ("origin", "target"):
+            if columns["%s_html_errors" % side][i] is None:
+                result["%s_html_errors" % side] = None
+            else:
+                result["%s_html_errors" % side] = unpack_html_errors(errors.get(side, []), messages)
+
+        yield result
+
+
+def iter_result_dicts(f):
+    """Yield each result dict from a file written by Walker.json_results,
+    --jsonl or --columnar, without loading more than one result at a time
+    unless it's columnar. The errors file next to a columnar one is read too.
+    """
+    buf = f.read(RESULTS_CHUNK_SIZE)
+
+    if JSON_DOCUMENT_RE.match(buf):
+        return iter(ResultListReader(f, buf))
+
+    if COLUMNAR_DOCUMENT_RE.match(buf):
+        data = json.loads(buf + f.read())
+        if data.get("html_errors_file") is None:
+            return iter_columnar_result_dicts(data)
+        if not hasattr(f, "name"):
+            raise ValueError("Columnar results must be read from their file to find %s"
+                             % data["html_errors_file"])
+        return iter_columnar_result_dicts(data, os.path.join(os.path.dirname(f.name),
+                                                             data["html_errors_file"]))
+
+    return iter_jsonl_result_dicts(f, buf)
+
+
+def result_from_dict(data, url_prefixes=None):
+    """Recreate a Result from its to_dict()"""
+    data = dict((str(k), v) for k, v in data.items())
+    return RESULT_TYPES[data.pop("result_type")](url_prefixes=url_prefixes, **data)
 
 
 class Response(object):
@@ -138,50 +644,158 @@ class Response(object):
     We could parse this and save contained URLs? Not generic enough?
     TODO: should subclass (undocumented) urllib2.urlopen() return object urllib.addinfourl ?
           instead of copying all its attrs into our own?
-    TODO: should we avid non-html content?
+
+    The body is read in chunks and kept only if its type is in body_types
+    (None allows all) and it's no bigger than max_body_size bytes. Other
+    bodies are just hashed as they stream past, or with hash_body=False not
+    downloaded at all, so a large PDF or video doesn't end up in memory.
     """
-    def __init__(self, http_response):
+    #: Bytes to read from the server at a time:
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, http_response, max_body_size=None, body_types=None, hash_body=True):
         self.http_response = http_response
         self.code = self.http_response.code
         self.url = self.http_response.geturl()
         self.content_type = self.http_response.headers['content-type']
-        self.content = self.http_response.read()
+
+        #: Seconds spent on each stage: dns, connect, ttfb, download and parse
+        self.timings = dict(getattr(http_response, "timings", {}))
+        #: SHA-1 of the body, unless we stopped reading it early
+        self.body_hash = None
+        #: True if we stopped reading because the body was over max_body_size
+        self.truncated = False
+        self.has_body = body_types is None or get_mime_type(self.content_type) in body_types
+
+        t = time.time()
+        if self.has_body or hash_body:
+            self.content, length = self._read_body(max_body_size)
+        else:
+            self.content, length = "", None
+            self.http_response.close()
+        self.timings.setdefault("download", time.time() - t)
         self._extracted_body = None
+        self._title = None
+        self._features = {}
 
-        self.htmltree = None
-        # Create a per-instance parser so callers can retrieve errors later:
-        self.parser = html5lib.HTMLParser()
+        # The tree and error list are only built if something asks for them:
+        self._htmltree = None
+        self._parsed = False
+        self._parser_errors = None
+        self.parser = None
 
         try:
             self.content_length = int(self.http_response.headers['content-length'])
         except KeyError:
-            self.content_length = len(self.content)
+            self.content_length = length
 
-        if self.content_type.startswith("text/html"):
-            # The double-parse is wasteful but difficult to avoid until
-            # https://bugs.launchpad.net/lxml/+bug/780642 is resolved in a way
-            # which both works and preserves use of lxml's HTML methods like
-            # make_links_absolute
+    def _read_body(self, max_body_size):
+        """Return the body (or "" if we aren't keeping it) and its length,
+        stopping once it's more than max_body_size bytes
+        """
+        chunks = []
+        digest = hashlib.sha1()
+        length = 0
+
+        while True:
+            chunk = self.http_response.read(self.CHUNK_SIZE)
+            if not chunk:
+                break
+
+            length += len(chunk)
+            if max_body_size is not None and length > max_body_size:
+                logging.warning("Stopped reading %s after %d bytes", self.url, max_body_size)
+                self.truncated = True
+                self.has_body = False
+                self.http_response.close()
+                return "", length
+
+            digest.update(chunk)
+            if self.has_body:
+                chunks.append(chunk)
+
+        self.body_hash = digest.hexdigest()
+        return "".join(chunks), length
+
+    @property
+    def is_html(self):
+        return self.has_body and self.content_type.startswith("text/html")
+
+    @property
+    def htmltree(self):
+        """The lxml.html tree for an HTML response or None, parsed on first use"""
+        if not self._parsed:
+            self._parsed = True
+
+            if self.is_html:
+                t = time.time()
+                self._htmltree = self._parse_html()
+                self.timings["parse"] = time.time() - t
+
+                if self.parser.errors:
+                    logging.info("Loaded HTML from %s with %d errors",
+                                 self.url, len(self.parser.errors))
 
-            html5 = self.parser.parse(self.content)
+                self._htmltree.make_links_absolute(self.url, resolve_base_href=True)
+
+        return self._htmltree
+
+    def _parse_html(self):
+        """Parse our content with html5lib straight into an lxml.html tree.
+        html5lib's lxml treebuilder creates its document with the default
+        parser, which is thread-local, so pointing that at an XHTMLParser for
+        the duration gives us lxml.html elements (with make_links_absolute et
+        al.) without serializing and reparsing the document.
+        """
+        # Create a per-instance parser so callers can retrieve errors later:
+        self.parser = html5lib.HTMLParser(tree=LXML_TREEBUILDER,
+                                          namespaceHTMLElements=False)
 
-            if self.parser.errors:
-                logging.info("Loaded HTML from %s with %d errors",
-                             self.url, len(self.parser.errors))
+        lxml.etree.set_default_parser(lxml.html.XHTMLParser())
+        try:
+            document = self.parser.parse(self.content)
+        finally:
+            lxml.etree.set_default_parser()
+
+        root = document.getroot()
+        self._restore_names(root)
+        return root
+
+    def _restore_names(self, root):
+        """Give names in root the shape a tree parsed by lxml.html has, so
+        noise XPaths and link finding work the same: SVG and MathML elements
+        and their attributes (e.g. xlink:href) lose their namespaces and
+        xml:lang et al. get the real XML namespace rather than a mangled name.
+        Unlike lxml.html, html5lib adds the <tbody> to tables which browsers do.
+        """
+        foreign = False
 
-            cleaned_html = html5lib.serializer.serialize(html5,
-                                                         encoding="utf-8")
+        for e in root.iter(*FOREIGN_ELEMENTS):
+            foreign = True
+            e.tag = lxml.etree.QName(e).localname
+            for name in [name for name in e.attrib if name.startswith("{")]:
+                e.set(lxml.etree.QName(name).localname, e.attrib.pop(name))
 
-            self.htmltree = lxml.html.document_fromstring(cleaned_html)
+        for attribute in COERCED_XML_ATTRIBUTES(root):
+            e = attribute.getparent()
+            e.set("{%s}%s" % (XML_NAMESPACE, attribute.attrname[len("xmlU0003A"):]),
+                  e.attrib.pop(attribute.attrname))
 
-            self.htmltree.make_links_absolute(self.url, resolve_base_href=True)
+        if foreign:
+            lxml.etree.cleanup_namespaces(root)
 
     def get_parser_errors(self):
         """Return an HTML tidy-like list of error strings"""
         from html5lib.constants import E
 
+        if self._parser_errors is not None:
+            return self._parser_errors
+
         errors = []
 
+        if self.htmltree is None:
+            return errors
+
         for pos, error_code, data in self.parser.errors:
 
             try:
@@ -189,11 +803,69 @@ class Response(object):
             except KeyError:
                 error_message = error_code
 
-            errors.append(u"Error at line %s col %s: %s" % (pos[0], pos[1],
-                                                            error_message))
+            errors.append(HTML_ERROR_FORMAT % (pos[0], pos[1], error_message))
 
+        self._parser_errors = errors
         return errors
 
+    def get_title(self):
+        """Return the cleaned text of the HTML <title> or None"""
+
+        if self._title is None:
+            try:
+                title = self.htmltree.xpath("//html/head/title")[0].text
+            except (IndexError, AttributeError):
+                return
+
+            if title is None:
+                return
+
+            self._title = clean_text(title)
+
+        return self._title
+
+    def get_feature(self, name, engine=None):
+        """Return the named text ("title", "body" or "content") normalized for
+        comparison, or if engine is given, in the form that engine.score uses.
+        Each is computed once per response, so comparators sharing a text or an
+        engine only pay for the comparison. Returns None if there's no such text.
+        """
+        key = (name, engine.name if engine is not None else None)
+
+        if key not in self._features:
+            if engine is not None:
+                text = self.get_feature(name)
+                if text is not None and engine.prepare is not None:
+                    text = engine.prepare(text)
+            else:
+                if name == "title":
+                    text = self.get_title()
+                elif name == "body":
+                    text = self.get_body_text()
+                elif name == "content":
+                    text = clean_text(self.content)
+                else:
+                    raise ValueError("Unknown feature %s" % name)
+
+                if text is not None:
+                    text = collapse_whitespace(text).lower()
+
+            self._features[key] = text
+
+        return self._features[key]
+
+    def get_content_hash(self, denoised=False):
+        """Return a hash of the normalized content, to tell whether it has changed.
+        If noise has been removed from our tree, pass denoised to hash what's
+        left of the tree instead, so changes to the noise don't count.
+        """
+        if denoised and self.htmltree is not None:
+            text = lxml.html.tostring(self.htmltree, encoding=unicode)
+        else:
+            text = self.get_feature("content")
+
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
     def get_body_text(self):
         """Return the HTML body's text"""
 
@@ -216,37 +888,1061 @@ class Response(object):
         return self._extracted_body
 
 
+class ConnectionPool(object):
+    """Idle HTTP/1.1 keep-alive connections, kept per scheme and host.
+    At most max_size idle connections are kept for each host and any which
+    have been idle longer than idle_timeout seconds are closed rather than reused.
+    """
+    def __init__(self, max_size=1, idle_timeout=30):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return an idle connection for key or None if there isn't a usable one"""
+        now = time.time()
+
+        with self.lock:
+            connections = self.idle.get(key, [])
+            while connections:
+                conn, last_used = connections.pop()
+                if now - last_used < self.idle_timeout:
+                    return conn
+                conn.close()
+
+        return None
+
+    def put(self, key, conn):
+        """Return conn to the pool once its response has been read completely"""
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.max_size:
+                connections.append((conn, time.time()))
+                return
+
+        conn.close()
+
+    def close(self):
+        """Close all idle connections"""
+        with self.lock:
+            for connections in self.idle.values():
+                for conn, last_used in connections:
+                    conn.close()
+            self.idle.clear()
+
+
+class PooledResponse(object):
+    """Wrap an httplib response so its connection goes back to the pool once
+    the body has been read to the end. A response closed before then might
+    have unread data on the wire so its connection is closed instead.
+    """
+    def __init__(self, response, release):
+        self.response = response
+        self._release = release
+
+    def release(self):
+        if self._release is not None:
+            self._release(self.response.will_close)
+            self._release = None
+
+    def recv(self, amt=None):
+        data = self.response.read(amt)
+        if self.response.isclosed():
+            self.release()
+        return data
+
+    read = recv
+
+    def close(self):
+        if self.response.length == 0 or self.response.isclosed():
+            # Nothing left on the wire, e.g. a 304:
+            self.release()
+        elif self._release is not None:
+            self._release(True)
+            self._release = None
+        self.response.close()
+
+
+class KeepAliveHandler(urllib2.HTTPHandler, urllib2.HTTPSHandler):
+    """urllib2 handler which reuses connections from a ConnectionPool
+    instead of opening a new TCP (and TLS) connection for every request.
+    """
+    def __init__(self, pool, debuglevel=0, context=None):
+        urllib2.HTTPSHandler.__init__(self, debuglevel=debuglevel, context=context)
+        self.pool = pool
+
+    def do_open(self, http_class, req, **http_conn_args):
+        if req._tunnel_host:
+            return urllib2.AbstractHTTPHandler.do_open(self, http_class, req, **http_conn_args)
+
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        key = (http_class.__name__, host)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers["Connection"] = "keep-alive"
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        conn = self.pool.get(key)
+        timings = {}
+
+        if conn is not None:
+            try:
+                t = time.time()
+                conn.request(req.get_method(), req.get_selector(), req.data, headers)
+                r = conn.getresponse(buffering=True)
+                timings["ttfb"] = time.time() - t
+            except (socket.error, httplib.HTTPException):
+                # The server most likely closed the idle connection so we'll
+                # retry once on a fresh one:
+                logging.debug("Discarding stale connection to %s", host)
+                conn.close()
+                conn = None
+
+        if conn is None:
+            conn = http_class(host, timeout=req.timeout, **http_conn_args)
+            conn.set_debuglevel(self._debuglevel)
+            try:
+                self._connect(conn, timings)
+                t = time.time()
+                conn.request(req.get_method(), req.get_selector(), req.data, headers)
+                r = conn.getresponse(buffering=True)
+                timings["ttfb"] = time.time() - t
+            except socket.error, err:
+                conn.close()
+                raise urllib2.URLError(err)
+
+        def release(close):
+            if close:
+                conn.close()
+            else:
+                self.pool.put(key, conn)
+
+        fp = socket._fileobject(PooledResponse(r, release), close=True)
+
+        resp = urllib.addinfourl(fp, r.msg, req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason
+        resp.timings = timings
+        return resp
+
+    def _connect(self, conn, timings):
+        """Open conn's socket, recording how long the DNS lookup and connecting took.
+        HTTPS connections look up, connect and handshake in one step so they
+        only get a connect time.
+        """
+        if isinstance(conn, httplib.HTTPSConnection):
+            t = time.time()
+            conn.connect()
+            timings["connect"] = time.time() - t
+            return
+
+        t = time.time()
+        addresses = socket.getaddrinfo(conn.host, conn.port, 0, socket.SOCK_STREAM)
+        timings["dns"] = time.time() - t
+
+        t = time.time()
+        for family, socktype, proto, canonname, sockaddr in addresses:
+            try:
+                conn.sock = socket.create_connection(sockaddr[:2], conn.timeout,
+                                                     conn.source_address)
+                break
+            except socket.error as err:
+                pass
+        else:
+            raise err
+        timings["connect"] = time.time() - t
+
+    def http_open(self, req):
+        return self.do_open(httplib.HTTPConnection, req)
+
+    def https_open(self, req):
+        return self.do_open(httplib.HTTPSConnection, req, context=self._context)
+
+
+class HostThrottle(object):
+    """Paces and limits the requests made to one server, backing off when it struggles.
+    Requests start at most rate times a second (None for no limit) and at most
+    limit of them run at once. limit starts at max_concurrency and is halved
+    when a request fails with a transient error, then grows back by one for
+    every limit requests which go smoothly, like TCP congestion control. Once
+    limit is down to one, requests are spaced out further instead.
+
+    If latency_factor is set, a request taking more than latency_factor times
+    the server's moving average latency also counts as a sign of overload.
+    That's off by default: pages of very different sizes make latency a noisy
+    signal.
+    """
+    #: Latencies below this are too noisy to be a sign of an overloaded server
+    MIN_LATENCY = 0.05
+    #: Weight of each new request in the moving average latency
+    LATENCY_WEIGHT = 0.2
+    #: Bounds of the extra seconds between requests when backing off below one at a time
+    MIN_DELAY = 0.05
+    MAX_DELAY = 1
+
+    def __init__(self, rate=None, max_concurrency=1, latency_factor=None):
+        self.rate = rate
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.latency_factor = latency_factor
+        self.delay = 0
+        self.active = 0
+        self.latency = None
+        self.next_start = 0
+        self.paused_until = 0
+        self.backed_off_at = 0
+        self.backoffs = 0
+        self.failures = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Wait for a free slot and our turn under the rate limit"""
+        with self.condition:
+            while self.active >= int(self.limit):
+                self.condition.wait()
+            self.active += 1
+
+            start = max(time.time(), self.next_start, self.paused_until)
+            interval = max(1.0 / self.rate if self.rate else 0, self.delay)
+            self.next_start = start + interval
+
+        delay = start - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def release(self, latency=None, failed=False):
+        """Finish a request which took latency seconds, adapting the limit to
+        whether it failed or was slow
+        """
+        with self.condition:
+            self.active -= 1
+            slow = self._is_slow(latency)
+
+            if latency is not None:
+                if self.latency is None:
+                    self.latency = latency
+                else:
+                    self.latency += self.LATENCY_WEIGHT * (latency - self.latency)
+
+            if failed:
+                self.failures += 1
+
+            if failed or slow:
+                self._back_off()
+            elif self.delay:
+                self.delay = self.delay / 2 if self.delay > self.MIN_DELAY else 0
+            elif self.limit < self.max_concurrency:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+
+            self.condition.notify_all()
+
+    def pause(self, seconds):
+        """Start no requests for seconds, e.g. when the server sent Retry-After"""
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+
+    def _is_slow(self, latency):
+        return (self.latency_factor is not None and latency is not None and self.latency is not None
+                and latency > self.latency_factor * max(self.latency, self.MIN_LATENCY))
+
+    def _back_off(self):
+        now = time.time()
+        # At most once per round trip, so one bad patch doesn't collapse the limit:
+        if now - self.backed_off_at < (self.latency or 0):
+            return
+        self.backed_off_at = now
+        self.backoffs += 1
+
+        if self.limit >= 2:
+            self.limit = self.limit / 2
+        else:
+            self.limit = 1.0
+            self.delay = min(self.MAX_DELAY, max(self.MIN_DELAY, self.delay * 2))
+
+    def summary(self):
+        """Return the current limits and how often we've backed off"""
+        with self.condition:
+            return {"limit": int(self.limit), "delay": round(self.delay, 3),
+                    "latency": round(self.latency or 0, 3),
+                    "backoffs": self.backoffs, "failures": self.failures}
+
+
+def is_transient_error(e):
+    """Return whether retrying later might avoid e: an overloaded server's
+    429/502/503/504, a refused, dropped or timed out connection or a garbled
+    status line from a stale keep-alive connection
+    """
+    if isinstance(e, urllib2.HTTPError):
+        return e.code in RETRY_STATUS_CODES
+    if isinstance(e, urllib2.URLError):
+        e = e.reason
+    # A host which doesn't resolve won't start to:
+    return (isinstance(e, (httplib.HTTPException, socket.error))
+            and not isinstance(e, socket.gaierror))
+
+
+def get_retry_after(e):
+    """Return the seconds an HTTPError's Retry-After header asks us to wait, or None"""
+    headers = getattr(e, "hdrs", None)
+    value = headers.get("retry-after") if headers is not None else None
+    if not value:
+        return None
+
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0, email.utils.mktime_tz(date) - time.time())
+
+
+class ExtractedResponse(Response):
+    """Picklable copy of the parts of a Response which comparators use.
+    The text is extracted (and the tree thrown away) in the calling process
+    so comparisons can be shipped to another process.
+    """
+    def __init__(self, response):
+        self.code = response.code
+        self.url = response.url
+        self.content_type = response.content_type
+        self.content = response.content
+        self.content_length = response.content_length
+        self.timings = {}
+        self.body_hash = response.body_hash
+        self.truncated = response.truncated
+        self.has_body = response.has_body
+        self._title = response.get_title()
+        self._extracted_body = response.get_body_text()
+        self._features = {}
+
+        self._htmltree = None
+        self._parsed = True
+        self._parser_errors = None
+        self.parser = None
+
+
+def run_comparators(comparators, origin_response, target_response):
+    """Return dicts of each comparator's class name and its score for the two
+    responses, and of the seconds each comparator took.
+    """
+    comparisons = {}
+    timings = {}
+
+    for comparator in comparators:
+        name = comparator.__class__.__name__
+        t = time.time()
+        comparisons[name] = comparator.compare(origin_response, target_response)
+        timings[name] = time.time() - t
+
+    return comparisons, timings
+
+
+class TimingHistogram(object):
+    """Fixed-memory summary of a stage's durations for estimating percentiles.
+    Samples are counted in logarithmic buckets GROWTH apart so a percentile
+    is accurate to within about 5% however many pages were crawled.
+    """
+    GROWTH = 1.05
+    MINIMUM = 1e-6
+
+    def __init__(self):
+        self.buckets = Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+        if seconds <= self.MINIMUM:
+            self.buckets[0] += 1
+        else:
+            self.buckets[int(math.ceil(math.log(seconds / self.MINIMUM, self.GROWTH)))] += 1
+
+    def percentile(self, p):
+        """Return the p-th percentile, or None if there are no samples"""
+        if not self.count:
+            return None
+
+        rank = max(1, int(math.ceil(p / 100.0 * self.count)))
+        seen = 0
+
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.MINIMUM * self.GROWTH ** bucket, self.max)
+
+    def summary(self):
+        return {"count": self.count,
+                "mean": self.total / self.count if self.count else None,
+                "p50": self.percentile(50),
+                "p95": self.percentile(95),
+                "p99": self.percentile(99),
+                "max": self.max}
+
+
+class BloomFilter(object):
+    """Fixed-size probabilistic set for remembering URLs on very large crawls.
+    Memory use depends only on capacity and error_rate. Once capacity items
+    have been added, about error_rate of the URLs we haven't seen will be
+    reported as seen (and so not crawled); a URL which was added is never missed.
+    """
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, int(round(math.log(2) * self.num_bits / capacity)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        if isinstance(item, unicode):
+            item = item.encode("utf-8")
+        h1, h2 = struct.unpack("<QQ", hashlib.md5(item).digest())
+        return [(h1 + i * h2) % self.num_bits for i in xrange(self.num_hashes)]
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(item))
+
+    def __len__(self):
+        return self.count
+
+
+class Checkpoint(object):
+    """SQLite record of a crawl's frontier and finished results.
+    Every URL added to the frontier gets a row, in order, and its result is
+    saved there once finished, so an interrupted walk can be resumed with the
+    unfinished URLs without refetching the finished ones. Changes are committed
+    every interval results.
+    """
+    def __init__(self, filename, interval=100, resume=False):
+        self.filename = filename
+        self.interval = interval
+        self.uncommitted = 0
+
+        self.db = sqlite3.connect(filename)
+        self.db.execute("CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, result TEXT)")
+        if not resume:
+            self.db.execute("DELETE FROM urls")
+        self.db.commit()
+
+    def load(self):
+        """Return a list of (url, result dict or None) in frontier order"""
+        return [(url, json.loads(result) if result is not None else None)
+                for url, result in self.db.execute("SELECT url, result FROM urls ORDER BY rowid")]
+
+    def add_url(self, url):
+        self.db.execute("INSERT OR IGNORE INTO urls (url) VALUES (?)", (url, ))
+
+    def add_result(self, result):
+        self.db.execute("UPDATE urls SET result = ? WHERE url = ?",
+                        (json.dumps(result.to_dict(), sort_keys=True), result.origin_url))
+
+        self.uncommitted += 1
+        if self.uncommitted >= self.interval:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+class ResponseCache(object):
+    """SQLite cache of successful HTTP responses, keyed by requested URL.
+    Entries are revalidated with If-None-Match/If-Modified-Since by the caller
+    and the least recently used are evicted once the bodies take up more than
+    max_size bytes.
+
+    The total size is kept in memory rather than summed on every put, and
+    cache hits only update last_used in memory until a put which needs to
+    evict, or close, writes them out in one go.
+    """
+    #: Write out last_used times anyway once this many hits have built up
+    FLUSH_INTERVAL = 1000
+    #: Rows to look at at a time when evicting
+    EVICT_BATCH = 100
+
+    def __init__(self, filename, max_size=1024 * 1024 * 1024):
+        self.filename = filename
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        #: url: last_used for hits not yet written to the database
+        self.touched = {}
+
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS responses (
+                               url TEXT PRIMARY KEY, final_url TEXT, code INTEGER,
+                               headers TEXT, body BLOB, size INTEGER, last_used REAL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.db.commit()
+        self.total_size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, url):
+        """Return a urlopen()-style response for url from the cache or None"""
+        with self.lock:
+            row = self.db.execute("SELECT final_url, code, headers, body FROM responses WHERE url = ?",
+                                  (url, )).fetchone()
+            if row is None:
+                return None
+
+            self.touched[url] = time.time()
+            if len(self.touched) >= self.FLUSH_INTERVAL:
+                self._flush()
+                self.db.commit()
+
+        final_url, code, headers, body = row
+        return urllib.addinfourl(StringIO(str(body)),
+                                 httplib.HTTPMessage(StringIO(headers.encode("latin-1"))),
+                                 final_url, code)
+
+    def put(self, url, http_response, body):
+        """Store body and the status and headers of http_response for url"""
+        headers = "".join(http_response.headers.headers) + "\r\n"
+
+        with self.lock:
+            old = self.db.execute("SELECT size FROM responses WHERE url = ?", (url, )).fetchone()
+            self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (url, http_response.geturl(), http_response.code,
+                             headers.decode("latin-1"), sqlite3.Binary(body), len(body),
+                             time.time()))
+            self.touched.pop(url, None)
+            self.total_size += len(body) - (old[0] if old is not None else 0)
+            if self.total_size > self.max_size:
+                self._flush()
+                self._evict()
+            self.db.commit()
+
+    def _flush(self):
+        if self.touched:
+            self.db.executemany("UPDATE responses SET last_used = ? WHERE url = ?",
+                                [(last_used, url) for url, last_used in self.touched.items()])
+            self.touched.clear()
+
+    def _evict(self):
+        while self.total_size > self.max_size:
+            rows = self.db.execute("SELECT url, size FROM responses ORDER BY last_used LIMIT ?",
+                                   (self.EVICT_BATCH, )).fetchall()
+            if not rows:
+                self.total_size = 0
+                return
+
+            for url, size in rows:
+                self.db.execute("DELETE FROM responses WHERE url = ?", (url, ))
+                self.total_size -= size
+                if self.total_size <= self.max_size:
+                    return
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.db.commit()
+            self.db.close()
+
+
+class ShardSpool(object):
+    """Hands URLs between the shards of a crawl split with --shard.
+    Each URL belongs to exactly one of count shards, chosen by a hash of the
+    URL so every process agrees without talking to the others. URLs found for
+    another shard are appended to that shard's file in directory, and its
+    owner picks them up from there.
+
+    Each shard also keeps a state file saying whether it's busy, idle or done
+    and how much of its URL file it has read. The crawl is finished once every
+    shard is idle (or done) and has read everything sent to it: an idle shard
+    sends nothing until it reads a new URL, so nothing can wake them again.
+
+    Our own state file, or any shard being done, can only be left over from
+    an earlier crawl, whose URLs would leak into this one, so that's a
+    ValueError unless we're resuming.
+    """
+    def __init__(self, directory, index, count, resume=False):
+        self.directory = directory
+        self.index = index
+        self.count = count
+        self.outboxes = {}
+        self.partial_line = ""
+
+        if not resume and (os.path.exists(self._get_state_path(index))
+                           or any(self.get_state(i)[0] == "done" for i in range(count))):
+            raise ValueError("%s holds the files of an earlier crawl: empty it, or pass "
+                             "--resume to carry on with that crawl" % directory)
+
+        open(self._get_path(index), "ab").close()
+        self.inbox = io.open(self._get_path(index), "rb")
+        self.set_state("busy")
+
+    def _get_path(self, index):
+        return os.path.join(self.directory, "shard-%d-of-%d.urls" % (index + 1, self.count))
+
+    def _get_state_path(self, index):
+        return os.path.join(self.directory, "shard-%d-of-%d.state" % (index + 1, self.count))
+
+    def set_state(self, state):
+        """Tell the other shards we're busy, idle or done, and how much of our
+        URL file we've read
+        """
+        path = self._get_state_path(self.index)
+        with open(path + ".tmp", "wb") as f:
+            f.write("%s %d\n" % (state, self.inbox.tell()))
+        os.rename(path + ".tmp", path)
+
+    def get_state(self, index):
+        """Return the state and read offset shard index last reported, or (None, 0)"""
+        try:
+            with open(self._get_state_path(index), "rb") as f:
+                state, offset = f.read().split()
+        except (IOError, ValueError):
+            return None, 0
+        return state, int(offset)
+
+    def is_finished(self):
+        """Return True if every shard is idle and has read all the URLs sent to it"""
+        # Read every state before any URL file, so a URL sent by a shard
+        # after we saw it busy still shows up as unread below
+        states = [self.get_state(index) for index in range(self.count)]
+
+        if any(state not in ("idle", "done") for state, offset in states):
+            return False
+
+        for index, (state, offset) in enumerate(states):
+            path = self._get_path(index)
+            if os.path.exists(path) and os.path.getsize(path) != offset:
+                return False
+
+        return True
+
+    def owner(self, url):
+        if isinstance(url, unicode):
+            url = url.encode("utf-8")
+        return int(hashlib.md5(url).hexdigest()[:8], 16) % self.count
+
+    def owns(self, url):
+        return self.owner(url) == self.index
+
+    def send(self, url):
+        """Pass url to the shard which owns it"""
+        owner = self.owner(url)
+
+        if owner not in self.outboxes:
+            self.outboxes[owner] = open(self._get_path(owner), "ab")
+
+        if isinstance(url, unicode):
+            url = url.encode("utf-8")
+
+        self.outboxes[owner].write(url + "\n")
+        self.outboxes[owner].flush()
+
+    def receive(self):
+        """Return the URLs other shards have sent us since the last call"""
+        lines = (self.partial_line + self.inbox.read()).split("\n")
+        self.partial_line = lines.pop()
+        return [line.decode("utf-8") for line in lines if line]
+
+    def close(self):
+        self.inbox.close()
+        for outbox in self.outboxes.values():
+            outbox.close()
+
+
+#: Noise expressions simple enough to test on each element in one walk over
+#: the tree: //tag, //tag[@attr], //tag[@attr="value"] and
+#: //tag[contains(@attr, "value")], where tag may be *
+SIMPLE_XPATH_RE = re.compile(r"""^//(?P<tag>[\w-]+|\*)(?:\[(?:
+                                   @(?P<attr>[\w:-]+)(?:\s*=\s*(?P<q1>["'])(?P<value>.*?)(?P=q1))?
+                                   |contains\(\s*@(?P<contains_attr>[\w:-]+)\s*,
+                                              \s*(?P<q2>["'])(?P<substring>.*?)(?P=q2)\s*\)
+                                 )\])?$""", re.VERBOSE)
+
+
+class NoiseTables(object):
+    """A run of simple noise expressions (see SIMPLE_XPATH_RE), kept in
+    tables by tag and attribute so one walk over a tree tests them all
+    """
+    def __init__(self):
+        #: Tags removed outright, and tags for each attribute or (attribute, value):
+        self.tags = set()
+        self.attrs = {}
+        self.attr_values = {}
+        #: (attribute, substring, tag) for contains():
+        self.contains = []
+
+    def add(self, m):
+        """Add the expression SIMPLE_XPATH_RE matched as m"""
+        if m.group("contains_attr"):
+            self.contains.append((m.group("contains_attr"), m.group("substring"), m.group("tag")))
+        elif m.group("value") is not None:
+            self.attr_values.setdefault((m.group("attr"), m.group("value")), set()).add(m.group("tag"))
+        elif m.group("attr"):
+            self.attrs.setdefault(m.group("attr"), set()).add(m.group("tag"))
+        else:
+            self.tags.add(m.group("tag"))
+
+    def is_noise(self, e):
+        tag = e.tag
+
+        if tag in self.tags or "*" in self.tags:
+            return True
+
+        for attr, value in e.items():
+            for tags in (self.attrs.get(attr), self.attr_values.get((attr, value))):
+                if tags and (tag in tags or "*" in tags):
+                    return True
+
+        for attr, substring, contains_tag in self.contains:
+            if (contains_tag == "*" or contains_tag == tag) and substring in e.get(attr, ""):
+                return True
+
+        return False
+
+    def __call__(self, tree):
+        """Return the elements of tree which match, like an XPath"""
+        return [e for e in tree.iter(lxml.etree.Element) if self.is_noise(e)]
+
+
+class NoiseFilter(object):
+    """Removes the elements matching a list of XPath expressions from HTML trees.
+
+    Each expression only sees what the ones before it left, as if they were
+    evaluated and removed one at a time. Expressions like //script,
+    //*[@id="ads"] or //div[contains(@class, "nav")] only look at an element's
+    own tag and attributes, so a run of them is looked up in NoiseTables while
+    walking the tree once. Anything more complicated, e.g. //div[2] or
+    //div[p], depends on what's been removed already and is evaluated by
+    itself in its turn.
+
+    With timed=True each expression is instead evaluated separately and the
+    seconds and matches for each are totalled in timings, to find the
+    expensive ones.
+    """
+    def __init__(self, expressions, timed=False):
+        self.expressions = [e.strip() for e in expressions if e.strip()]
+        self.timed = timed
+        #: expression: [seconds, matches], when timed
+        self.timings = dict((e, [0.0, 0]) for e in self.expressions)
+        self.lock = threading.Lock()
+
+        # Compiling each one separately reports a bad expression by itself:
+        self.xpaths = [(e, XPath(e)) for e in self.expressions]
+
+        #: NoiseTables for each run of simple expressions and the XPath of
+        #: each other expression, to be applied in order
+        self.passes = []
+
+        for expression, xpath in self.xpaths:
+            m = SIMPLE_XPATH_RE.match(expression)
+            if m is None:
+                self.passes.append(xpath)
+            else:
+                if not self.passes or not isinstance(self.passes[-1], NoiseTables):
+                    self.passes.append(NoiseTables())
+                self.passes[-1].add(m)
+
+    def remove(self, tree):
+        """Remove the noise from tree"""
+        if self.timed:
+            self._remove_timed(tree)
+        else:
+            for find in self.passes:
+                self._remove_all(find(tree))
+
+    def _remove_all(self, matches):
+        for e in matches:
+            # Already removed with an ancestor, or the root:
+            parent = e.getparent()
+            if parent is not None:
+                parent.remove(e)
+
+    def _remove_timed(self, tree):
+        for expression, xpath in self.xpaths:
+            t = time.time()
+            found = xpath(tree)
+            elapsed = time.time() - t
+
+            with self.lock:
+                self.timings[expression][0] += elapsed
+                self.timings[expression][1] += len(found)
+
+            self._remove_all(found)
+
+    def get_timings(self):
+        """Return {expression: {"seconds": total, "matches": total}}"""
+        with self.lock:
+            return dict((e, {"seconds": seconds, "matches": matches})
+                        for e, (seconds, matches) in self.timings.items())
+
+
+class SynchronousResult(object):
+    """Already-computed stand-in for the AsyncResult returned by a pool"""
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+class SynchronousPool(object):
+    """Pool lookalike which runs each call immediately in the calling thread"""
+    def apply_async(self, func, args=()):
+        return SynchronousResult(func(*args))
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+
+class GreenletPool(object):
+    """Pool lookalike which runs each call in a gevent greenlet.
+    Greenlets are cheap enough to keep thousands of requests in flight; the
+    standard library must have been monkey-patched for them to cooperate.
+    """
+    def __init__(self, size):
+        from gevent.pool import Pool
+        self.pool = Pool(size)
+
+    def apply_async(self, func, args=()):
+        return self.pool.spawn(func, *args)
+
+    def close(self):
+        pass
+
+    def join(self):
+        self.pool.join()
+
+
 class Walker(object):
     """
     Walk origin URL, generate target URLs, retrieve both pages for comparison.
     """
 
-    def __init__(self, origin_url_base, target_url_base, ignoreres=[]):
+    def __init__(self, origin_url_base, target_url_base, ignoreres=[], concurrency=1,
+                 origin_urls_seen=None):
         """Specify origin_url and target_url to compare.
         e.g.: w = Walker("http://oldsite.com", "http://newsite.com")
+        concurrency is the number of origin/target pairs fetched at once.
+        origin_urls_seen remembers every URL ever queued; it defaults to a set
+        but anything with add() and __contains__, like a BloomFilter, will do.
         TODO:
         - Limit to subtree of origin  like http://oldsite.com/forums/
         """
         self.origin_url_base = origin_url_base
         self.target_url_base = target_url_base
         self.target_url_parts = urlparse(target_url_base)
+        #: Shared by every Result whose target_url is derived from its origin_url
+        self.url_prefixes = (origin_url_base, target_url_base)
         self.comparators = []
         self.results = []
-        self.origin_urls_todo = [self.origin_url_base]
-        self.origin_urls_visited = []
-        self.ignoreres = [re.compile(ignorere) for ignorere in ignoreres]
-        self.origin_noise_xpaths = []
-        self.target_noise_xpaths = []
+        self.stats = {}
+        #: If set, results are written here as JSON lines instead of kept in self.results
+        self.result_stream = None
+        #: If set, a Checkpoint which the frontier and results are saved to
+        self.checkpoint = None
+        #: If set, a ResponseCache used and revalidated by _fetch_url
+        self.response_cache = None
+        #: Serve origin pages only from response_cache, never the network
+        self.origin_frozen = False
+        #: origin_url: (origin_hash, target_hash, comparison_key, comparisons) from an earlier run
+        self.previous_results = {}
+        #: Save content hashes with the results, so a later run can reuse their comparisons
+        self.record_hashes = False
+        #: stage name: TimingHistogram of every recorded result's timings
+        self.timing_histograms = {}
+        #: If set, a ShardSpool: we only crawl the URLs it says we own
+        self.shard_spool = None
+        self.shard_idle_timeout = None
+        self.shard_poll_interval = 1
+        self.origin_urls_todo = deque([self.origin_url_base])
+        self.origin_urls_visited = 0
+        if origin_urls_seen is None:
+            origin_urls_seen = set()
+        self.origin_urls_seen = origin_urls_seen
+        self.origin_urls_seen.add(self.origin_url_base)
+        self.ignoreres = combine_regexes(ignoreres)
+        #: link: normalized URL, or None if we won't crawl it
+        self._link_cache = {}
+        self.link_cache_size = 100000
+        #: Responses bigger than this many bytes are abandoned (None for no limit)
+        self.max_body_size = None
+        #: Content types whose bodies are kept, or None for all of them
+        self.body_types = None
+        #: Whether to download other bodies to hash them, or close the connection
+        self.hash_bodies = True
+        self.asset_comparator = AssetComparator()
+        #: NoiseFilters for elements to remove before comparing, or None
+        self.origin_noise = None
+        self.target_noise = None
+        self.concurrency = max(1, int(concurrency))
+        self.use_gevent = False
+        self.validate_html = True
+        self.comparison_processes = 0
+        self._comparison_pool = None
+        self.max_connections_per_host = None
+        #: Requests per second to start on each side, or None for no limit
+        self.origin_rate = None
+        self.target_rate = None
+        #: Most requests in flight on each side, or None for concurrency
+        self.origin_concurrency = None
+        self.target_concurrency = None
+        #: Transient failures are retried this many times, after exponential
+        #: backoff from retry_backoff seconds or the server's Retry-After
+        self.max_retries = 2
+        self.retry_backoff = 1.0
+        self.max_retry_delay = 60
+        #: If set, also back off when a request takes this many times a side's average latency
+        self.latency_backoff = None
+        self._throttles = {}
+        self.connection_pool = ConnectionPool(max_size=self.concurrency)
+        self.opener = urllib2.build_opener(KeepAliveHandler(self.connection_pool))
+        self._host_semaphores = {}
+        self._host_semaphores_lock = threading.Lock()
 
     def _texas_ranger(self):
         return "I think our next place to search is where military and wannabe military types hang out."
 
+    def _get_host_semaphore(self, url):
+        """Return the semaphore limiting concurrent requests to url's host"""
+        host = urlparse(url).netloc
+
+        with self._host_semaphores_lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = threading.BoundedSemaphore(self.max_connections_per_host)
+            return self._host_semaphores[host]
+
+    def _get_throttle(self, url):
+        """Return the HostThrottle pacing requests to url's side, origin or target"""
+        side = "origin" if self._is_within_origin(url) else "target"
+
+        with self._host_semaphores_lock:
+            if side not in self._throttles:
+                self._throttles[side] = HostThrottle(
+                    rate=getattr(self, "%s_rate" % side),
+                    max_concurrency=getattr(self, "%s_concurrency" % side) or self.concurrency,
+                latency_factor=self.latency_backoff)
+            return self._throttles[side]
+
     def _fetch_url(self, url):
         """Retrieve a page by URL, return as Response object (code, content, htmltree, etc)
         This could be overriden, e.g., to use an asynchronous call.
-        If this causes an exception, we just leave it for the caller.
+        Transient failures are retried up to max_retries times; if this still
+        causes an exception, we just leave it for the caller.
         """
-        return Response(urllib2.urlopen(url))
+        throttle = self._get_throttle(url)
+        attempt = 0
+
+        while True:
+            throttle.acquire()
+            t = time.time()
+            transient = False
+            try:
+                if self.max_connections_per_host:
+                    with self._get_host_semaphore(url):
+                        return self._make_response(self._open_url(url))
+                else:
+                    return self._make_response(self._open_url(url))
+            except FETCH_ERRORS as e:
+                transient = is_transient_error(e)
+                if not transient or attempt >= self.max_retries:
+                    raise
+            finally:
+                throttle.release(time.time() - t, failed=transient)
+
+            if isinstance(e, urllib2.HTTPError):
+                e.close()
+
+            retry_after = get_retry_after(e)
+            if retry_after is not None:
+                # The server told us when it'll want *any* request from us again:
+                throttle.pause(min(retry_after, self.max_retry_delay))
+            else:
+                # Full jitter, so workers which failed together don't retry together:
+                time.sleep(random.uniform(0, min(self.max_retry_delay,
+                                                 self.retry_backoff * 2 ** attempt)))
+
+            attempt += 1
+            logging.warning("Retrying %s (attempt %d) after %s", url, attempt, e)
+
+    def _make_response(self, http_response):
+        return Response(http_response, max_body_size=self.max_body_size,
+                        body_types=self.body_types, hash_body=self.hash_bodies)
+
+    def _keeps_body(self, http_response):
+        return (self.body_types is None
+                or get_mime_type(http_response.headers.get("content-type", "")) in self.body_types)
+
+    def _open_url(self, url):
+        """Return a urlopen()-style response for url, from response_cache if we
+        have one and the server says our copy is still current
+        """
+        if self.response_cache is None:
+            return self.opener.open(url)
+
+        cached = self.response_cache.get(url)
+
+        if self.origin_frozen and self._is_within_origin(url):
+            if cached is None:
+                raise urllib2.URLError("%s is not in the response cache" % url)
+            return cached
+
+        request = urllib2.Request(url)
+
+        if cached is not None:
+            if "etag" in cached.headers:
+                request.add_header("If-None-Match", cached.headers["etag"])
+            if "last-modified" in cached.headers:
+                request.add_header("If-Modified-Since", cached.headers["last-modified"])
+
+        try:
+            http_response = self.opener.open(request)
+        except urllib2.HTTPError as e:
+            if e.code == 304 and cached is not None:
+                logging.debug("Using cached copy of %s", url)
+                # Reading the empty body returns the connection to the pool:
+                e.read()
+                e.close()
+                return cached
+            raise
+
+        if not self._keeps_body(http_response):
+            # Response will hash or skip it as it streams past, uncached:
+            return http_response
+
+        t = time.time()
+        if self.max_body_size is None:
+            body = http_response.read()
+        else:
+            # One byte more tells Response this is over the limit:
+            body = http_response.read(self.max_body_size + 1)
+        timings = dict(getattr(http_response, "timings", {}), download=time.time() - t)
+        http_response.close()
+
+        if self.max_body_size is None or len(body) <= self.max_body_size:
+            self.response_cache.put(url, http_response, body)
+
+        response = urllib.addinfourl(StringIO(body), http_response.headers,
+                                     http_response.geturl(), http_response.code)
+        response.timings = timings
+        return response
 
     def _get_target_url(self, origin_url):
         """Return URL for target based on (absolute) origin_url.
@@ -272,6 +1968,48 @@ class Walker(object):
 
         return urlunparse((scheme, netloc, path, params, query, None))
 
+    def load_previous_results(self, f):
+        """Remember the content hashes and comparisons of an earlier run's results
+        so pages which haven't changed since then don't have to be compared again.
+        This turns on record_hashes, so our results can be reused in turn.
+        """
+        self.record_hashes = True
+
+        for result in iter_result_dicts(f):
+            if result.get("origin_hash") and result.get("target_hash") and result.get("comparison_key"):
+                self.previous_results[result["origin_url"]] = (result["origin_hash"],
+                                                               result["target_hash"],
+                                                               result["comparison_key"],
+                                                               result["comparisons"])
+
+    def get_comparison_key(self):
+        """Return a hash of the settings which affect comparisons: each
+        comparator's configuration and the noise expressions
+        """
+        settings = {"comparators": [comparator.get_config() for comparator in self.comparators],
+                    "origin_noise": self.origin_noise and self.origin_noise.expressions,
+                    "target_noise": self.target_noise and self.target_noise.expressions}
+        return hashlib.sha1(json.dumps(settings, sort_keys=True)).hexdigest()
+
+    def _get_previous_comparisons(self, origin_url, origin_hash, target_hash, comparison_key):
+        """Return the earlier run's comparisons if neither page nor the
+        comparison settings have changed since
+        """
+        try:
+            (previous_origin_hash, previous_target_hash, previous_comparison_key,
+             comparisons) = self.previous_results[origin_url]
+        except KeyError:
+            return None
+
+        if (previous_origin_hash != origin_hash or previous_target_hash != target_hash
+                or previous_comparison_key != comparison_key
+                or any(comparator.__class__.__name__ not in comparisons
+                       for comparator in self.comparators)):
+            return None
+
+        return dict((comparator.__class__.__name__, comparisons[comparator.__class__.__name__])
+                    for comparator in self.comparators)
+
     def add_comparator(self, comparator_function):
         """Add a comparator method to the list of comparators to try.
         Each comparator should return a floating point number between
@@ -288,7 +2026,8 @@ class Walker(object):
 
         for r in self.results:
             stats[r.result_type] = stats.get(r.result_type, 0) + 1
-        result_list = [r.__dict__ for r in self.results]
+        stats.update(self.get_summary_stats())
+        result_list = [r.to_dict() for r in self.results]
         all_results = dict(results=dict(resultlist=result_list, stats=stats))
 
         try:
@@ -299,120 +2038,495 @@ class Walker(object):
 
         return json_results
 
+    def get_summary_stats(self):
+        """Return the stats which summarize the whole crawl rather than count
+        results: the stage timings, how each side's throttle has backed off
+        and, if they were timed, each noise XPath's cost
+        """
+        stats = {"timings": self.get_timing_stats()}
+
+        for name, noise in (("origin", self.origin_noise), ("target", self.target_noise)):
+            if noise is not None and noise.timed:
+                stats.setdefault("noise_xpaths", {})[name] = noise.get_timings()
+
+        if self._throttles:
+            stats["throttles"] = dict((side, throttle.summary())
+                                      for side, throttle in self._throttles.items())
+
+        return stats
+
+    def get_timing_stats(self):
+        """Return the count, mean, max and 50th, 95th and 99th percentile
+        seconds spent in each stage, for finding the one limiting throughput
+        """
+        return dict((stage, histogram.summary())
+                    for stage, histogram in self.timing_histograms.items())
+
+    def columnar_results(self, html_errors_file=None):
+        """Return results and stats as parallel arrays, one per field, for the
+        report to page through without building an object for every result.
+
+        result_type is an index into result_types and target_url is None when
+        it's just the origin URL moved to target_url_base, or "" if there
+        isn't one (e.g. the origin page failed). If html_errors_file
+        is provided each result's HTML errors are written to it as a line of
+        JSON and the report fetches them with a Range request using
+        html_errors_offsets; otherwise only the error counts are kept. The
+        lines hold the flat (line, col, message index) arrays from
+        pack_html_errors, indexing html_error_messages.
+        """
+        result_types = sorted(RESULT_TYPES)
+        comparators = sorted(set(chain.from_iterable(r.comparisons for r in self.results)))
+
+        columns = dict((k, []) for k in ("result_type", "origin_url", "origin_code",
+                                         "origin_time", "origin_html_errors", "target_url",
+                                         "target_code", "target_time", "target_html_errors"))
+        columns.update((name, []) for name in comparators)
+        html_errors_offsets = [0]
+        html_error_messages = MessageTable()
+        stats = {}
+
+        for r in self.results:
+            stats[r.result_type] = stats.get(r.result_type, 0) + 1
+
+            columns["result_type"].append(result_types.index(r.result_type))
+            columns["origin_url"].append(r.origin_url)
+            columns["origin_code"].append(r.origin_code)
+            columns["target_code"].append(r.target_code)
+
+            if (r.origin_url.startswith(self.origin_url_base)
+                    and r.target_url == self._get_target_url(r.origin_url)):
+                columns["target_url"].append(None)
+            elif r.target_url is None:
+                columns["target_url"].append("")
+            else:
+                columns["target_url"].append(r.target_url)
+
+            for k in ("origin_time", "target_time"):
+                t = getattr(r, k)
+                columns[k].append(round(t, 3) if t is not None else None)
+
+            origin_errors, target_errors = r.count_html_errors()
+            columns["origin_html_errors"].append(origin_errors)
+            columns["target_html_errors"].append(target_errors)
+
+            for name in comparators:
+                columns[name].append(r.comparisons.get(name))
+
+            if html_errors_file is not None:
+                if origin_errors or target_errors:
+                    errors = {}
+                    for k in ("origin", "target"):
+                        errors[k] = list(pack_html_errors(getattr(r, "%s_html_errors" % k) or [],
+                                                          html_error_messages))
+                    line = json.dumps(errors, separators=(",", ":")) + "\n"
+                    html_errors_file.write(line)
+                    html_errors_offsets.append(html_errors_offsets[-1] + len(line))
+                else:
+                    html_errors_offsets.append(html_errors_offsets[-1])
+
+        return {"origin_url_base": self.origin_url_base,
+                "target_url_base": self.target_url_base,
+                "result_types": result_types,
+                "comparators": comparators,
+                "count": len(self.results),
+                "columns": columns,
+                "html_errors_offsets": html_errors_offsets if html_errors_file is not None else None,
+                "html_error_messages": (html_error_messages.messages
+                                        if html_errors_file is not None else None),
+                "stats": dict(stats, **self.get_summary_stats())}
+
+    def _get_worker_pool(self):
+        """Return the pool used to run _compare_url for each origin URL.
+        Anything with apply_async(func, args) returning an object with get()
+        will do; the default is a thread pool sized to self.concurrency.
+        """
+        if self.use_gevent:
+            return GreenletPool(self.concurrency)
+        elif self.concurrency > 1:
+            return ThreadPool(self.concurrency)
+        else:
+            return SynchronousPool()
+
+    def _next_origin_url(self):
+        """Pop the next URL off the frontier and mark it visited"""
+        lv = self.origin_urls_visited
+        lt = len(self.origin_urls_todo)
+        logging.info("visited=%s todo=%s %03s%% try url=%s" % (
+                lv, lt, int(100.0 * lv / (lv + lt)), self.origin_urls_todo[0]))
+        origin_url = self.origin_urls_todo.popleft()
+        if not isinstance(origin_url, unicode):
+            origin_url = unicode(origin_url, errors='ignore')
+        self.origin_urls_visited += 1
+        return origin_url
+
+    def _add_origin_urls(self, urls):
+        """Add newly discovered origin URLs to the frontier unless we've seen them"""
+        for url in urls:
+            if url in self.origin_urls_seen:
+                logging.debug("Skipping already seen URL %s", url)
+                continue
+
+            self.origin_urls_seen.add(url)
+
+            if self.shard_spool is not None and not self.shard_spool.owns(url):
+                logging.debug("Passing URL=%s to shard %d", url, self.shard_spool.owner(url) + 1)
+                self.shard_spool.send(url)
+                continue
+
+            logging.debug("adding URL=%s", url)
+            self.origin_urls_todo.append(url)
+
+            if self.checkpoint is not None:
+                self.checkpoint.add_url(url)
+
+    def _get_links(self, response):
+        """Return the normalized URLs linked from response which we should crawl.
+        This only applies the filters which don't depend on crawl state so it
+        is safe to call from a worker; see _add_origin_urls for the rest.
+        """
+        urls = []
+        links_seen = set()
+        urls_seen = set()
+
+        for element, attribute, link, pos in response.htmltree.iterlinks():
+            if link in links_seen:
+                continue
+            links_seen.add(link)
+
+            url = self._filter_link(link)
+
+            if url is not None and url not in urls_seen:
+                urls_seen.add(url)
+                urls.append(url)
+
+        return urls
+
+    def _filter_link(self, link):
+        """Return link's normalized URL if it's one we should crawl, otherwise None.
+        Sites repeat the same navigation links on every page so the answers
+        are cached, up to link_cache_size of them.
+        """
+        try:
+            return self._link_cache[link]
+        except KeyError:
+            pass
+
+        url = self._normalize_url(link)
+
+        if not self._is_within_origin(url):
+            logging.debug("Skip url=%s not within origin_url=%s",
+                          url, self.origin_url_base)
+            url = None
+        elif any(i.match(url) for i in self.ignoreres):
+            logging.debug("Ignoring URL %s", url)
+            url = None
+
+        if len(self._link_cache) >= self.link_cache_size:
+            self._link_cache.clear()
+        self._link_cache[link] = url
+
+        return url
+
     def walk_and_compare(self):
         """Start at origin_url, generate target urls, run comparators, return dict of results.
         If there are no comparators, we will just return all the origin and target urls
         and any redirects we've encountered.
-        TODO: remove unneeded testing and logging, clean up if/else/continue
+
+        Up to self.concurrency URLs are processed at once but results are
+        collected in the order the URLs were taken from the frontier, so the
+        links discovered, results and stats are the same as a sequential run.
         """
-        while self.origin_urls_todo:
-            lv = len(self.origin_urls_visited)
-            lt = len(self.origin_urls_todo)
-            logging.info("visited=%s todo=%s %03s%% try url=%s" % (
-                    lv, lt, int(100.0 * lv / (lv + lt)), self.origin_urls_todo[0]))
-            origin_url = unicode(self.origin_urls_todo.pop(0), errors='ignore')
-            self.origin_urls_visited.append(origin_url)
+        # Fork the comparison processes before the worker pool starts any
+        # threads, whose locks could otherwise be copied into them held:
+        if self.comparison_processes:
+            self._comparison_pool = multiprocessing.Pool(self.comparison_processes)
 
-            logging.debug("Retrieving origin %s", origin_url)
+        pool = self._get_worker_pool()
+        in_flight = deque()
+        # Results whose comparisons are still running in comparison processes:
+        unfinished = deque()
 
-            try:
-                t = time.time()
-                origin_response = self._fetch_url(origin_url)
-                origin_time = time.time() - t
-            except (urllib2.URLError, httplib.BadStatusLine) as e:
-                logging.warning("Could not fetch origin_url=%s -- %s",
-                                origin_url, e)
-                # We won't have an HTTP code for low-level network failures:
-                result = ErrorResult(origin_url, getattr(e, 'code', 0))
-                self.results.append(result)
-                logging.info("result(err resp): %s", result)
-                continue
-            # TODO: do I need this check? or code block?
-            if origin_response.code != 200:
-                result = BadOriginResult(origin_url, origin_response.code)
-                self.results.append(result)
-                logging.warning(result)
-                continue
-            else:
-                if origin_response.content_type.startswith("text/html"):
-                    origin_html_errors = origin_response.get_parser_errors()
+        if self.checkpoint is not None:
+            self._restore_checkpoint()
 
-                    for url_obj in origin_response.htmltree.iterlinks():
-                        url = self._normalize_url(url_obj[2])
+        if self.shard_spool is not None:
+            self.origin_urls_todo = deque(url for url in self.origin_urls_todo
+                                          if self.shard_spool.owns(url))
 
-                        if not self._is_within_origin(url):
-                            logging.debug("Skip url=%s not within origin_url=%s",
-                                          url, self.origin_url_base)
-                            continue
+        try:
+            while True:
+                while self.origin_urls_todo or in_flight:
+                    while self.origin_urls_todo and len(in_flight) < self.concurrency:
+                        origin_url = self._next_origin_url()
+                        in_flight.append(pool.apply_async(self._compare_url, (origin_url, )))
+
+                    result, urls, comparisons = in_flight.popleft().get()
+                    self._add_origin_urls(urls)
+                    if self.shard_spool is not None:
+                        self._add_origin_urls(self.shard_spool.receive())
+                    unfinished.append((result, comparisons))
+                    self._finish_results(unfinished, block=False)
+
+                if not self._wait_for_shard_urls():
+                    break
+
+            self._finish_results(unfinished, block=True)
+
+            if self.result_stream is not None:
+                stats = dict(self.stats, **self.get_summary_stats())
+                self.result_stream.write(json.dumps({"stats": stats}, sort_keys=True))
+                self.result_stream.write("\n")
+        finally:
+            pool.close()
+            pool.join()
+            if self._comparison_pool is not None:
+                self._comparison_pool.close()
+                self._comparison_pool.join()
+                self._comparison_pool = None
+            if self.checkpoint is not None:
+                self.checkpoint.commit()
+            self.connection_pool.close()
+
+    def _restore_checkpoint(self):
+        """Pick up the frontier and finished results saved in self.checkpoint,
+        or start saving our own if it's empty
+        """
+        saved = self.checkpoint.load()
 
-                        if url in self.origin_urls_todo:
-                            continue
+        if not saved:
+            for url in self.origin_urls_todo:
+                self.checkpoint.add_url(url)
+            return
 
-                        if url in self.origin_urls_visited:
-                            logging.debug("Skipping already seen URL %s", url)
-                            continue
+        logging.info("Resuming from checkpoint %s", self.checkpoint.filename)
 
-                        if any(i.match(url) for i in self.ignoreres):
-                            logging.debug("Ignoring URL %s", url)
-                            continue
+        self.origin_urls_todo.clear()
 
-                        logging.debug("adding URL=%s", url)
-                        self.origin_urls_todo.append(url)
+        for url, result in saved:
+            self.origin_urls_seen.add(url)
 
-                target_url = self._get_target_url(origin_url)
-                logging.debug("Retrieving target %s", target_url)
-                try:
-                    t = time.time()
-                    target_response = self._fetch_url(target_url)
-                    target_time = time.time() - t
-                except urllib2.URLError, e:
-                    result = BadTargetResult(origin_url, origin_response.code, origin_time=origin_time,
-                                             origin_html_errors=origin_html_errors,
-                                             target_url=target_url, target_code=getattr(e, "code", e.errno))
-                    self.results.append(result)
-                    logging.warning(result)
-                    continue
-                except httplib.BadStatusLine, e:
-                    result = BadTargetResult(origin_url, origin_response.code, origin_time=origin_time,
-                                             origin_html_errors=origin_html_errors,
-                                             target_url=target_url, target_code=0)
-                    self.results.append(result)
-                    logging.warning(result)
-                    continue
+            if result is None:
+                self.origin_urls_todo.append(url)
+            else:
+                self.origin_urls_visited += 1
+                self._record_result(result_from_dict(result, url_prefixes=self.url_prefixes),
+                                    save=False)
+
+    def _wait_for_shard_urls(self):
+        """Wait for other shards to send us new URLs, returning False once
+        every shard is idle with nothing left to read (or we aren't sharded).
+        If shard_idle_timeout is set, also give up after that many seconds
+        without a URL from the others, in case one of them died.
+        """
+        if self.shard_spool is None:
+            return False
+
+        last_received = time.time()
+
+        while True:
+            urls = self.shard_spool.receive()
+            if urls:
+                last_received = time.time()
+            self._add_origin_urls(urls)
+            if self.origin_urls_todo:
+                self.shard_spool.set_state("busy")
+                return True
+
+            self.shard_spool.set_state("idle")
+            if self.shard_spool.is_finished():
+                self.shard_spool.set_state("done")
+                return False
+
+            if (self.shard_idle_timeout is not None
+                    and time.time() - last_received >= self.shard_idle_timeout):
+                logging.warning("Giving up on the other shards after %ss without a URL",
+                                self.shard_idle_timeout)
+                return False
+
+            time.sleep(self.shard_poll_interval)
+
+    def _get_timings(self, origin_response, target_response=None, timings=None):
+        """Return timings plus each response's stage timings as origin_STAGE and target_STAGE"""
+        timings = dict(timings or {})
+
+        for prefix, response in (("origin", origin_response), ("target", target_response)):
+            if response is not None:
+                timings.update(("%s_%s" % (prefix, stage), seconds)
+                               for stage, seconds in response.timings.items())
+
+        return timings
+
+    def _finish_results(self, unfinished, block):
+        """Move results from unfinished to self.results, in order, as their
+        comparisons complete. Without block, stop at the first one still running.
+        """
+        while unfinished:
+            result, comparisons = unfinished[0]
+
+            if comparisons is not None:
+                if not block and not comparisons.ready():
+                    return
+                result.comparisons, comparator_timings = comparisons.get()
+                result.timings.update(comparator_timings)
+                logging.info(result)
+
+            unfinished.popleft()
+            self._record_result(result)
+
+    def _record_result(self, result, save=True):
+        """Count a finished result and either keep it or write it to result_stream.
+        Unless save is False it's also saved to our checkpoint, if we have one.
+        """
+        self.stats[result.result_type] = self.stats.get(result.result_type, 0) + 1
+
+        stages = result.timings.items()
+        stages.extend(("%s_fetch" % prefix, getattr(result, "%s_time" % prefix))
+                      for prefix in ("origin", "target"))
+        for stage, seconds in stages:
+            if seconds is None:
+                continue
+            if stage not in self.timing_histograms:
+                self.timing_histograms[stage] = TimingHistogram()
+            self.timing_histograms[stage].add(seconds)
+
+        if save and self.checkpoint is not None:
+            self.checkpoint.add_result(result)
+
+        if self.result_stream is None:
+            self.results.append(result)
+        else:
+            self.result_stream.write(json.dumps(result.to_dict(), sort_keys=True))
+            self.result_stream.write("\n")
+            self.result_stream.flush()
+
+    def _compare_url(self, origin_url):
+        """Fetch origin_url and its target, run comparators, return (result, links, comparisons).
+        This runs in the worker pool: anything touching the frontier or the
+        results belongs in walk_and_compare instead.
+        comparisons is None unless the comparators are running in a comparison
+        process, in which case it's the AsyncResult for result.comparisons.
+        TODO: remove unneeded testing and logging, clean up if/else/continue
+        """
+        logging.debug("Retrieving origin %s", origin_url)
+
+        urls = []
+        origin_html_errors = None
+        pending_comparisons = None
+        origin_hash = target_hash = comparison_key = None
+        timings = {}
 
+        try:
+            t = time.time()
+            origin_response = self._fetch_url(origin_url)
+            origin_time = time.time() - t
+        except FETCH_ERRORS as e:
+            logging.warning("Could not fetch origin_url=%s -- %s",
+                            origin_url, e)
+            # We won't have an HTTP code for low-level network failures:
+            result = ErrorResult(origin_url, getattr(e, 'code', 0))
+            logging.info("result(err resp): %s", result)
+            return result, urls, None
+        # TODO: do I need this check? or code block?
+        if origin_response.code != 200:
+            result = BadOriginResult(origin_url, origin_response.code,
+                                     timings=self._get_timings(origin_response))
+            logging.warning(result)
+            return result, urls, None
+
+        if origin_response.is_html:
+            if self.validate_html:
+                origin_html_errors = origin_response.get_parser_errors()
+            urls = self._get_links(origin_response)
+
+        target_url = self._get_target_url(origin_url)
+        logging.debug("Retrieving target %s", target_url)
+        try:
+            t = time.time()
+            target_response = self._fetch_url(target_url)
+            target_time = time.time() - t
+        except urllib2.URLError, e:
+            result = BadTargetResult(origin_url, origin_response.code, origin_time=origin_time,
+                                     origin_html_errors=origin_html_errors,
+                                     target_url=target_url, target_code=getattr(e, "code", e.errno),
+                                     timings=self._get_timings(origin_response),
+                                     url_prefixes=self.url_prefixes)
+            logging.warning(result)
+            return result, urls, None
+        except (httplib.HTTPException, socket.error), e:
+            result = BadTargetResult(origin_url, origin_response.code, origin_time=origin_time,
+                                     origin_html_errors=origin_html_errors,
+                                     target_url=target_url, target_code=0,
+                                     timings=self._get_timings(origin_response),
+                                     url_prefixes=self.url_prefixes)
+            logging.warning(result)
+            return result, urls, None
+
+        if not origin_response.is_html or not target_response.is_html:
+            logging.warning("compare: non-HTML origin content_type=%s or target content_type=%s",
+                            origin_response.content_type, target_response.content_type)
+            target_html_errors = []
+            origin_hash = origin_response.body_hash
+            target_hash = target_response.body_hash
+            score = self.asset_comparator.compare(origin_response, target_response)
+            comparisons = {"AssetComparator": score} if score is not None else {}
+        else:
+            # De-noising step, which needs the trees; otherwise they're only
+            # parsed if validation or a comparator asks for them:
+            denoise = [(noise, response.htmltree)
+                       for noise, response in ((self.origin_noise, origin_response),
+                                               (self.target_noise, target_response))
+                       if noise is not None]
+            if denoise:
                 logging.debug("Denoising HTML")
-                # De-noising step:
-                for xp in self.origin_noise_xpaths:
-                    for e in xp(origin_response.htmltree):
-                        e.getparent().remove(e)
-                for xp in self.target_noise_xpaths:
-                    for e in xp(target_response.htmltree):
-                        e.getparent().remove(e)
-
-                if origin_response.htmltree == None or target_response.htmltree == None:
-                    logging.warning("compare: None for origin htmltree=%s or target htmltree=%s",
-                                    origin_response.htmltree, target_response.htmltree)
-                    target_html_errors = []
-                    comparisons = {}
-                else:
-                    target_html_errors = target_response.get_parser_errors()
-
-                    comparisons = {}
-
-                    logging.debug("Starting content comparison")
-                    for comparator in self.comparators:
-                        proximity = comparator.compare(origin_response, target_response)
-                        comparisons[comparator.__class__.__name__] = proximity
-                    logging.debug("Comparisons completed")
-
-                result = GoodResult(origin_url, origin_response.code, origin_time=origin_time,
-                                    origin_html_errors=origin_html_errors,
-                                    target_url=target_url, target_code=target_response.code,
-                                    target_time=target_time,
-                                    target_html_errors=target_html_errors,
-                                    comparisons=comparisons)
-                self.results.append(result)
-                logging.info(result)
+                t = time.time()
+                for noise, tree in denoise:
+                    noise.remove(tree)
+                timings["denoise"] = time.time() - t
+
+            if self.validate_html:
+                target_html_errors = target_response.get_parser_errors()
+            else:
+                target_html_errors = None
+
+            if self.record_hashes:
+                origin_hash = origin_response.get_content_hash(denoised=self.origin_noise is not None)
+                target_hash = target_response.get_content_hash(denoised=self.target_noise is not None)
+                comparison_key = self.get_comparison_key()
+                comparisons = self._get_previous_comparisons(origin_url, origin_hash, target_hash,
+                                                             comparison_key)
+            else:
+                comparisons = None
+
+            if comparisons is not None:
+                logging.debug("Reusing comparisons for unchanged %s", origin_url)
+            elif self._comparison_pool is not None:
+                t = time.time()
+                extracted = (ExtractedResponse(origin_response), ExtractedResponse(target_response))
+                timings["extract"] = time.time() - t
+                pending_comparisons = self._comparison_pool.apply_async(
+                    run_comparators, (self.comparators, ) + extracted)
+                comparisons = {}
+            else:
+                logging.debug("Starting content comparison")
+                comparisons, comparator_timings = run_comparators(self.comparators,
+                                                                  origin_response, target_response)
+                timings.update(comparator_timings)
+                logging.debug("Comparisons completed")
+
+        result = GoodResult(origin_url, origin_response.code, origin_time=origin_time,
+                            origin_html_errors=origin_html_errors,
+                            target_url=target_url, target_code=target_response.code,
+                            target_time=target_time,
+                            target_html_errors=target_html_errors,
+                            comparisons=comparisons,
+                            origin_hash=origin_hash, target_hash=target_hash,
+                            comparison_key=comparison_key,
+                            timings=self._get_timings(origin_response, target_response, timings),
+                            url_prefixes=self.url_prefixes)
+        if pending_comparisons is None:
+            logging.info(result)
+        return result, urls, pending_comparisons
 
 
 class Comparator(object):
@@ -425,25 +2539,78 @@ class Comparator(object):
     - compare 'features' extracted with OpenCalais et al
     TODO: are we going to compare non-HTML responses?
           If so, we can't presume HTML-Tree objects as inputs.
+
+    similarity names the SIMILARITY_ENGINES entry used by fuzziness, which
+    trades exactness for speed on large pages.
+
+    interesting_threshold is an optional score: if a cheap upper bound on
+    the score falls below it, fuzziness reports the bound instead of
+    computing the exact score. A bound can show two pages differ but never
+    that they match, so only equal texts are settled at the top.
     """
-    def __init__(self):
+    def __init__(self, similarity="sequence", interesting_threshold=None):
         self.match_nothing = 0
         self.match_perfect = 100
 
+        if similarity not in SIMILARITY_ENGINES:
+            raise ValueError("Unknown similarity engine %s: expected one of %s" % (
+                             similarity, ", ".join(sorted(SIMILARITY_ENGINES))))
+        self.similarity = SIMILARITY_ENGINES[similarity]
+        self.interesting_threshold = interesting_threshold
+
+    def get_config(self):
+        """Return the settings our scores depend on, as a JSON-able list"""
+        return [self.__class__.__name__, self.similarity.name, self.interesting_threshold]
+
     def unfraction(self, number):
         """Convert a 0 - 1 fractional into our match range"""
         return int((self.match_perfect - self.match_nothing) * number)
 
     def fuzziness(self, origin_text, target_text):
         """Return a fuzzy comparison value for the two (preprocessed) texts"""
-        if origin_text and target_text:
-            sm = SequenceMatcher(None,
-                                 collapse_whitespace(origin_text).lower(),
-                                 collapse_whitespace(target_text).lower())
-            return self.unfraction(sm.ratio())
-        else:
+        if not origin_text or not target_text:
+            return self.match_nothing
+
+        origin_text = collapse_whitespace(origin_text).lower()
+        target_text = collapse_whitespace(target_text).lower()
+
+        score = self._settle_early(origin_text, target_text)
+        if score is not None:
+            return score
+
+        return self.unfraction(self.similarity(origin_text, target_text))
+
+    def fuzzy_compare(self, origin_response, target_response, name):
+        """Like fuzziness, for the named text of each response (see Response.get_feature).
+        The normalized and prepared forms are cached on the responses so other
+        comparators using the same text or engine don't have to redo them.
+        """
+        origin_text = origin_response.get_feature(name)
+        target_text = target_response.get_feature(name)
+
+        if not origin_text or not target_text:
             return self.match_nothing
 
+        score = self._settle_early(origin_text, target_text)
+        if score is not None:
+            return score
+
+        return self.unfraction(self.similarity.score(origin_response.get_feature(name, self.similarity),
+                                                     target_response.get_feature(name, self.similarity)))
+
+    def _settle_early(self, origin_text, target_text):
+        """Return the score for two normalized texts if it can be settled cheaply, otherwise None"""
+        if origin_text == target_text:
+            return self.match_perfect
+
+        if self.interesting_threshold and self.similarity.upper_bounds:
+            for bound in self.similarity.upper_bounds(origin_text, target_text):
+                score = self.unfraction(bound)
+                if score < self.interesting_threshold:
+                    return score
+
+        return None
+
     def compare(self, origin_response, target_response):
         """This is expected to be subclassed and then superclass invoked.
         """
@@ -455,23 +2622,19 @@ class TitleComparator(Comparator):
     Origin: "NASA Science", Target: "Site Map - NASA Science"
     """
     def compare(self, origin_response, target_response):
-        origin_title = target_title = None
+        origin_title = origin_response.get_title()
+        target_title = target_response.get_title()
 
-        try:
-            origin_title = origin_response.htmltree.xpath("//html/head/title")[0].text
-            target_title = target_response.htmltree.xpath("//html/head/title")[0].text
-        except IndexError:
+        if origin_title is None or target_title is None:
             logging.warning("Couldn't find a origin_title=%s or target_title=%s", origin_title, target_title)
             return self.match_nothing
 
-        return self.fuzziness(clean_text(origin_title),
-                              clean_text(target_title))
+        return self.fuzzy_compare(origin_response, target_response, "title")
 
 
 class ContentComparator(Comparator):
     def compare(self, origin_response, target_response):
-        return self.fuzziness(clean_text(origin_response.content),
-                              clean_text(target_response.content))
+        return self.fuzzy_compare(origin_response, target_response, "content")
 
 
 class BodyComparator(Comparator):
@@ -484,8 +2647,7 @@ class BodyComparator(Comparator):
                             origin_body, target_body)
             return self.match_nothing
         else:
-            return self.fuzziness(collapse_whitespace(origin_body),
-                                  collapse_whitespace(target_body))
+            return self.fuzzy_compare(origin_response, target_response, "body")
 
 
 class LengthComparator(Comparator):
@@ -504,6 +2666,24 @@ class LengthComparator(Comparator):
         return self.unfraction(fraction)
 
 
+class AssetComparator(LengthComparator):
+    """Compare responses we don't parse, like images or PDFs, without looking
+    inside them: identical bodies match perfectly, otherwise the score is how
+    close their lengths are, short of perfect. Returns None if either length
+    is unknown.
+    """
+    def compare(self, origin_response, target_response):
+        if (origin_response.body_hash is not None
+                and origin_response.body_hash == target_response.body_hash):
+            return self.match_perfect
+
+        if origin_response.content_length is None or target_response.content_length is None:
+            return None
+
+        return min(LengthComparator.compare(self, origin_response, target_response),
+                   self.match_perfect - 1)
+
+
 class NgramComparator(Comparator):
     """Report NGram string similarity
 
@@ -517,6 +2697,256 @@ class NgramComparator(Comparator):
         return int(self.match_perfect * similarity)
 
 
+class ResultIndex(object):
+    """SQLite index of a result file for answering paged, sorted and filtered
+    queries without holding the results in memory.
+
+    The default filename of "" gives SQLite a private temporary database.
+    It may be queried from any thread, though only by one at a time.
+    """
+    #: Columns which may be used to sort results, besides comparator names:
+    SORT_COLUMNS = ("result_type", "origin_url", "target_url", "origin_code", "target_code",
+                    "origin_time", "target_time", "origin_html_errors", "target_html_errors")
+
+    def __init__(self, filename=""):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE results (row INTEGER PRIMARY KEY, result_type TEXT,
+                                  origin_url TEXT, target_url TEXT,
+                                  origin_code INTEGER, target_code INTEGER,
+                                  origin_time REAL, target_time REAL,
+                                  origin_html_errors INTEGER, target_html_errors INTEGER,
+                                  html_errors TEXT);
+            CREATE TABLE scores (row INTEGER, comparator TEXT, score INTEGER,
+                                 PRIMARY KEY (comparator, row));
+        """)
+        self.comparators = set()
+        self.stats = {}
+
+    def load(self, f):
+        """Add every result in f, a file written by json_results, --jsonl or --columnar"""
+        def rows():
+            for row, result in enumerate(iter_result_dicts(f), self.count()):
+                self.stats[result["result_type"]] = self.stats.get(result["result_type"], 0) + 1
+                self.comparators.update(result.get("comparisons") or {})
+                yield row, result
+
+        def count_errors(errors):
+            return len(errors) if errors is not None else None
+
+        scores = []
+        for row, result in rows():
+            self.db.execute("INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (row, result["result_type"], result["origin_url"],
+                             result.get("target_url"), result.get("origin_code"),
+                             result.get("target_code"), result.get("origin_time"),
+                             result.get("target_time"),
+                             count_errors(result.get("origin_html_errors")),
+                             count_errors(result.get("target_html_errors")),
+                             json.dumps({"origin": result.get("origin_html_errors") or [],
+                                         "target": result.get("target_html_errors") or []})))
+            scores.extend((row, name, score)
+                          for name, score in (result.get("comparisons") or {}).items())
+
+            if len(scores) > 10000:
+                self.db.executemany("INSERT INTO scores VALUES (?, ?, ?)", scores)
+                scores = []
+
+        self.db.executemany("INSERT INTO scores VALUES (?, ?, ?)", scores)
+        self.db.executescript("""
+            CREATE INDEX IF NOT EXISTS results_type ON results (result_type);
+            CREATE INDEX IF NOT EXISTS results_origin_url ON results (origin_url);
+            CREATE INDEX IF NOT EXISTS scores_row ON scores (row);
+        """)
+        self.db.commit()
+
+    def count(self):
+        return self.db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def query(self, result_types=None, comparator=None, min_score=None, max_score=None,
+              url_prefix=None, sort="origin_url", descending=False, start=0, count=100):
+        """Return (records, total) for one page of the results matching the filters.
+
+        result_types limits the results to those types (all if it's None,
+        none if it's empty), min_score and
+        max_score to those whose comparator score falls in that range and
+        url_prefix to origin URLs starting with it. Records are dicts of the
+        indexed fields plus row and a key for each comparator's score.
+        """
+        with self.lock:
+            return self._query(result_types, comparator, min_score, max_score,
+                               url_prefix, sort, descending, start, count)
+
+    def _query(self, result_types, comparator, min_score, max_score,
+               url_prefix, sort, descending, start, count):
+        joins = []
+        where = []
+        params = []
+        order_by = "results.origin_url"
+
+        if sort in self.comparators:
+            joins.append("LEFT JOIN scores AS sort_scores ON sort_scores.row = results.row"
+                         " AND sort_scores.comparator = ?")
+            params.append(sort)
+            order_by = "sort_scores.score"
+        elif sort in self.SORT_COLUMNS:
+            order_by = "results.%s" % sort
+        elif sort:
+            raise ValueError("Cannot sort on %s" % sort)
+
+        if min_score is not None or max_score is not None:
+            if comparator not in self.comparators:
+                raise ValueError("Unknown comparator %s" % comparator)
+            joins.append("JOIN scores AS filter_scores ON filter_scores.row = results.row"
+                         " AND filter_scores.comparator = ?")
+            params.append(comparator)
+            if min_score is not None:
+                where.append("filter_scores.score >= ?")
+                params.append(min_score)
+            if max_score is not None:
+                where.append("filter_scores.score <= ?")
+                params.append(max_score)
+
+        if result_types is not None:
+            where.append("results.result_type IN (%s)" % ", ".join("?" * len(result_types)))
+            params.extend(result_types)
+
+        if url_prefix:
+            # A range rather than LIKE so the origin_url index can be used:
+            where.append("results.origin_url >= ? AND results.origin_url < ?")
+            params.extend([url_prefix, url_prefix[:-1] + unichr(ord(url_prefix[-1]) + 1)])
+
+        sql = "FROM results %s %s" % (" ".join(joins), "WHERE " + " AND ".join(where) if where else "")
+
+        total = self.db.execute("SELECT COUNT(*) " + sql, params).fetchone()[0]
+
+        cursor = self.db.execute(
+            "SELECT results.row, result_type, origin_url, target_url, origin_code, target_code,"
+            " origin_time, target_time, origin_html_errors, target_html_errors %s"
+            " ORDER BY %s %s, results.row LIMIT ? OFFSET ?" % (sql, order_by,
+                                                               "DESC" if descending else "ASC"),
+            params + [count, start])
+
+        fields = ("row", ) + self.SORT_COLUMNS
+        records = [dict(zip(fields, values)) for values in cursor]
+
+        by_row = dict((record["row"], record) for record in records)
+        if by_row:
+            for row, name, score in self.db.execute(
+                    "SELECT row, comparator, score FROM scores WHERE row IN (%s)"
+                    % ", ".join("?" * len(by_row)), by_row.keys()):
+                by_row[row][name] = score
+
+        return records, total
+
+    def get_html_errors(self, row):
+        """Return {"origin": [...], "target": [...]} for the result in row"""
+        with self.lock:
+            found = self.db.execute("SELECT html_errors FROM results WHERE row = ?",
+                                    (row, )).fetchone()
+        if found is None:
+            raise KeyError(row)
+        return json.loads(found[0])
+
+    def close(self):
+        self.db.close()
+
+
+class ResultRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve the HTML report and answer its queries from the server's ResultIndex
+
+    webcompare.json describes the results rather than containing them, which
+    tells webcompare.js to request each page from /results and HTML errors
+    from /errors instead of loading everything up front.
+    """
+    #: Files from next to this script which make up the report:
+    STATIC_FILES = {"/webcompare.html": "text/html; charset=utf-8",
+                    "/webcompare.js": "application/javascript",
+                    "/webcompare.css": "text/css"}
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        params = parse_qs(query)
+
+        try:
+            if path == "/":
+                self.send_response(302)
+                self.send_header("Location", "/webcompare.html")
+                self.end_headers()
+            elif path in self.STATIC_FILES:
+                filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), path[1:])
+                with open(filename, "rb") as f:
+                    self.send_body(f.read(), self.STATIC_FILES[path])
+            elif path == "/webcompare.json":
+                index = self.server.result_index
+                self.send_json({"server": True, "comparators": sorted(index.comparators),
+                                "result_types": sorted(RESULT_TYPES), "stats": index.stats})
+            elif path == "/results":
+                self.send_json(self.query_results(params))
+            elif path == "/errors":
+                self.send_json(self.server.result_index.get_html_errors(int(params["row"][0])))
+            else:
+                self.send_error(404)
+        except (KeyError, ValueError) as e:
+            self.send_error(400, "Invalid request: %s" % e)
+
+    def query_results(self, params):
+        def get(name, convert=None):
+            if name not in params:
+                return None
+            return convert(params[name][0]) if convert else params[name][0].decode("utf-8")
+
+        # Like the static report, no result_type boxes ticked shows nothing:
+        records, total = self.server.result_index.query(
+            result_types=params.get("result_type", []),
+            comparator=get("comparator"),
+            min_score=get("min_score", int),
+            max_score=get("max_score", int),
+            url_prefix=get("prefix"),
+            sort=get("sort") or "origin_url",
+            descending=get("dir") == "desc",
+            start=get("startIndex", int) or 0,
+            count=min(get("results", int) or 100, 1000))
+
+        return {"records": records, "totalRecords": total}
+
+    def send_json(self, data):
+        self.send_body(json.dumps(data), "application/json")
+
+    def send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.info("%s %s", self.address_string(), format % args)
+
+
+def serve_results(filename, port=8000):
+    """Index the results in filename and serve the report for them on port"""
+    index = ResultIndex()
+    with open(filename, "rb") as f:
+        try:
+            index.load(f)
+        except (IOError, ValueError) as e:
+            logging.error("Unable to index %s: %s", filename, e)
+            sys.exit(1)
+    logging.info("Indexed %d results from %s", index.count(), filename)
+
+    server = BaseHTTPServer.HTTPServer(("localhost", port), ResultRequestHandler)
+    server.result_index = index
+    print "Serving %s at http://localhost:%d/" % (filename, server.server_port)
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        index.close()
+
+
 if __name__ == "__main__":
     usage = 'usage: %prog [options] origin_url target_url   (do: "%prog --help" for help)'
     parser = OptionParser(usage)
@@ -526,6 +2956,12 @@ if __name__ == "__main__":
                       help="Launch interactive debugger on failures")
     parser.add_option("-f", "--file", dest="filename",
                       help="path to store the json results to (default is stdout)")
+    parser.add_option("--jsonl", action="store_true", default=False,
+                      help="Write each result as a line of JSON as soon as it completes, "
+                           "followed by a stats line, instead of one JSON document at the end")
+    parser.add_option("--columnar", action="store_true", default=False,
+                      help="Write compact per-field arrays for webcompare.html, with the "
+                           "HTML errors in FILE.errors.jsonl, which is loaded on demand")
     parser.add_option("-i", "--ignorere", dest="ignoreres", action="append", default=[],
                       help="Ignore URLs matching this regular expression, can use multiple times")
     parser.add_option("-I", "--ignorere-file", dest="ignorere_file",
@@ -536,15 +2972,148 @@ if __name__ == "__main__":
     parser.add_option("--target-noise-xpath-file",
                       help="File containing XPath expressions to strip from "
                            "target server responses before comparison")
+    parser.add_option("--noise-xpath-timings", action="store_true", default=False,
+                      help="Evaluate each noise XPath separately and report the time each "
+                           "takes in the stats. Slower, but shows which are expensive")
+
+    parser.add_option("--no-validation", dest="validate_html", action="store_false", default=True,
+                      help="Don't record HTML validation errors, which also skips parsing "
+                           "pages the comparators don't need a tree for")
+
+    parser.add_option("--similarity", action="append", default=[],
+                      metavar="[COMPARATOR=]ENGINE",
+                      help="Similarity engine for fuzzy comparisons: %s (default sequence, "
+                           "which is exact but slow on large pages). Prefix with a comparator "
+                           "name, e.g. ContentComparator=minhash, to set it for one comparator; "
+                           "can use multiple times" % ", ".join(sorted(SIMILARITY_ENGINES)))
+
+    parser.add_option("--interesting-threshold", type="int", metavar="SCORE",
+                      help="Report a cheap upper bound instead of the exact fuzzy score when "
+                           "the bound is below SCORE (e.g. 20)")
+
+    parser.add_option("--comparison-processes", type="int", default=0,
+                      help="Run comparators in this many separate processes so they can use "
+                           "every core while fetching continues (default runs them in-process)")
+
+    parser.add_option("--previous-results", metavar="FILE",
+                      help="Results from an earlier run: pages whose origin and target "
+                           "content and comparison settings haven't changed since keep "
+                           "their old comparisons")
+    parser.add_option("--record-hashes", action="store_true", default=False,
+                      help="Save a hash of each page's content with the results so a later "
+                           "run can use them as --previous-results (implied by --previous-results)")
+
+    parser.add_option("--concurrency", type="int", default=1,
+                      help="Number of origin/target pages to fetch and compare at once")
+    parser.add_option("--gevent", action="store_true", default=False,
+                      help="Use gevent greenlets rather than threads for --concurrency, "
+                           "which allows thousands of requests in flight")
+    parser.add_option("--max-connections-per-host", type="int",
+                      help="Limit concurrent requests to each host (default is unlimited)")
+    parser.add_option("--origin-rate", type="float", metavar="N",
+                      help="Start at most N requests a second to the origin (default is unlimited)")
+    parser.add_option("--target-rate", type="float", metavar="N",
+                      help="Start at most N requests a second to the target (default is unlimited)")
+    parser.add_option("--origin-concurrency", type="int", metavar="N",
+                      help="Most requests in flight to the origin; fewer are used while it "
+                           "is slow or failing (default is --concurrency)")
+    parser.add_option("--target-concurrency", type="int", metavar="N",
+                      help="Most requests in flight to the target; fewer are used while it "
+                           "is slow or failing (default is --concurrency)")
+    parser.add_option("--latency-backoff", type="float", metavar="FACTOR",
+                      help="Also reduce a side's concurrency when a request takes more than "
+                           "FACTOR times its average latency (default is to back off only "
+                           "on errors)")
+    parser.add_option("--retries", type="int", default=2,
+                      help="Times to retry a 429, 502, 503, 504 or dropped connection "
+                           "before recording an error (default %default)")
+    parser.add_option("--retry-backoff", type="float", default=1.0,
+                      help="Seconds to back off before the first retry, doubling for each "
+                           "retry and randomized, unless the server sent Retry-After "
+                           "(default %default)")
+    parser.add_option("--max-retry-delay", type="float", default=60,
+                      help="Never wait longer than this many seconds before a retry, "
+                           "whatever Retry-After says (default %default)")
+    parser.add_option("--max-body-size", type="float", default=20,
+                      help="Stop downloading responses bigger than this many MB, comparing "
+                           "only their lengths (default %default, 0 for no limit)")
+    parser.add_option("--body-type", dest="body_types", action="append", metavar="TYPE",
+                      help="Content type whose bodies are kept for parsing and comparison; "
+                           "others are only hashed as they download. Can be used multiple "
+                           "times (default text/html)")
+    parser.add_option("--no-asset-hashes", dest="hash_bodies", action="store_false", default=True,
+                      help="Don't download the bodies of other content types at all, just "
+                           "compare their Content-Length")
+    parser.add_option("--pool-size", type="int",
+                      help="Number of idle keep-alive connections to keep for each host "
+                           "(default is --concurrency, 0 disables keep-alive)")
+    parser.add_option("--pool-idle-timeout", type="float", default=30,
+                      help="Close keep-alive connections idle for more than this many "
+                           "seconds (default %default)")
+
+    parser.add_option("--bloom-filter-capacity", type="int",
+                      help="Remember crawled URLs in a fixed-size Bloom filter sized for "
+                           "this many URLs instead of an exact set, to bound memory use")
+    parser.add_option("--bloom-filter-error-rate", type="float", default=0.001,
+                      help="Fraction of new URLs a full Bloom filter may wrongly "
+                           "skip (default %default)")
+
+    parser.add_option("--checkpoint", metavar="FILE",
+                      help="Save the frontier and finished results to this SQLite file "
+                           "so an interrupted run can be continued with --resume")
+    parser.add_option("--checkpoint-interval", type="int", default=100,
+                      help="Commit the checkpoint every this many results (default %default)")
+    parser.add_option("--resume", action="store_true", default=False,
+                      help="Continue the crawl saved in --checkpoint instead of starting over")
+
+    parser.add_option("--cache", metavar="FILE",
+                      help="Keep responses in this SQLite file and revalidate them with "
+                           "the server on later runs instead of downloading them again")
+    parser.add_option("--cache-size", type="int", default=1024,
+                      help="Evict the least recently used responses once the cache holds "
+                           "more than this many megabytes (default %default)")
+    parser.add_option("--origin-frozen", action="store_true", default=False,
+                      help="Serve origin pages only from --cache without contacting the origin server")
+
+    parser.add_option("--shard", metavar="I/N",
+                      help="Crawl only the I-th of N disjoint slices of the origin site, "
+                           "exchanging URLs with the other shards through --spool-dir")
+    parser.add_option("--spool-dir",
+                      help="Directory, shared by every shard, for handing URLs between them")
+    parser.add_option("--shard-idle-timeout", type="float",
+                      help="Give up waiting for the other shards once our frontier is empty "
+                           "and none of them has sent us a URL for this many seconds "
+                           "(default: wait until every shard is done)")
+
+    parser.add_option("--serve", metavar="RESULTS_FILE",
+                      help="Instead of crawling, serve the HTML report for RESULTS_FILE, "
+                           "answering its queries from an index of the results")
+    parser.add_option("--port", type="int", default=8000,
+                      help="Port for --serve to listen on (default %default)")
 
     parser.add_option("--profile", action="store_true", default=False,
                       help="Use cProfile to run webcompare")
 
     ignoreres = []              # why isn't this set by the parser.add_option above?
     (options, args) = parser.parse_args()
+
+    if options.serve:
+        logging.basicConfig(format=LOGGING_FORMAT,
+                            level=logging.INFO if options.verbose else logging.WARNING)
+        serve_results(os.path.expanduser(options.serve), port=options.port)
+        sys.exit(0)
+
     if len(args) != 2:
         parser.error("Must specify origin and target urls")
 
+    if options.gevent:
+        # This has to happen before any sockets are created:
+        try:
+            from gevent import monkey
+        except ImportError:
+            parser.error("--gevent requires the gevent package")
+        monkey.patch_all()
+
     if options.verbose > 1:
         logging.basicConfig(format=LOGGING_FORMAT, level=logging.DEBUG)
     elif options.verbose:
@@ -552,6 +3121,37 @@ if __name__ == "__main__":
     else:
         logging.basicConfig(format=LOGGING_FORMAT, level=logging.WARN)
 
+    similarity_engines = {}
+    for spec in options.similarity:
+        comparator_name, _, engine = spec.rpartition("=")
+        if engine not in SIMILARITY_ENGINES:
+            parser.error("Unknown similarity engine %s" % engine)
+        similarity_engines[comparator_name] = engine
+
+    def get_similarity(comparator_name):
+        return similarity_engines.get(comparator_name,
+                                      similarity_engines.get("", "sequence"))
+
+    if options.resume and not options.checkpoint:
+        parser.error("--resume requires --checkpoint")
+
+    if options.origin_frozen and not options.cache:
+        parser.error("--origin-frozen requires --cache")
+
+    if options.columnar and (options.jsonl or not options.filename):
+        parser.error("--columnar requires -f and can't be combined with --jsonl")
+
+    if options.shard:
+        try:
+            shard_index, shard_count = [int(i) for i in options.shard.split("/")]
+            if not 1 <= shard_index <= shard_count:
+                raise ValueError
+        except ValueError:
+            parser.error("--shard must look like I/N with I between 1 and N, e.g. 2/4")
+
+        if not options.spool_dir:
+            parser.error("--shard requires --spool-dir")
+
     if options.ignorere_file:
         file_ignores = open(os.path.expanduser(options.ignorere_file)).readlines()
         file_ignores = [regex.rstrip('\n') for regex in file_ignores
@@ -575,13 +3175,42 @@ if __name__ == "__main__":
         profiler.enable()
 
     try:
-        w = Walker(args[0], args[1], ignoreres=options.ignoreres)
+        if options.bloom_filter_capacity:
+            origin_urls_seen = BloomFilter(options.bloom_filter_capacity,
+                                           error_rate=options.bloom_filter_error_rate)
+        else:
+            origin_urls_seen = None
+
+        w = Walker(args[0], args[1], ignoreres=options.ignoreres,
+                   concurrency=options.concurrency, origin_urls_seen=origin_urls_seen)
+        w.use_gevent = options.gevent
+        w.validate_html = options.validate_html
+        w.comparison_processes = options.comparison_processes
+        w.max_connections_per_host = options.max_connections_per_host
+        w.origin_rate = options.origin_rate
+        w.target_rate = options.target_rate
+        w.origin_concurrency = options.origin_concurrency
+        w.target_concurrency = options.target_concurrency
+        w.max_retries = options.retries
+        w.latency_backoff = options.latency_backoff
+        w.retry_backoff = options.retry_backoff
+        w.max_retry_delay = options.max_retry_delay
+        if options.max_body_size:
+            w.max_body_size = int(options.max_body_size * 1024 * 1024)
+        w.body_types = set(get_mime_type(t) for t in options.body_types or ["text/html"])
+        w.hash_bodies = options.hash_bodies
+        if options.pool_size is not None:
+            w.connection_pool.max_size = options.pool_size
+        w.connection_pool.idle_timeout = options.pool_idle_timeout
         w.add_comparator(LengthComparator())
-        w.add_comparator(TitleComparator())
-        w.add_comparator(BodyComparator())
+        w.add_comparator(TitleComparator(similarity=get_similarity("TitleComparator"),
+                                         interesting_threshold=options.interesting_threshold))
+        w.add_comparator(BodyComparator(similarity=get_similarity("BodyComparator"),
+                                        interesting_threshold=options.interesting_threshold))
         # This is basically the same as the BodyComparator except for a little more
         # noise:
-        w.add_comparator(ContentComparator())
+        w.add_comparator(ContentComparator(similarity=get_similarity("ContentComparator"),
+                                           interesting_threshold=options.interesting_threshold))
 
         try:
             from ngram import NGram
@@ -590,13 +3219,58 @@ if __name__ == "__main__":
             print >>sys.stderr, "NgramComparator requires the ngram package"
 
         if options.origin_noise_xpath_file:
-            w.origin_noise_xpaths = [XPath(xp) for xp in open(options.origin_noise_xpath_file)]
+            w.origin_noise = NoiseFilter(open(options.origin_noise_xpath_file),
+                                         timed=options.noise_xpath_timings)
 
         if options.target_noise_xpath_file:
-            w.target_noise_xpaths = [XPath(xp) for xp in open(options.target_noise_xpath_file)]
+            w.target_noise = NoiseFilter(open(options.target_noise_xpath_file),
+                                         timed=options.noise_xpath_timings)
+
+        if options.jsonl:
+            w.result_stream = f
+
+        w.record_hashes = options.record_hashes
+        if options.previous_results:
+            with open(os.path.expanduser(options.previous_results)) as previous_results:
+                w.load_previous_results(previous_results)
+
+        if options.cache:
+            w.response_cache = ResponseCache(os.path.expanduser(options.cache),
+                                             max_size=options.cache_size * 1024 * 1024)
+            w.origin_frozen = options.origin_frozen
+
+        if options.shard:
+            try:
+                w.shard_spool = ShardSpool(os.path.expanduser(options.spool_dir),
+                                           shard_index - 1, shard_count, resume=options.resume)
+            except ValueError as e:
+                parser.error(e)
+            w.shard_idle_timeout = options.shard_idle_timeout
+
+        if options.checkpoint:
+            w.checkpoint = Checkpoint(os.path.expanduser(options.checkpoint),
+                                      interval=options.checkpoint_interval,
+                                      resume=options.resume)
 
         w.walk_and_compare()
-        f.write(w.json_results())
+
+        if options.columnar:
+            errors_filename = "%s.errors.jsonl" % os.path.splitext(os.path.expanduser(options.filename))[0]
+            with open(errors_filename, "wb") as errors_file:
+                columnar_results = w.columnar_results(html_errors_file=errors_file)
+            columnar_results["html_errors_file"] = os.path.basename(errors_filename)
+            json.dump(columnar_results, f, sort_keys=True, separators=(",", ":"))
+        elif not options.jsonl:
+            f.write(w.json_results())
+
+        if w.checkpoint is not None:
+            w.checkpoint.close()
+
+        if w.response_cache is not None:
+            w.response_cache.close()
+
+        if w.shard_spool is not None:
+            w.shard_spool.close()
         if f != sys.stdout:
             f.close()
     except StandardError as e: